@@ -0,0 +1,331 @@
+"""
+Benchmarks Image operations on synthetic images of realistic sizes.
+
+    python -m benchmarks.bench                      # Run, compare with baseline
+    python -m benchmarks.bench --save-baseline      # Run, store as baseline
+    python -m benchmarks.bench --sizes 1,50 --formats jpeg --filter resize
+
+Every case runs in its own process, so its peak RSS is measured on its
+own. Reported are latency percentiles, throughput in source megapixels per
+second and peak RSS growth. With a stored baseline, a case whose median
+latency or peak RSS grows by more than --tolerance fails the run, as does
+a case that raises, crashes or runs longer than --timeout.
+
+Everything runs offline, images are generated in a temporary directory.
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue as queue_module
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from PIL import Image as PILImage
+
+from da_vinci import images
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Megapixels, with a 3:2 aspect ratio like most cameras
+SIZES = (1, 12, 24, 50)
+MODES = ('RGB', 'RGBA', 'L', 'P')
+FORMATS = ('jpeg', 'png', 'webp', 'gif', 'tiff')
+
+# Modes each format can store
+FORMAT_MODES = {
+    'jpeg': ('RGB', 'L'),
+    'png': ('RGB', 'RGBA', 'L', 'P'),
+    'webp': ('RGB', 'RGBA'),
+    'gif': ('L', 'P'),
+    'tiff': ('RGB', 'RGBA', 'L', 'P'),
+}
+
+
+def get_dimensions(megapixels):
+    height = int((megapixels * 1000000 / 1.5) ** 0.5)
+    return (int(height * 1.5), height)
+
+
+def generate_image(size, mode):
+    """Returns an image with smooth areas and texture, which compresses
+    roughly like a photo."""
+    gradient = PILImage.linear_gradient('L').resize(size)
+    radial = PILImage.radial_gradient('L').resize(size)
+    noise = PILImage.effect_noise((size[0] // 4, size[1] // 4), 40).resize(size)
+    pil_image = PILImage.merge('RGB', (gradient, radial, noise))
+    if mode == 'RGBA':
+        pil_image.putalpha(radial)
+    elif mode == 'P':
+        pil_image = pil_image.quantize(256)
+    elif mode != 'RGB':
+        pil_image = pil_image.convert(mode)
+    return pil_image
+
+
+def generate_fixtures(directory, sizes, modes, formats):
+    fixtures = []
+    for megapixels in sizes:
+        for format in formats:
+            for mode in FORMAT_MODES[format]:
+                if mode not in modes:
+                    continue
+                filename = os.path.join(
+                    directory, '%smp-%s.%s' % (megapixels, mode.lower(), format))
+                generate_image(get_dimensions(megapixels), mode).save(filename)
+                fixtures.append((megapixels, mode, format, filename))
+    return fixtures
+
+
+def open_image(filename):
+    image = images.from_file(filename)
+    return image.width, image.height, image.format
+
+
+def decode(filename):
+    images.from_file(filename).get_pil_image().load()
+
+
+def resize_half(filename):
+    image = images.from_file(filename)
+    image.resize(width='50%', height='50%')
+
+
+def resize_fastest(filename):
+    image = images.from_file(filename)
+    image.resize(width=640, method='fit', resample='fastest')
+
+
+def resize_balanced(filename):
+    image = images.from_file(filename)
+    image.resize(width=640, method='fit', resample='balanced')
+
+
+def resize_best(filename):
+    image = images.from_file(filename)
+    image.resize(width=640, method='fit', resample='best')
+
+
+def thumbnail(filename):
+    image = images.from_file(filename, deferred=True)
+    image.resize(width=200, height=200, method='fit')
+    image.to_bytes()
+
+
+def crop(filename):
+    image = images.from_file(filename)
+    image.crop(512, 512)
+
+
+def adjust(filename):
+    image = images.from_file(filename)
+    image.adjust(saturation=-20, brightness=10, contrast=20)
+
+
+def save(filename):
+    images.from_file(filename).to_bytes(quality=85)
+
+
+def chain(filename):
+    image = images.from_file(filename)
+    image.resize(width=1200, method='fit')
+    image.crop(800, 600)
+    image.flip('horizontal')
+    image.to_bytes(quality=85)
+
+
+def chain_deferred(filename):
+    image = images.from_file(filename, deferred=True)
+    image.resize(width=1200, method='fit')
+    image.crop(800, 600)
+    image.flip('horizontal')
+    image.to_bytes(quality=85)
+
+
+def renditions(filename):
+    images.from_file(filename).renditions([
+        (1600, 1600, 'fit'), (800, 800, 'fit'), (400, 400, 'fit'), (200, 200, 'fit'),
+    ])
+
+
+def perceptual_hash(filename):
+    images.from_file(filename).get_hash()
+
+
+def placeholders(filename):
+    images.from_file(filename).get_placeholders()
+
+
+OPERATIONS = (open_image, decode, resize_half, resize_fastest, resize_balanced,
+              resize_best, thumbnail, crop, adjust, save, chain, chain_deferred,
+              renditions, perceptual_hash, placeholders)
+
+# Modes operations support, as the fixture is opened (grayscale GIFs open
+# as palette images). Other operations support every mode
+OPERATION_MODES = {
+    # ImageEnhance doesn't adjust palette images
+    'adjust': ('RGB', 'RGBA', 'L'),
+}
+
+
+def get_peak_rss():
+    """Returns peak resident set size in bytes."""
+    # Unlike ru_maxrss, VmHWM isn't inherited from the parent process
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_case(operation_name, filename, repeat, queue):
+    operation = globals()[operation_name]
+    rss = get_peak_rss()
+    timings = []
+    try:
+        for i in range(repeat):
+            start = time.perf_counter()
+            operation(filename)
+            timings.append(time.perf_counter() - start)
+    except Exception as error:
+        queue.put((None, repr(error)))
+        return
+    queue.put((timings, get_peak_rss() - rss))
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(int(round(percent / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def measure(context, operation, filename, repeat, timeout=None):
+    """Runs a case in a new process. Returns its timings and peak RSS, or
+    None and the reason it failed."""
+    queue = context.Queue()
+    process = context.Process(target=run_case,
+                              args=(operation.__name__, filename, repeat, queue))
+    process.start()
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    try:
+        while True:
+            exitcode = process.exitcode
+            try:
+                # Polls, so a crashed process isn't waited for forever
+                return queue.get(timeout=1)
+            except queue_module.Empty:
+                pass
+            if exitcode is not None:
+                # Exited before putting its result, e.g. killed when out of memory
+                return None, 'exited with code %d' % exitcode
+            if deadline is not None and time.monotonic() > deadline:
+                process.terminate()
+                return None, 'timed out after %ss' % timeout
+    finally:
+        process.join()
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        for key in ('p50', 'peak_rss'):
+            # Ignore noise on very fast cases and tiny allocations
+            floor = 0.001 if key == 'p50' else 1024 * 1024
+            if result[key] > max(expected[key], floor) * (1 + tolerance):
+                regressions.append('%s %s: %s -> %s' % (name, key, expected[key], result[key]))
+    return regressions
+
+
+def parse_list(value, cast=str):
+    return tuple(cast(item) for item in value.split(',') if item)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks da_vinci Image operations')
+    parser.add_argument('--sizes', type=lambda value: parse_list(value, float),
+                        default=SIZES, help='Megapixels, comma separated')
+    parser.add_argument('--modes', type=parse_list, default=MODES)
+    parser.add_argument('--formats', type=parse_list, default=FORMATS)
+    parser.add_argument('--filter', default='', help='Only run cases containing this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed relative slowdown or memory growth')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='Seconds a case may run for, all repeats included')
+    args = parser.parse_args(args)
+
+    context = multiprocessing.get_context('spawn')
+    directory = tempfile.mkdtemp(prefix='da-vinci-bench-')
+    results = {}
+    failures = []
+    try:
+        fixtures = generate_fixtures(directory, args.sizes, args.modes, args.formats)
+        print('%-40s %9s %9s %9s %9s %10s' % ('case', 'p50 ms', 'p90 ms', 'p99 ms',
+                                              'MP/s', 'peak MB'))
+        for megapixels, mode, format, filename in fixtures:
+            with PILImage.open(filename) as pil_image:
+                opened_mode = pil_image.mode
+            for operation in OPERATIONS:
+                name = '%s/%s/%gmp/%s' % (format, mode, megapixels, operation.__name__)
+                if args.filter not in name or \
+                        opened_mode not in OPERATION_MODES.get(operation.__name__, (opened_mode,)):
+                    continue
+                timings, peak_rss = measure(context, operation, filename, args.repeat,
+                                            args.timeout)
+                if timings is None:
+                    print('%-40s failed: %s' % (name, peak_rss))
+                    failures.append(name)
+                    continue
+                result = {
+                    'p50': percentile(timings, 50),
+                    'p90': percentile(timings, 90),
+                    'p99': percentile(timings, 99),
+                    'peak_rss': peak_rss,
+                }
+                result['throughput'] = megapixels / result['p50'] if result['p50'] else 0
+                results[name] = result
+                print('%-40s %9.2f %9.2f %9.2f %9.1f %10.1f' % (
+                    name, result['p50'] * 1000, result['p90'] * 1000,
+                    result['p99'] * 1000, result['throughput'], peak_rss / 1024 / 1024))
+    finally:
+        shutil.rmtree(directory)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        baseline.update(results)
+        with open(args.baseline, 'w') as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+        print('Baseline saved to %s' % args.baseline)
+        return 1 if failures else 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at %s, run with --save-baseline to create one' % args.baseline)
+        return 1 if failures else 0
+    with open(args.baseline) as file:
+        regressions = compare(results, json.load(file), args.tolerance)
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return 1 if regressions or failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,262 @@
+"""
+asyncio interface. Opening, fetching, decoding and encoding run on a
+thread pool so they don't block the event loop:
+
+    from da_vinci.aio import AsyncImage
+
+    image = await AsyncImage.open('photo.jpg')
+    image.resize(width=300, method='fit')  # Recorded, doesn't block
+    await image.save_async(filename='thumbnail.jpg')
+
+Work is submitted through a Runner, which limits how many images are
+processed at once. Extra work waits for a free slot, or is rejected with
+RunnerBusy if more than "max_queued" coroutines are already waiting. A
+runner can be shared by several event loops, e.g. one per thread.
+"""
+import asyncio
+import collections
+import os
+import threading
+from concurrent import futures
+
+from . import images
+from .utils import BufferReader
+
+
+class RunnerBusy(Exception):
+    pass
+
+
+class Runner(object):
+
+    def __init__(self, executor=None, max_concurrency=None, max_queued=None):
+        """
+        - executor: a concurrent.futures.Executor, defaults to a thread pool
+          with "max_concurrency" threads
+        - max_concurrency: number of images processed at once, defaults to
+          the number of CPUs
+        - max_queued: number of coroutines allowed to wait for a slot,
+          unlimited by default
+        """
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self.max_queued = max_queued
+        self.executor = executor or futures.ThreadPoolExecutor(
+            max_workers=self.max_concurrency)
+        self.running = 0
+        # (loop, future) of coroutines waiting for a slot, in arrival order.
+        # Slots are released from worker threads and may be handed over to
+        # another event loop, so they're counted under a lock rather than
+        # with an asyncio.Semaphore, which belongs to a single loop
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    async def _acquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if not self._waiters and self.running < self.max_concurrency:
+                self.running += 1
+                return
+            if self.max_queued is not None and len(self._waiters) >= self.max_queued:
+                raise RunnerBusy('%d images are already waiting to be processed'
+                                 % len(self._waiters))
+            waiter = loop.create_future()
+            self._waiters.append((loop, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove((loop, waiter))
+                    handed_over = False
+                except ValueError:
+                    handed_over = True
+            # A slot handed over to a cancelled waiter is passed on by
+            # _wake(), unless the waiter got it before being cancelled
+            if handed_over and waiter.done() and not waiter.cancelled():
+                self._release()
+            raise
+
+    def _wake(self, waiter):
+        if waiter.cancelled():
+            self._release()
+        else:
+            waiter.set_result(None)
+
+    def _release(self):
+        with self._lock:
+            if not self._waiters:
+                self.running -= 1
+                return
+            # The slot goes to the next waiter directly
+            loop, waiter = self._waiters.popleft()
+        try:
+            loop.call_soon_threadsafe(self._wake, waiter)
+        except RuntimeError:
+            # The waiter's event loop is closed
+            self._release()
+
+    async def run(self, function, *args, **kwargs):
+        """Runs function(*args, **kwargs) on the executor once a slot is free.
+        The slot is held until the function returns, even if the coroutine
+        is cancelled in the meantime."""
+        await self._acquire()
+        try:
+            future = self.executor.submit(function, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda future: self._release())
+        return await asyncio.wrap_future(future, loop=asyncio.get_running_loop())
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+_default_runner = None
+
+
+def get_default_runner():
+    global _default_runner
+    if _default_runner is None:
+        _default_runner = Runner()
+    return _default_runner
+
+
+class AsyncImage(object):
+    """Wraps a deferred Image. Operations are only recorded, so they're
+    called directly, work happens in the *_async methods."""
+
+    def __init__(self, image, runner=None):
+        image.deferred = True
+        self.image = image
+        self.runner = runner or get_default_runner()
+
+    @classmethod
+    async def open(cls, path_or_file, runner=None, **kwargs):
+        """Opens an image from a filename, file object or URL."""
+        runner = runner or get_default_runner()
+        kwargs['deferred'] = True
+        image = await runner.run(images.Image, path_or_file, **kwargs)
+        return cls(image, runner=runner)
+
+    @classmethod
+    async def from_url(cls, url, runner=None, **kwargs):
+        return await cls.open(url, runner=runner, **kwargs)
+
+    @property
+    def width(self):
+        return self.image.width
+
+    @property
+    def height(self):
+        return self.image.height
+
+    @property
+    def aspect_ratio(self):
+        return self.image.aspect_ratio
+
+    @property
+    def info(self):
+        return self.image.info
+
+    @property
+    def mode(self):
+        return self.image.mode
+
+    @property
+    def format(self):
+        return self.image.format
+
+    @property
+    def quality(self):
+        return self.image.quality
+
+    def set(self, *args, **kwargs):
+        self.image.set(*args, **kwargs)
+
+    def flip(self, *args, **kwargs):
+        self.image.flip(*args, **kwargs)
+
+    def rotate(self, *args, **kwargs):
+        self.image.rotate(*args, **kwargs)
+
+    def resize(self, width=None, height=None, method='stretch', resample=None,
+               center=None):
+        if center == 'auto':
+            raise ValueError('center="auto" decodes the image, use resize_async()')
+        self.image.resize(width, height, method, resample, center)
+
+    async def resize_async(self, *args, **kwargs):
+        """See Image.resize(), with center="auto" the image is decoded on the
+        executor to find the center."""
+        await self.runner.run(self.image.resize, *args, **kwargs)
+
+    def crop(self, width, height, center=('50%', '50%'), shape='rectangle'):
+        if center == 'auto':
+            raise ValueError('center="auto" decodes the image, use crop_async()')
+        self.image.crop(width, height, center, shape)
+
+    async def crop_async(self, *args, **kwargs):
+        """See Image.crop(), with center="auto" the image is decoded on the
+        executor to find the center."""
+        await self.runner.run(self.image.crop, *args, **kwargs)
+
+    def adjust(self, *args, **kwargs):
+        self.image.adjust(*args, **kwargs)
+
+    async def to_profile_async(self, *args, **kwargs):
+        """See Image.to_profile(), profiles given as a filename are read on
+        the executor."""
+        await self.runner.run(self.image.to_profile, *args, **kwargs)
+
+    async def save_async(self, *args, **kwargs):
+        """Applies recorded operations and saves the image, see Image.save()."""
+        return await self.runner.run(self.image.save, *args, **kwargs)
+
+    async def to_bytes_async(self, *args, **kwargs):
+        """Applies recorded operations and returns the encoded image, see
+        Image.to_bytes()."""
+        return await self.runner.run(self.image.to_bytes, *args, **kwargs)
+
+    async def renditions_async(self, specs):
+        """See Image.renditions(), returns Images."""
+        return await self.runner.run(self.image.renditions, specs)
+
+    async def get_pil_image_async(self):
+        return await self.runner.run(self.image.get_pil_image)
+
+    async def get_hash_async(self, *args, **kwargs):
+        """See Image.get_hash()."""
+        return await self.runner.run(self.image.get_hash, *args, **kwargs)
+
+    async def get_blurhash_async(self, *args, **kwargs):
+        """See Image.get_blurhash()."""
+        return await self.runner.run(self.image.get_blurhash, *args, **kwargs)
+
+    async def get_lqip_async(self, *args, **kwargs):
+        """See Image.get_lqip()."""
+        return await self.runner.run(self.image.get_lqip, *args, **kwargs)
+
+    async def get_color_async(self, *args, **kwargs):
+        """See Image.get_color()."""
+        return await self.runner.run(self.image.get_color, *args, **kwargs)
+
+    async def get_placeholders_async(self, *args, **kwargs):
+        """See Image.get_placeholders()."""
+        return await self.runner.run(self.image.get_placeholders, *args, **kwargs)
+
+
+async def from_file(path_or_file, **kwargs):
+    return await AsyncImage.open(path_or_file, **kwargs)
+
+
+async def from_bytes(buffer, **kwargs):
+    return await AsyncImage.open(BufferReader(buffer), **kwargs)
+
+
+async def from_url(url, **kwargs):
+    return await AsyncImage.from_url(url, **kwargs)
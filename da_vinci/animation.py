@@ -0,0 +1,100 @@
+"""
+Animated GIF and WebP images. Operations recorded on an animated image are
+applied to every frame when it's saved as GIF or WebP:
+
+    image = Image('sticker.gif')
+    image.resize(width=128, method='fit')
+    image.save(filename='sticker.webp')
+
+Frames are decoded, transformed and handed to the encoder one at a time,
+so only a couple of frames are held in memory. Pillow's GIF encoder keeps
+every encoded frame to compare consecutive ones, WebP's doesn't. Frame
+durations, loop count and disposal are preserved.
+"""
+from PIL import Image as PILImage
+
+from . import pipeline
+
+
+# Formats that animations are saved as, in other formats only the first
+# frame is saved
+FORMATS = ('GIF', 'WEBP')
+
+# Steps that resample or blend pixels, which palette images can't do well
+RESAMPLING_STEPS = ('resize', 'rotate', 'adjust', 'profile')
+
+
+def is_animated(pil_image):
+    return getattr(pil_image, 'is_animated', False)
+
+
+class FrameSequence(PILImage.Image):
+    """Frames of an animated image, transformed by planned steps as they're
+    seeked to. Pillow's encoders iterate it like an animated image."""
+
+    def __init__(self, source, steps):
+        super(FrameSequence, self).__init__()
+        self.source = source
+        self.steps = steps
+        self.n_frames = source.n_frames
+        self.is_animated = self.n_frames > 1
+        self._frame = None
+        self.seek(0)
+
+    def seek(self, frame):
+        if frame == self._frame:
+            return
+        # Raises EOFError past the last frame, which ends iteration
+        self.source.seek(frame)
+        pil_image = self.source
+        if pil_image.mode in ('1', 'P') and any(
+                step[0] in RESAMPLING_STEPS for step in self.steps):
+            pil_image = pil_image.convert(
+                'RGBA' if pil_image.has_transparency_data else 'RGB')
+        pil_image = pipeline.run(pil_image, self.steps)
+        if pil_image is self.source:
+            # The source's pixels change on the next seek
+            pil_image = pil_image.copy()
+
+        # Same as PIL's image._new(). Pillow's encoders iterate the image
+        # they save, so the frame becomes this image's content. Relies on
+        # Pillow >= 10.1, where mode and size became read-only properties
+        # backed by _mode and _size (see the README and PillowTest)
+        self.im = pil_image.im
+        self._mode = pil_image.mode
+        self._size = pil_image.size
+        self.palette = pil_image.palette.copy() if pil_image.palette else None
+        self.info = pil_image.info.copy()
+        disposal = getattr(self.source, 'disposal_method', None)
+        if disposal is not None:
+            self.info['disposal'] = disposal
+        self._frame = frame
+
+    def tell(self):
+        return self._frame
+
+
+def get_durations(pil_image):
+    """Returns the duration of every frame, in milliseconds."""
+    durations = []
+    for frame in range(pil_image.n_frames):
+        pil_image.seek(frame)
+        # Some formats only read the duration when decoding
+        pil_image.load()
+        durations.append(pil_image.info.get('duration', 0))
+    pil_image.seek(0)
+    return durations
+
+
+def save(pil_image, steps, fp, format, **kwargs):
+    """Saves every frame of an animated image, transformed by planned steps."""
+    if format == 'WEBP':
+        # The WebP encoder doesn't read durations from frames
+        kwargs.setdefault('duration', get_durations(pil_image))
+        # GIFs without a loop count play once
+        kwargs.setdefault('loop', pil_image.info.get('loop', 1))
+    frames = FrameSequence(pil_image, steps)
+    try:
+        frames.save(fp, format=format, save_all=True, **kwargs)
+    finally:
+        pil_image.seek(0)
@@ -0,0 +1,193 @@
+"""
+Processes many images in parallel, following a recipe of Image method
+calls:
+
+    from da_vinci import batch
+
+    recipe = [
+        ('resize', {'width': 300, 'method': 'fit'}),
+        ('set', {'format': 'webp', 'quality': 80}),
+        ('save', {'filename': 'thumbnails/{stem}.{extension}'}),
+    ]
+    for result in batch.process(['a.jpg', 'b.png'], recipe, workers=4):
+        if result.error is not None:
+            print('Failed to process %s: %s' % (result.source, result.error))
+
+The "save" filename is a template, filled in with the image's "name",
+"stem" (name without extension), "dirname", "extension" and "index" (the
+position of the source). A recipe without a "save" step returns the
+encoded image bytes instead of the filename. Files are written
+atomically, a file that exists is complete.
+
+Images are processed by a process pool by default. A thread pool also
+scales well since Pillow releases the GIL while decoding, resampling and
+encoding, and avoids sending results across processes.
+"""
+import collections
+import functools
+import os
+from concurrent import futures
+
+from . import formats, images
+from .utils import make_temporary_file
+
+
+RECIPE_METHODS = ('flip', 'rotate', 'resize', 'crop', 'adjust', 'set', 'save')
+
+Result = collections.namedtuple('Result', ['index', 'source', 'value', 'error'])
+
+
+def validate_recipe(recipe):
+    recipe = [(method, dict(kwargs or {})) for method, kwargs in recipe]
+    for method, kwargs in recipe:
+        if method not in RECIPE_METHODS:
+            raise ValueError('Recipe method must be one of %s, not "%s"'
+                             % (', '.join(RECIPE_METHODS), method))
+    if any(method == 'save' for method, kwargs in recipe[:-1]):
+        raise ValueError('"save" must be the last step of a recipe')
+    return recipe
+
+
+def get_template_context(image, index):
+    name = image.name or ''
+    return {
+        'name': name,
+        'stem': os.path.splitext(name)[0],
+        'dirname': os.path.dirname(image.filename or ''),
+        'extension': formats.EXTENSIONS[image.format],
+        'index': index,
+    }
+
+
+def save_atomically(image, filename, **kwargs):
+    """Saves the image to a temporary file next to `filename`, then renames
+    it, so readers never see a partially written file. Like save(), the
+    extension follows the format the image is saved as."""
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created concurrently
+            if not os.path.isdir(directory):
+                raise
+    descriptor, temporary_path = make_temporary_file(directory or '.')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            image.save(file=file, **kwargs)
+        image.filename = filename
+        filename = image.get_filename()
+        os.replace(temporary_path, filename)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+    image.filename = filename
+    return filename
+
+
+def apply_recipe(source, recipe, index=0, deferred=True):
+    """Opens an image from a filename, URL or file object and applies the
+    recipe. Returns the saved filename, or the encoded image if the recipe
+    doesn't save it."""
+    image = images.Image(source, deferred=deferred)
+    for method, kwargs in recipe:
+        if method == 'save':
+            kwargs = dict(kwargs)
+            if kwargs.get('filename'):
+                filename = kwargs.pop('filename').format(
+                    **get_template_context(image, index))
+                save_atomically(image, filename, **kwargs)
+                return image.filename
+            image.save(**kwargs)
+            return None if kwargs.get('file') else image.filename
+        getattr(image, method)(**kwargs)
+    return image.to_bytes()
+
+
+def get_executor(executor, workers):
+    if executor == 'process':
+        return futures.ProcessPoolExecutor(max_workers=workers)
+    if executor == 'thread':
+        return futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+    raise ValueError('Executor must be "process", "thread" or an Executor instance')
+
+
+def process(sources, recipe, executor='process', workers=None,
+            max_in_flight=None, ordered=False, deferred=True):
+    """
+    Applies the recipe to every source, yielding a Result for each one as
+    it completes. A source that fails yields a Result with the exception as
+    "error" instead of stopping the batch.
+
+    - executor: "process", "thread" or a concurrent.futures.Executor, which
+      is left running
+    - workers: number of workers, defaults to the number of CPUs
+    - max_in_flight: number of sources submitted but not yielded yet,
+      defaults to twice the number of workers. Sources are consumed lazily,
+      so this also bounds memory
+    - ordered: yield results in the order of sources rather than as they
+      complete
+    """
+    recipe = validate_recipe(recipe)
+    function = functools.partial(apply_recipe, recipe=recipe, deferred=deferred)
+    return run(function, sources, executor=executor, workers=workers,
+               max_in_flight=max_in_flight, ordered=ordered)
+
+
+def run(function, sources, executor='process', workers=None,
+        max_in_flight=None, ordered=False):
+    """Calls function(source, index=index) for every source, see process().
+    With a process pool, the function must be picklable, e.g. a module
+    level function or a functools.partial of one."""
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = workers * 2
+
+    if isinstance(executor, futures.Executor):
+        pool = executor
+        owns_pool = False
+    else:
+        pool = get_executor(executor, workers)
+        owns_pool = True
+
+    sources = iter(enumerate(sources))
+    pending = {}
+    completed = {}
+    next_index = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) + len(completed) < max_in_flight:
+                try:
+                    index, source = next(sources)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = pool.submit(function, source, index=index)
+                pending[future] = (index, source)
+
+            if not pending and not completed:
+                return
+
+            if pending:
+                done, not_done = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    index, source = pending.pop(future)
+                    error = future.exception()
+                    value = None if error is not None else future.result()
+                    completed[index] = Result(index, source, value, error)
+
+            if ordered:
+                while next_index in completed:
+                    yield completed.pop(next_index)
+                    next_index += 1
+            else:
+                for index in sorted(completed):
+                    yield completed.pop(index)
+    finally:
+        for future in pending:
+            future.cancel()
+        if owns_pool:
+            pool.shutdown(wait=True)
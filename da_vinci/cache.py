@@ -0,0 +1,204 @@
+"""
+Caches for encoded images (derivatives), keyed by a hash of the source
+image bytes and the operations applied to it:
+
+    from da_vinci import cache
+
+    derivatives = cache.TieredCache(
+        cache.MemoryCache(max_bytes=64 * 1024 * 1024),
+        cache.FileCache('/var/cache/images', max_bytes=10 * 1024 * 1024 * 1024),
+    )
+    image.resize(width=300)
+    image.save(filename='thumbnail.jpg', cache=derivatives)
+
+When a derivative is cached, save() writes it out without decoding or
+encoding the image. Least recently used entries are evicted when the total
+size of cached derivatives exceeds max_bytes.
+"""
+import collections
+import hashlib
+import json
+import os
+import threading
+
+from .utils import make_temporary_file
+
+
+def get_key(source_digest, description):
+    """Returns a cache key from the source digest and a JSON serializable
+    description of the operations applied to it."""
+    description = json.dumps(description, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(
+        ('%s:%s' % (source_digest, description)).encode('utf-8')).hexdigest()
+
+
+def get_digest(file, chunk_size=1024 * 1024):
+    """Returns the SHA-256 hex digest of a file object's content. The file
+    position is left untouched."""
+    position = file.tell()
+    file.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        digest.update(chunk)
+    file.seek(position)
+    return digest.hexdigest()
+
+
+class MemoryCache(object):
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def set(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                key, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._entries), 'bytes': self.size}
+
+
+class FileCache(object):
+    """Stores derivatives as files in a directory. Entries left by previous
+    runs are picked up, least recently used first."""
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        existing = []
+        for key in os.listdir(directory):
+            path = os.path.join(directory, key)
+            if key.startswith('.') or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            existing.append((stat.st_mtime, key, stat.st_size))
+        for mtime, key, size in sorted(existing):
+            self._entries[key] = size
+            self.size += size
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+        return data
+
+    def set(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        # Written to a temporary file first so readers never see a partial file
+        descriptor, temporary_path = make_temporary_file(self.directory)
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(data)
+        os.replace(temporary_path, self._get_path(key))
+
+        with self._lock:
+            self.size -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self.size += len(data)
+            evicted = []
+            while self.size > self.max_bytes:
+                evicted_key, size = self._entries.popitem(last=False)
+                self.size -= size
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            try:
+                os.remove(self._get_path(evicted_key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._entries)
+            self._entries.clear()
+            self.size = 0
+        for key in keys:
+            try:
+                os.remove(self._get_path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._entries), 'bytes': self.size}
+
+
+class TieredCache(object):
+    """Looks derivatives up in each cache in turn (e.g. memory, then disk),
+    copying hits into the faster caches before it."""
+
+    def __init__(self, *caches):
+        self.caches = caches
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        for index, cache in enumerate(self.caches):
+            data = cache.get(key)
+            if data is not None:
+                for faster_cache in self.caches[:index]:
+                    faster_cache.set(key, data)
+                self.hits += 1
+                return data
+        self.misses += 1
+        return None
+
+    def set(self, key, data):
+        for cache in self.caches:
+            cache.set(key, data)
+
+    def clear(self):
+        for cache in self.caches:
+            cache.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'caches': [cache.stats() for cache in self.caches]}
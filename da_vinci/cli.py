@@ -0,0 +1,282 @@
+"""
+Applies a recipe to every image of a directory tree:
+
+    da-vinci photos/ thumbnails/ --resize 300x300 --method fit --format webp --quality 80
+    python -m da_vinci photos/ crops/ --crop 800x600 --adjust saturation=-20,contrast=10
+
+The output tree mirrors the source tree, with extensions following the
+output format. Images are processed on a process pool, one worker per CPU
+by default, and written atomically.
+
+Processing is incremental: a manifest in the output directory records the
+size, mtime and SHA-256 digest of every source along with a digest of the
+recipe. Sources whose size and mtime haven't changed since they were
+processed with the same recipe are skipped without being read. Sources
+whose mtime changed are hashed, and skipped if their content didn't. The
+manifest is appended to as images complete, so an interrupted run resumes
+where it stopped.
+"""
+from __future__ import print_function
+
+import argparse
+import functools
+import hashlib
+import json
+import os
+import sys
+
+from . import batch, cache, formats, images
+from .utils import make_temporary_file
+
+
+MANIFEST_NAME = '.da-vinci-manifest.jsonl'
+MANIFEST_VERSION = 1
+
+# Source files recognized by their extension
+EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.tif', '.tiff', '.bmp')
+
+
+def parse_size(value):
+    """Parses "300x200", "300x" or "x200" into (width, height), dimensions
+    may be percentages like "50%"."""
+    width, separator, height = value.partition('x')
+    if not separator:
+        raise argparse.ArgumentTypeError('Expected WIDTHxHEIGHT, not "%s"' % value)
+    dimensions = []
+    for dimension in (width, height):
+        if not dimension:
+            dimensions.append(None)
+        elif dimension.isdigit():
+            dimensions.append(int(dimension))
+        elif dimension.endswith('%') and dimension[:-1].isdigit():
+            dimensions.append(dimension)
+        else:
+            raise argparse.ArgumentTypeError('Invalid dimension "%s"' % dimension)
+    if dimensions == [None, None]:
+        raise argparse.ArgumentTypeError('Width or height is required')
+    return tuple(dimensions)
+
+
+def parse_adjustments(value):
+    """Parses "saturation=-20,contrast=10" into keyword arguments of
+    Image.adjust()."""
+    adjustments = {}
+    for item in value.split(','):
+        name, separator, amount = item.partition('=')
+        if name not in ('sharpness', 'brightness', 'saturation', 'contrast'):
+            raise argparse.ArgumentTypeError('Unknown adjustment "%s"' % name)
+        try:
+            adjustments[name] = int(amount)
+        except ValueError:
+            raise argparse.ArgumentTypeError('Invalid %s "%s"' % (name, amount))
+    return adjustments
+
+
+def get_recipe(args):
+    """Returns the recipe of Image method calls described by command line
+    arguments, without saving."""
+    recipe = []
+    if args.resize:
+        recipe.append(('resize', {'width': args.resize[0], 'height': args.resize[1],
+                                  'method': args.method, 'resample': args.resample}))
+    if args.crop:
+        recipe.append(('crop', {'width': args.crop[0], 'height': args.crop[1]}))
+    if args.adjust:
+        recipe.append(('adjust', args.adjust))
+    if args.format or args.quality or args.preset:
+        recipe.append(('set', {'format': args.format, 'quality': args.quality,
+                               'preset': args.preset}))
+    return batch.validate_recipe(recipe)
+
+
+def get_recipe_digest(recipe):
+    description = json.dumps(recipe, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+def find_sources(directory, exclude=None):
+    """Yields paths of images in a directory tree relative to it, with "/"
+    separators, skipping hidden files and directories."""
+    exclude = os.path.abspath(exclude) if exclude else None
+    for root, directories, filenames in os.walk(directory):
+        directories[:] = sorted(
+            name for name in directories if not name.startswith('.') and
+            os.path.abspath(os.path.join(root, name)) != exclude)
+        relative_root = os.path.relpath(root, directory)
+        for filename in sorted(filenames):
+            if filename.startswith('.') or \
+                    os.path.splitext(filename)[1].lower() not in EXTENSIONS:
+                continue
+            path = filename if relative_root == '.' else os.path.join(relative_root, filename)
+            yield path.replace(os.sep, '/')
+
+
+class Manifest(object):
+    """Entries of processed sources keyed by their relative path, stored as
+    JSON lines. Updates are appended, later lines win when loading."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._file = None
+        try:
+            with open(path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line of an interrupted run
+                        continue
+                    if entry.get('version') == MANIFEST_VERSION:
+                        self.entries[entry['path']] = entry
+        except (IOError, OSError):
+            pass
+
+    def is_current(self, entry, stat, recipe_digest, output_directory):
+        """Whether the source's output is up to date, judging by size and
+        mtime only."""
+        return (entry is not None and entry['recipe'] == recipe_digest and
+                entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns and
+                os.path.exists(os.path.join(output_directory, entry['output'])))
+
+    def add(self, entry):
+        self.entries[entry['path']] = entry
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps(entry, sort_keys=True) + '\n')
+        self._file.flush()
+
+    def compact(self, paths=None):
+        """Rewrites the manifest with one line per entry, only keeping
+        `paths` if given."""
+        self.close()
+        if paths is not None:
+            self.entries = dict((path, self.entries[path])
+                                for path in paths if path in self.entries)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temporary_path = make_temporary_file(directory)
+        with os.fdopen(descriptor, 'w') as file:
+            for path in sorted(self.entries):
+                file.write(json.dumps(self.entries[path], sort_keys=True) + '\n')
+        os.replace(temporary_path, self.path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def render(task, source_directory, output_directory, recipe, recipe_digest,
+           deferred=True, index=0):
+    """Applies the recipe to a source given as (relative path, manifest
+    entry or None). Returns the source's new manifest entry and whether it
+    was rendered, which it isn't if its content matches the entry's."""
+    path, entry = task
+    source = os.path.join(source_directory, *path.split('/'))
+    stat = os.stat(source)
+    with open(source, 'rb') as file:
+        digest = cache.get_digest(file)
+    if (entry is not None and entry['digest'] == digest and entry['recipe'] == recipe_digest and
+            os.path.exists(os.path.join(output_directory, entry['output']))):
+        entry = dict(entry, size=stat.st_size, mtime=stat.st_mtime_ns)
+        return entry, False
+
+    image = images.Image(source, deferred=deferred)
+    for method, kwargs in recipe:
+        getattr(image, method)(**kwargs)
+    stem = os.path.splitext(path)[0]
+    filename = os.path.join(output_directory, *stem.split('/')) + \
+        '.' + formats.EXTENSIONS[image.format]
+    filename = batch.save_atomically(image, filename)
+    output = os.path.relpath(filename, output_directory).replace(os.sep, '/')
+    entry = {
+        'version': MANIFEST_VERSION,
+        'path': path,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'digest': digest,
+        'recipe': recipe_digest,
+        'output': output,
+    }
+    return entry, True
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='da-vinci',
+        description='Applies a recipe to every image of a directory tree. Re-runs '
+                    'only process new or changed images.')
+    parser.add_argument('source', help='Directory of source images')
+    parser.add_argument('output', help='Directory to write images to')
+    parser.add_argument('--resize', type=parse_size, metavar='WIDTHxHEIGHT',
+                        help='e.g. 300x200, 300x or 50%%x50%%')
+    parser.add_argument('--method', choices=('stretch', 'fit', 'fill'), default='fit',
+                        help='Resize method (default: fit)')
+    parser.add_argument('--resample', choices=('fastest', 'balanced', 'best'))
+    parser.add_argument('--crop', type=parse_size, metavar='WIDTHxHEIGHT',
+                        help='Centered crop, after resizing')
+    parser.add_argument('--adjust', type=parse_adjustments, metavar='NAME=AMOUNT,...',
+                        help='sharpness, brightness, saturation or contrast, '
+                             'from -100 to 100')
+    parser.add_argument('--format', choices=sorted(formats.MAPPING),
+                        help='Output format (default: the source format)')
+    parser.add_argument('--quality', type=int)
+    parser.add_argument('--preset', choices=sorted(formats.PRESETS))
+    parser.add_argument('--workers', type=int, help='Default: number of CPUs')
+    parser.add_argument('--executor', choices=('process', 'thread'), default='process')
+    parser.add_argument('--manifest', help='Default: %s in the output directory'
+                        % MANIFEST_NAME)
+    parser.add_argument('--force', action='store_true',
+                        help='Process every image, even unchanged ones')
+    parser.add_argument('--quiet', '-q', action='store_true')
+    return parser
+
+
+def main(args=None):
+    args = get_parser().parse_args(args)
+    recipe = get_recipe(args)
+    recipe_digest = get_recipe_digest(recipe)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    manifest = Manifest(args.manifest or os.path.join(args.output, MANIFEST_NAME))
+
+    paths = []
+    skipped = [0]
+
+    def get_tasks():
+        for path in find_sources(args.source, exclude=args.output):
+            paths.append(path)
+            entry = None if args.force else manifest.entries.get(path)
+            stat = os.stat(os.path.join(args.source, *path.split('/')))
+            if manifest.is_current(entry, stat, recipe_digest, args.output):
+                skipped[0] += 1
+                continue
+            yield (path, entry)
+
+    function = functools.partial(
+        render, source_directory=args.source, output_directory=args.output,
+        recipe=recipe, recipe_digest=recipe_digest)
+    rendered = failed = 0
+    try:
+        for result in batch.run(function, get_tasks(), executor=args.executor,
+                                workers=args.workers):
+            if result.error is not None:
+                failed += 1
+                print('%s: %s' % (result.source[0], result.error), file=sys.stderr)
+                continue
+            entry, is_rendered = result.value
+            manifest.add(entry)
+            if is_rendered:
+                rendered += 1
+                if not args.quiet:
+                    print('%s -> %s' % (entry['path'], entry['output']))
+            else:
+                skipped[0] += 1
+    finally:
+        manifest.close()
+    # Entries of deleted sources are dropped
+    manifest.compact(paths)
+
+    if not args.quiet:
+        print('%d processed, %d unchanged, %d failed' % (rendered, skipped[0], failed))
+    return 1 if failed else 0
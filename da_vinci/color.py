@@ -0,0 +1,180 @@
+"""
+Color management with ICC profiles. Wide gamut images (Adobe RGB, Display
+P3...) look washed out wherever their profile is ignored, converting them
+to sRGB fixes that:
+
+    image = Image('photo.jpg', color_profile='srgb')  # When loading
+    image.to_profile('srgb')                           # Or as an operation
+    image.to_profile('/usr/share/color/icc/DisplayP3.icc', intent='relative')
+
+Images without a profile are assumed to be sRGB. Images converted to sRGB
+are saved without a profile, which is how untagged images are displayed,
+images converted to another profile embed it. Otherwise the embedded
+profile is kept when saving.
+
+Building a transform takes milliseconds, so built transforms are cached
+process-wide, keyed by the source profile's digest, the target profile,
+modes and rendering intent. Images whose profile already is sRGB skip all
+color work.
+"""
+import collections
+import hashlib
+import io
+import os
+import threading
+
+from PIL import ImageCms
+
+
+SRGB = 'sRGB'
+
+INTENTS = {
+    'perceptual': ImageCms.Intent.PERCEPTUAL,
+    'relative': ImageCms.Intent.RELATIVE_COLORIMETRIC,
+    'saturation': ImageCms.Intent.SATURATION,
+    'absolute': ImageCms.Intent.ABSOLUTE_COLORIMETRIC,
+}
+
+# Formats that can embed an ICC profile
+ICC_FORMATS = ('JPEG', 'PNG', 'WEBP', 'TIFF')
+
+MAX_TRANSFORMS = 64
+
+# Image modes transforms are built for, per color space of the target
+OUTPUT_MODES = {
+    'RGB': {'RGB': 'RGB', 'RGBA': 'RGBA', 'CMYK': 'RGB', 'L': 'RGB'},
+    'GRAY': {'RGB': 'L', 'CMYK': 'L', 'L': 'L'},
+    'CMYK': {'RGB': 'CMYK', 'CMYK': 'CMYK', 'L': 'CMYK'},
+}
+
+# sRGB is created on first use, Pillow may be built without littlecms
+_profiles = {}
+_srgb_profiles = {}
+_transforms = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def get_digest(icc_profile):
+    return hashlib.sha256(icc_profile).hexdigest()
+
+
+def _open_profile(icc_profile):
+    return ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+
+
+def get_color_space(profile):
+    return profile.profile.xcolor_space.strip()
+
+
+def get_profile_key(profile):
+    """Returns the key of a target profile: "sRGB", or the digest of a
+    profile given as bytes, a filename or an ImageCmsProfile. The profile is
+    registered, so operations only record its key."""
+    if isinstance(profile, ImageCms.ImageCmsProfile):
+        icc_profile = profile.tobytes()
+    elif isinstance(profile, bytes):
+        icc_profile = profile
+    elif profile.lower() == SRGB.lower():
+        return SRGB
+    elif os.path.exists(profile):
+        with open(profile, 'rb') as file:
+            icc_profile = file.read()
+    else:
+        raise ValueError('Profile must be "srgb", ICC profile bytes or the '
+                         'filename of one, not %r' % profile)
+    if is_srgb(icc_profile):
+        return SRGB
+    key = get_digest(icc_profile)
+    with _lock:
+        if key not in _profiles:
+            _profiles[key] = (icc_profile, _open_profile(icc_profile))
+    return key
+
+
+def get_profile(key):
+    """Returns a registered profile's bytes (None for sRGB) and
+    ImageCmsProfile."""
+    if key == SRGB and key not in _profiles:
+        profile = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB'))
+        with _lock:
+            _profiles.setdefault(key, (None, profile))
+    try:
+        return _profiles[key]
+    except KeyError:
+        raise ValueError('Unknown profile %s, see get_profile_key()' % key)
+
+
+def is_srgb(icc_profile):
+    """Returns whether an ICC profile is a version of sRGB, judging by its
+    description. Results are cached per profile."""
+    key = get_digest(icc_profile)
+    result = _srgb_profiles.get(key)
+    if result is None:
+        try:
+            profile = _open_profile(icc_profile)
+            description = (profile.profile.profile_description or '').lower()
+            result = get_color_space(profile) == 'RGB' and 'srgb' in description
+        except (OSError, ImageCms.PyCMSError):
+            result = False
+        with _lock:
+            _srgb_profiles[key] = result
+    return result
+
+
+def get_output_profile(icc_profile, key):
+    """Returns the profile of an image with `icc_profile` (None if it has
+    none) once converted to the profile with `key`."""
+    if key == SRGB:
+        return icc_profile if icc_profile and is_srgb(icc_profile) else None
+    return get_profile(key)[0]
+
+
+def get_transform(icc_profile, key, input_mode, output_mode, intent):
+    """Returns a transform from `icc_profile` (sRGB if None) to the profile
+    with `key`, built once per process."""
+    source_key = get_digest(icc_profile) if icc_profile else SRGB
+    cache_key = (source_key, key, input_mode, output_mode, intent)
+    with _lock:
+        transform = _transforms.get(cache_key)
+        if transform is not None:
+            _transforms.move_to_end(cache_key)
+            return transform
+
+    if icc_profile:
+        source = _open_profile(icc_profile)
+    else:
+        source = get_profile(SRGB)[1]
+    transform = ImageCms.buildTransform(source, get_profile(key)[1], input_mode,
+                                        output_mode, renderingIntent=INTENTS[intent])
+    with _lock:
+        _transforms[cache_key] = transform
+        while len(_transforms) > MAX_TRANSFORMS:
+            _transforms.popitem(last=False)
+    return transform
+
+
+def convert(pil_image, key=SRGB, intent='perceptual'):
+    """Returns the image converted to the profile with `key`. Images that
+    already are in that profile, or whose mode can't be converted (e.g.
+    palette images), are returned as is."""
+    icc_profile = pil_image.info.get('icc_profile')
+    if key == SRGB and (not icc_profile or is_srgb(icc_profile)):
+        return pil_image
+    if icc_profile and get_digest(icc_profile) == key:
+        return pil_image
+    target_bytes, target = get_profile(key)
+    output_mode = OUTPUT_MODES.get(get_color_space(target), {}).get(pil_image.mode)
+    if output_mode is None:
+        return pil_image
+    if pil_image.mode == 'L' and not icc_profile:
+        # Untagged grayscale isn't sRGB
+        return pil_image
+
+    transform = get_transform(icc_profile, key, pil_image.mode, output_mode, intent)
+    converted = ImageCms.applyTransform(pil_image, transform)
+    converted.info = dict(pil_image.info)
+    if target_bytes is None:
+        converted.info.pop('icc_profile', None)
+    else:
+        converted.info['icc_profile'] = target_bytes
+    return converted
@@ -11,13 +11,25 @@ else:
     string_types = basestring
 
 try:
-    from urlparse import urlparse
+    from urlparse import urljoin, urlparse
 except ImportError:
     # Python 3 version
-    from urllib.parse import urlparse
+    from urllib.parse import urljoin, urlparse
+
+try:
+    import httplib
+except ImportError:
+    # Python 3 version
+    import http.client as httplib
 
 try:
     from urllib import urlopen
 except ImportError:
     # Python 3 version
-    from urllib.request import urlopen
\ No newline at end of file
+    from urllib.request import urlopen
+
+try:
+    import numpy
+except ImportError:
+    # Optional, needed for image similarity
+    numpy = None
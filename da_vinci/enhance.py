@@ -0,0 +1,165 @@
+"""
+Fused image adjustments.
+
+PIL's ImageEnhance blends every enhancement with a full size "degenerate"
+image, so adjusting saturation, sharpness, brightness and contrast at once
+allocates up to 8 full size images. Instead:
+- brightness and contrast are folded into a single lookup table, applied
+  with image.point()
+- saturation is a color matrix, applied with image.convert(). If no
+  intermediate value can clip (saturation and brightness aren't
+  increased) and there's no sharpening, brightness and contrast are
+  folded into the matrix too
+- sharpening is a single 3x3 convolution
+
+Adjustments are applied in ImageEnhance's order, and results match it
+within 4 levels per channel, the difference comes from rounding.
+"""
+from __future__ import division
+
+from PIL import ImageEnhance, ImageFilter
+
+from .utils import convert_to_pil_factor
+
+
+# Weights PIL uses to convert RGB to L
+LUMA = (299 / 1000, 587 / 1000, 114 / 1000)
+
+# Kernel of PIL's ImageFilter.SMOOTH, which ImageEnhance.Sharpness blends with
+SMOOTH_KERNEL = (1, 1, 1, 1, 5, 1, 1, 1, 1)
+SMOOTH_SCALE = 13
+
+FUSED_MODES = ('L', 'LA', 'RGB', 'RGBA')
+
+
+def _blend(degenerate, value, factor):
+    # Same as PIL's Image.blend()
+    value = degenerate + factor * (value - degenerate)
+    return min(max(int(value), 0), 255)
+
+
+def get_sharpen_filter(factor):
+    """Returns a kernel that blends each pixel with its smoothed value,
+    i.e. ImageEnhance.Sharpness in one convolution."""
+    kernel = [(1 - factor) * weight for weight in SMOOTH_KERNEL]
+    kernel[4] += factor * SMOOTH_SCALE
+    return ImageFilter.Kernel((3, 3), kernel, scale=SMOOTH_SCALE)
+
+
+def get_color_matrix(saturation, brightness=1, contrast=1, mean=0):
+    """Returns an RGB to RGB matrix that blends each channel with luma, then
+    scales (brightness) and blends with `mean` (contrast)."""
+    matrix = []
+    for band in range(3):
+        row = [(1 - saturation) * luma for luma in LUMA]
+        row[band] += saturation
+        matrix.extend([value * brightness * contrast for value in row])
+        matrix.append((1 - contrast) * mean)
+    return tuple(matrix)
+
+
+def get_brightness_table(brightness):
+    return [_blend(0, value, brightness) for value in range(256)]
+
+
+def get_contrast_table(contrast, mean, table):
+    return [_blend(mean, value, contrast) for value in table]
+
+
+def get_mean(pil_image, table=None):
+    """Returns mean luma of an image, optionally mapped through `table`,
+    from its histogram. Unlike ImageEnhance.Contrast, this doesn't convert
+    the image to L."""
+    histogram = pil_image.histogram()
+    if table is None:
+        table = range(256)
+    means = []
+    for band in range(3 if pil_image.mode in ('RGB', 'RGBA') else 1):
+        band_histogram = histogram[band * 256:(band + 1) * 256]
+        total = sum(band_histogram) or 1
+        means.append(sum(count * value for count, value
+                         in zip(band_histogram, table)) / total)
+    if len(means) == 3:
+        return sum(luma * mean for luma, mean in zip(LUMA, means))
+    return means[0]
+
+
+def apply_table(pil_image, table):
+    """Applies a lookup table to every color band, leaving alpha as is."""
+    tables = []
+    for band in pil_image.getbands():
+        tables.extend(range(256) if band == 'A' else table)
+    return pil_image.point(tables)
+
+
+def enhance(pil_image, sharpness=0, brightness=0, saturation=0, contrast=0):
+    """Adjusts image using PIL's ImageEnhance, one enhancement at a time."""
+    # Image will lose transparency info when saturation/contrast
+    # is changed, see https://github.com/jdriscoll/django-imagekit/issues/64
+    if saturation:
+        enhancer = ImageEnhance.Color(pil_image)
+        pil_image = enhancer.enhance(convert_to_pil_factor(saturation))
+
+    if sharpness:
+        enhancer = ImageEnhance.Sharpness(pil_image)
+        pil_image = enhancer.enhance(convert_to_pil_factor(sharpness))
+
+    if brightness:
+        enhancer = ImageEnhance.Brightness(pil_image)
+        pil_image = enhancer.enhance(convert_to_pil_factor(brightness))
+
+    if contrast:
+        enhancer = ImageEnhance.Contrast(pil_image)
+        pil_image = enhancer.enhance(convert_to_pil_factor(contrast))
+
+    return pil_image
+
+
+def adjust(pil_image, sharpness=0, brightness=0, saturation=0, contrast=0):
+    """
+    Adjusts image's sharpness, brightness, saturation and contrast on a
+    scale from -100 to 100, in as few passes as possible. Images in modes
+    other than L, LA, RGB and RGBA are adjusted with ImageEnhance.
+    """
+    if pil_image.mode not in FUSED_MODES:
+        return enhance(pil_image, sharpness=sharpness, brightness=brightness,
+                       saturation=saturation, contrast=contrast)
+
+    # Same order as enhance(): saturation, sharpness, brightness, contrast.
+    # Grayscale images are unaffected by saturation
+    if saturation and pil_image.mode in ('RGB', 'RGBA'):
+        saturation = convert_to_pil_factor(saturation)
+        brightness = convert_to_pil_factor(brightness)
+        contrast = convert_to_pil_factor(contrast)
+        if pil_image.mode == 'RGB' and saturation <= 1 and brightness <= 1 and not sharpness:
+            mean = 0
+            if contrast != 1:
+                # Saturation preserves luma
+                mean = int(get_mean(pil_image) * brightness + 0.5)
+            return pil_image.convert('RGB', get_color_matrix(
+                saturation, brightness, contrast, mean))
+
+        if pil_image.mode == 'RGB' and not sharpness:
+            pil_image = pil_image.convert('RGB', get_color_matrix(saturation))
+        else:
+            # Sharpening amplifies the matrix's rounding differences
+            pil_image = ImageEnhance.Color(pil_image).enhance(saturation)
+    else:
+        brightness = convert_to_pil_factor(brightness)
+        contrast = convert_to_pil_factor(contrast)
+
+    if sharpness:
+        sharpened = pil_image.filter(
+            get_sharpen_filter(convert_to_pil_factor(sharpness)))
+        if 'A' in pil_image.getbands():
+            sharpened.putalpha(pil_image.getchannel('A'))
+        pil_image = sharpened
+
+    if brightness == 1 and contrast == 1:
+        return pil_image
+
+    table = get_brightness_table(brightness)
+    if contrast != 1:
+        mean = int(get_mean(pil_image, table) + 0.5)
+        table = get_contrast_table(contrast, mean, table)
+    return apply_table(pil_image, table)
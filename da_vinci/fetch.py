@@ -0,0 +1,226 @@
+"""
+Fetches images over HTTP(S), reusing keep-alive connections per host:
+
+    from da_vinci import fetch
+
+    fetcher = fetch.Fetcher(timeout=5, max_bytes=20 * 1024 * 1024,
+                            max_pixels=50 * 1000 * 1000)
+    image = Image('https://example.com/photo.jpg', fetcher=fetcher)
+
+    # Conditional request, response.data is None if not modified
+    response = fetcher.fetch(url, etag=response.etag)
+
+Responses are streamed: a download is aborted as soon as it exceeds
+max_bytes, or once the image header shows more than max_pixels pixels.
+"""
+import io
+import threading
+
+from PIL import Image as PILImage
+
+from .compat import httplib, urljoin, urlparse
+from .instrumentation import measure
+
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+# Header sniffing for image dimensions stops after this many bytes
+MAX_HEADER_BYTES = 1024 * 1024
+
+
+class FetchError(IOError):
+    pass
+
+
+class ResponseTooLarge(FetchError):
+    pass
+
+
+class Response(object):
+
+    def __init__(self, url, status, data, headers):
+        self.url = url
+        self.status = status
+        self.data = data
+        self.headers = headers
+
+    @property
+    def etag(self):
+        return self.headers.get('etag')
+
+    @property
+    def last_modified(self):
+        return self.headers.get('last-modified')
+
+    @property
+    def not_modified(self):
+        return self.status == 304
+
+
+def get_image_size(data):
+    """Returns image dimensions from the (possibly incomplete) beginning of
+    an image file, or None if the header isn't complete yet. Raises
+    PIL.Image.DecompressionBombError past Pillow's MAX_IMAGE_PIXELS."""
+    try:
+        return PILImage.open(io.BytesIO(data)).size
+    except PILImage.DecompressionBombError:
+        raise
+    except Exception:
+        return None
+
+
+class Fetcher(object):
+
+    def __init__(self, timeout=30, max_bytes=None, max_pixels=None,
+                 max_idle_connections=4, chunk_size=64 * 1024, headers=None):
+        """
+        - timeout: seconds to wait for connecting and for each read
+        - max_bytes: maximum size of a response body
+        - max_pixels: maximum number of pixels of an image, checked as soon
+          as its header is received
+        - max_idle_connections: keep-alive connections kept per host
+        """
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.max_idle_connections = max_idle_connections
+        self.chunk_size = chunk_size
+        self.headers = headers or {}
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def _new_connection(self, scheme, netloc):
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _get_connection(self, scheme, netloc):
+        """Returns an idle keep-alive connection to the host if there's one,
+        and whether it is reused."""
+        with self._lock:
+            idle = self._connections.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        return self._new_connection(scheme, netloc), False
+
+    def _release_connection(self, scheme, netloc, connection):
+        with self._lock:
+            idle = self._connections.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_idle_connections:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """Closes idle connections."""
+        with self._lock:
+            connections = self._connections
+            self._connections = {}
+        for idle in connections.values():
+            for connection in idle:
+                connection.close()
+
+    def _request(self, url, headers):
+        result = urlparse(url)
+        if result.scheme not in ('http', 'https'):
+            raise FetchError('Unsupported URL scheme: %s' % url)
+        path = result.path or '/'
+        if result.query:
+            path = '%s?%s' % (path, result.query)
+
+        connection, reused = self._get_connection(result.scheme, result.netloc)
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+        except (httplib.HTTPException, OSError):
+            connection.close()
+            if not reused:
+                raise
+            # Idle connection may have been closed by the server, retry once
+            connection = self._new_connection(result.scheme, result.netloc)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, OSError):
+                connection.close()
+                raise
+        return result, connection, response
+
+    def _read(self, url, response):
+        length = response.getheader('content-length')
+        if self.max_bytes is not None and length is not None and int(length) > self.max_bytes:
+            raise ResponseTooLarge('%s is larger than %d bytes' % (url, self.max_bytes))
+
+        buffer = io.BytesIO()
+        check_size = self.max_pixels is not None
+        while True:
+            chunk = response.read(self.chunk_size)
+            if not chunk:
+                break
+            buffer.write(chunk)
+            if self.max_bytes is not None and buffer.tell() > self.max_bytes:
+                raise ResponseTooLarge('%s is larger than %d bytes' % (url, self.max_bytes))
+            if check_size:
+                try:
+                    size = get_image_size(buffer.getvalue())
+                except PILImage.DecompressionBombError:
+                    # Too large for Pillow to open anyway
+                    raise ResponseTooLarge('%s is larger than %d pixels'
+                                           % (url, PILImage.MAX_IMAGE_PIXELS))
+                if size is not None:
+                    check_size = False
+                    if size[0] * size[1] > self.max_pixels:
+                        raise ResponseTooLarge('%s is larger than %d pixels'
+                                               % (url, self.max_pixels))
+                elif buffer.tell() > MAX_HEADER_BYTES:
+                    check_size = False
+        return buffer.getvalue()
+
+    def fetch(self, url, etag=None, last_modified=None):
+        """Fetches a URL, following redirects. If "etag" or "last_modified"
+        are given, the request is conditional and response.data is None
+        when the content hasn't changed."""
+        headers = dict(self.headers)
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+
+        for redirect in range(MAX_REDIRECTS + 1):
+            result, connection, response = self._request(url, headers)
+            try:
+                if response.status in REDIRECT_STATUSES and response.getheader('location'):
+                    response.read()
+                    url = urljoin(url, response.getheader('location'))
+                elif response.status == 304:
+                    response.read()
+                    data = None
+                elif response.status == 200:
+                    with measure('fetch') as measurement:
+                        data = self._read(url, response)
+                        measurement.set_output(bytes=len(data))
+                else:
+                    raise FetchError('%s returned HTTP %d' % (url, response.status))
+            except Exception:
+                connection.close()
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._release_connection(result.scheme, result.netloc, connection)
+            if response.status not in REDIRECT_STATUSES:
+                headers = dict((key.lower(), value) for key, value in response.getheaders())
+                return Response(url, response.status, data, headers)
+        raise FetchError('Too many redirects fetching %s' % url)
+
+
+_default_fetcher = None
+
+
+def get_default_fetcher():
+    global _default_fetcher
+    if _default_fetcher is None:
+        _default_fetcher = Fetcher()
+    return _default_fetcher
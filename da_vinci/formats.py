@@ -20,3 +20,34 @@ EXTENSIONS = {
     'BMP': 'bmp',
     'WEBP': 'webp'
 }
+
+# Encoder options trading encoding time for file size, per preset and format
+PRESETS = {
+    'fast': {
+        'JPEG': {'optimize': False, 'progressive': False},
+        'PNG': {'compress_level': 1, 'optimize': False},
+        'WEBP': {'method': 0},
+    },
+    'balanced': {
+        'JPEG': {'optimize': True},
+        'PNG': {'compress_level': 6},
+        'WEBP': {'method': 4},
+    },
+    'smallest': {
+        'JPEG': {'optimize': True, 'progressive': True},
+        'PNG': {'compress_level': 9, 'optimize': True},
+        'WEBP': {'method': 6},
+        'GIF': {'optimize': True},
+    },
+}
+
+
+def get_save_options(format, preset=None, options=None):
+    """Returns options for Pillow's encoder of `format`: the preset's,
+    updated with `options`, a dict of options per format."""
+    save_options = {}
+    if preset is not None:
+        save_options.update(PRESETS[preset].get(format, {}))
+    if options:
+        save_options.update(options.get(format, {}))
+    return save_options
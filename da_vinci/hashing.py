@@ -0,0 +1,218 @@
+"""
+Perceptual hashes, which stay the same (or close) when an image is
+re-encoded, resized or slightly adjusted, and an index finding near
+duplicates among many hashes:
+
+    from da_vinci.hashing import HashIndex
+
+    index = HashIndex.load('hashes.npy')         # Memory-mapped
+    value = image.get_hash()                      # pHash by default
+    matches = index.query(value)                  # [(key, distance), ...]
+    if not matches:
+        index.add('photos/cat.jpg', value)
+        index.save('hashes.npy')
+
+Hashes are 64 bit integers, computed from a proxy of the image decoded at
+a reduced scale where the format allows it (see Image._get_proxy):
+- "ahash": which pixels of an 8x8 grayscale copy are brighter than average
+- "dhash": which pixels of a 9x8 grayscale copy are brighter than their
+  right neighbour
+- "phash": which of the lowest 8x8 frequencies of a 32x32 grayscale copy's
+  DCT are above their median. The most robust, requires numpy
+
+Similar images have hashes at a small Hamming distance (the number of
+differing bits), MAX_DISTANCE is a good threshold for pHash.
+
+HashIndex keeps hashes in a NumPy array, queries XOR all of them with the
+hash and count the differing bits at once, which takes milliseconds for
+millions of hashes. It's saved as a .npy file of (hash, key) records.
+Requires numpy.
+"""
+from __future__ import division
+
+import os
+
+from PIL import Image as PILImage
+
+from .compat import numpy
+from .utils import make_temporary_file
+
+
+# Images are hashed from proxies fitting this size
+PROXY_SIZE = (64, 64)
+HASH_SIZE = 8
+DCT_SIZE = 32
+METHODS = ('ahash', 'dhash', 'phash')
+
+# pHashes of the same image re-encoded or resized are typically closer than
+# this, distinct images hardly ever are. Images without texture, like plain
+# gradients, have few significant frequencies and less stable hashes
+MAX_DISTANCE = 8
+
+
+def _require_numpy(feature):
+    if numpy is None:
+        raise ImportError('%s requires numpy' % feature)
+
+
+def _to_int(bits):
+    value = 0
+    for bit in bits:
+        value = (value << 1) | bool(bit)
+    return value
+
+
+def _get_gray(pil_image, size):
+    if pil_image.mode not in ('L', 'RGB'):
+        pil_image = pil_image.convert('RGB')
+    return pil_image.convert('L').resize(size, PILImage.LANCZOS)
+
+
+def _get_pixels(pil_image):
+    # getdata() is deprecated since Pillow 12.1
+    if hasattr(pil_image, 'get_flattened_data'):
+        return list(pil_image.get_flattened_data())
+    return list(pil_image.getdata())
+
+
+def average_hash(pil_image):
+    pixels = _get_pixels(_get_gray(pil_image, (HASH_SIZE, HASH_SIZE)))
+    mean = sum(pixels) / len(pixels)
+    return _to_int(pixel > mean for pixel in pixels)
+
+
+def difference_hash(pil_image):
+    pixels = _get_pixels(_get_gray(pil_image, (HASH_SIZE + 1, HASH_SIZE)))
+    width = HASH_SIZE + 1
+    return _to_int(pixels[row * width + column] > pixels[row * width + column + 1]
+                   for row in range(HASH_SIZE) for column in range(HASH_SIZE))
+
+
+def _get_dct_matrix(size):
+    k = numpy.arange(size).reshape(-1, 1)
+    n = numpy.arange(size).reshape(1, -1)
+    return numpy.cos(numpy.pi * (2 * n + 1) * k / (2 * size))
+
+
+def perceptual_hash(pil_image):
+    _require_numpy('pHash')
+    pixels = numpy.asarray(_get_gray(pil_image, (DCT_SIZE, DCT_SIZE)), dtype=numpy.float64)
+    matrix = _get_dct_matrix(DCT_SIZE)
+    frequencies = matrix.dot(pixels).dot(matrix.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # The first coefficient is the average brightness, which would skew it
+    median = numpy.median(frequencies[1:])
+    return _to_int(frequencies > median)
+
+
+HASHES = {
+    'ahash': average_hash,
+    'dhash': difference_hash,
+    'phash': perceptual_hash,
+}
+
+
+def get_hash(pil_image, method='phash'):
+    """Returns the hash of a (small) image as an integer."""
+    try:
+        function = HASHES[method]
+    except KeyError:
+        raise ValueError('Method must be one of %s, not "%s"'
+                         % (', '.join(METHODS), method))
+    return function(pil_image)
+
+
+def get_distance(first, second):
+    """Returns the number of bits differing between two hashes."""
+    return bin(first ^ second).count('1')
+
+
+def _count_bits(values):
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(values)
+    # Before NumPy 2.0, bits are counted per byte with a lookup table
+    table = numpy.array([bin(byte).count('1') for byte in range(256)], dtype=numpy.uint8)
+    return table[values.view(numpy.uint8)].reshape(-1, 8).sum(axis=1, dtype=numpy.uint8)
+
+
+class HashIndex(object):
+    """Hashes with a key each, e.g. the path or cache key of the image they
+    were computed from. Keys are saved with the length of the longest
+    one, short keys keep the file small."""
+
+    def __init__(self):
+        _require_numpy('HashIndex')
+        self._hashes = numpy.zeros(0, dtype=numpy.uint64)
+        self._keys = numpy.zeros(0, dtype='S1')
+        self._pending = []
+
+    def __len__(self):
+        return len(self._hashes) + len(self._pending)
+
+    def add(self, key, value):
+        """Adds a hash. Queries see it right away, added hashes are merged
+        into the arrays on the next query."""
+        self._pending.append((value, key.encode('utf-8')))
+
+    def _merge(self):
+        if not self._pending:
+            return
+        values, keys = zip(*self._pending)
+        self._hashes = numpy.concatenate([self._hashes, numpy.array(values, dtype=numpy.uint64)])
+        self._keys = numpy.concatenate([self._keys, numpy.array(keys)])
+        self._pending = []
+
+    def get_distances(self, value):
+        """Returns the distances of every hash to `value`, in the order
+        they were added."""
+        self._merge()
+        return _count_bits(numpy.bitwise_xor(self._hashes, numpy.uint64(value)))
+
+    def _get_results(self, positions, distances):
+        return [(self._keys[position].decode('utf-8'), int(distances[position]))
+                for position in positions]
+
+    def query(self, value, max_distance=MAX_DISTANCE):
+        """Returns the (key, distance) of hashes at most max_distance from
+        `value`, closest first."""
+        distances = self.get_distances(value)
+        positions = numpy.flatnonzero(distances <= max_distance)
+        positions = positions[numpy.argsort(distances[positions], kind='stable')]
+        return self._get_results(positions, distances)
+
+    def nearest(self, value, count=1):
+        """Returns the (key, distance) of the `count` hashes closest to
+        `value`, closest first."""
+        distances = self.get_distances(value)
+        count = min(count, len(distances))
+        if count == 0:
+            return []
+        positions = numpy.argpartition(distances, count - 1)[:count]
+        positions = positions[numpy.argsort(distances[positions], kind='stable')]
+        return self._get_results(positions, distances)
+
+    def save(self, filename):
+        """Writes the index to a .npy file of (hash, key) records, atomically."""
+        self._merge()
+        records = numpy.empty(len(self._hashes), dtype=[
+            ('hash', '<u8'), ('key', 'S%d' % max(self._keys.itemsize, 1))])
+        records['hash'] = self._hashes
+        records['key'] = self._keys
+        directory = os.path.dirname(os.path.abspath(filename))
+        descriptor, temporary_filename = make_temporary_file(directory)
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                numpy.save(file, records)
+            os.replace(temporary_filename, filename)
+        except BaseException:
+            os.remove(temporary_filename)
+            raise
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """Reads an index written by save(). With mmap, the file is mapped
+        rather than read, and pages are only read as queries need them."""
+        records = numpy.load(filename, mmap_mode='r' if mmap else None)
+        index = cls()
+        index._hashes = records['hash']
+        index._keys = records['key']
+        return index
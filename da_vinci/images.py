@@ -1,51 +1,191 @@
 from __future__ import division
 
+import contextlib
 import io
 import os
+import weakref
+from concurrent import futures
 
 from PIL import Image as PILImage
-from PIL import ImageEnhance, ImageOps
 
-from . import formats
-from .compat import string_types, urlopen, urlparse
-from .utils import (calculate_dimensions, convert_to_pil_factor,
-                    get_box_dimensions, parse_dimension)
+from . import (animation, color, formats, hashing, memory, pipeline,
+               placeholders, smartcrop)
+from .cache import get_digest, get_key
+from .compat import string_types, urlparse
+from .fetch import get_default_fetcher
+from .instrumentation import measure
+from .quality import find_encoding
+from .utils import (BufferReader, calculate_dimensions, get_box_dimensions,
+                    parse_dimension)
+
+
+RENDITION_FIELDS = ('width', 'height', 'method', 'format', 'quality', 'resample')
+
+
+def get_resize_operation(size, resample):
+    pipeline.get_resampling(resample)
+    # The default isn't recorded, so cache keys of existing images don't change
+    if resample is None or resample == pipeline.DEFAULT_RESAMPLING:
+        return ('resize', size)
+    return ('resize', size, resample)
+
+
+def get_position(fp):
+    """Returns the position in a file object, or the size of a file."""
+    try:
+        if isinstance(fp, string_types):
+            return os.path.getsize(fp)
+        return fp.tell()
+    except (IOError, OSError, AttributeError):
+        return None
 
 
 class Image(object):
 
-    def __init__(self, path_or_url):
+    def __init__(self, path_or_url, deferred=False, size_hint=None,
+                 fetcher=None, color_profile=None, max_pixels=None, budget=None):
         """
         "filename" refers to image's file name on disk. If an image is opened
-        from a URL, it doesn't have a filename until save() is called
+        from a URL, bytes or a file object without a name, it doesn't have a
+        filename until save() is called
+
+        Only the image header is read on opening, pixels are decoded when an
+        operation is applied or the image is saved. Dimensions are already
+        corrected for EXIF orientation. File objects are read in full, so
+        they can be closed right away.
+
+        If "deferred" is True, flip(), rotate(), resize(), crop() and adjust()
+        only record operations. They are planned and applied at once when
+        the image is saved or the underlying PIL image is requested, so a
+        pending downscale lets the decoder scale the image down (JPEG only).
+
+        "size_hint" is a (width, height) the image will be downscaled to at
+        most, allowing the decoder to scale down large JPEGs right away. The
+        image is no smaller than "size_hint" after opening.
+
+        Images are fetched from URLs with "fetcher" (see da_vinci.fetch),
+        which defaults to a shared fetcher without size limits.
+
+        "color_profile" converts the image to a profile, see to_profile().
+
+        Images larger than "max_pixels", which defaults to the budget's,
+        raise memory.ImageTooLarge when opened. While operations are applied
+        and the image is encoded, its estimated memory is reserved from
+        "budget", which defaults to the process-wide one (see
+        da_vinci.memory).
         """
+        self._budget = budget
+        self._reserved = False
+        if max_pixels is None and self.budget is not None:
+            max_pixels = self.budget.max_pixels
+        with measure('open') as measurement:
+            self._open(path_or_url, size_hint, fetcher, max_pixels)
+            measurement.set_output(self._pil_image)
+        self.deferred = deferred
+        if color_profile is not None:
+            self.to_profile(color_profile)
+
+    def _open(self, path_or_url, size_hint, fetcher, max_pixels=None):
         if isinstance(path_or_url, string_types):
             result = urlparse(path_or_url)
         else:
             result = None
-        # If we receive a URL, use urllib to open the image
+        # If we receive a URL, fetch the image
         # else, assume it's a filename or file like object
         if result is not None and result.scheme in ('http', 'https'):
-            file = io.BytesIO(urlopen(path_or_url).read())
+            fetcher = fetcher or get_default_fetcher()
+            file = io.BytesIO(fetcher.fetch(path_or_url).data)
             self._pil_image = PILImage.open(file)
+            self._source = file
             self.filename = None
             self.name = os.path.basename(path_or_url)
-        else:
+        elif isinstance(path_or_url, string_types):
             self._pil_image = PILImage.open(path_or_url)
-            self.filename = self._pil_image.filename if self._pil_image.filename else path_or_url.name
+            # Pillow only closes the file once the image is loaded, which
+            # pending operations may never do
+            weakref.finalize(self._pil_image, self._pil_image.fp.close)
+            self._source = path_or_url
+            self.filename = self._pil_image.filename
             self.name = os.path.basename(self.filename)
+        else:
+            file = path_or_url
+            if not isinstance(file, BufferReader):
+                # The caller may close its file before pixels are decoded,
+                # so its bytes are copied
+                try:
+                    file.seek(0)
+                except (AttributeError, io.UnsupportedOperation):
+                    pass
+                file = io.BytesIO(file.read())
+            self._pil_image = PILImage.open(file)
+            self._source = file
+            self.filename = getattr(path_or_url, 'name', None)
+            self.name = os.path.basename(self.filename) if self.filename else None
+        try:
+            memory.check_pixels(self._pil_image.size, max_pixels)
+        except memory.ImageTooLarge:
+            self._pil_image.close()
+            raise
 
         self._format = self._pil_image.format
-        self._pil_image = ImageOps.exif_transpose(self._pil_image)
         self._quality = None
+        self._preset = None
+        self._options = {}
+        self._target = None
+        self._operations = []
+        self._source_digest = None
+        # Every operation applied to the image, to identify derivatives
+        self._history = []
+        if size_hint is not None:
+            self._history.append(('size_hint', size_hint))
+
+        orientation = pipeline.get_orientation_transpose(self._pil_image)
+        if size_hint is not None:
+            self._pil_image.draft(
+                None, pipeline.transpose_size(size_hint, orientation))
+        self._size = self._pil_image.size
+
+        # Transposing the image upright is the first pending operation
+        if orientation is not None:
+            pipeline.remove_orientation(self._pil_image)
+            self._operations.append(('transpose', orientation))
+            self._size = pipeline.transpose_size(self._size, orientation)
+
+    @classmethod
+    def from_bytes(cls, buffer, **kwargs):
+        """Opens an image from bytes or any object supporting the buffer
+        protocol (bytearray, memoryview, mmap...), without copying it."""
+        return cls(BufferReader(buffer), **kwargs)
+
+    @classmethod
+    def _from_pil_image(cls, pil_image, filename=None, name=None, format=None,
+                        quality=None):
+        image = cls.__new__(cls)
+        image._pil_image = pil_image
+        image.filename = filename
+        image.name = name
+        image._format = format or pil_image.format
+        image._quality = quality
+        image._preset = None
+        image._options = {}
+        image._target = None
+        image.deferred = False
+        image._operations = []
+        image._size = pil_image.size
+        image._source = None
+        image._source_digest = None
+        image._history = None
+        image._budget = None
+        image._reserved = False
+        return image
 
     @property
     def width(self):
-        return self._pil_image.size[0]
+        return self._size[0]
 
     @property
     def height(self):
-        return self._pil_image.size[1]
+        return self._size[1]
 
     @property
     def aspect_ratio(self):
@@ -59,6 +199,13 @@ class Image(object):
     def mode(self):
         return self._pil_image.mode
 
+    @property
+    def is_animated(self):
+        """Whether the image has several frames. Operations on an animated
+        image are applied to every frame when it's saved as GIF or WebP,
+        get_pil_image() only returns the first frame."""
+        return animation.is_animated(self._pil_image)
+
     def _set_format(self, format):
         if isinstance(format, string_types):
             format = format.lower()
@@ -77,73 +224,354 @@ class Image(object):
 
     quality = property(_get_quality, _set_quality)
 
-    def set(self, format=None, quality=None):
-        """Converts image to specified kwargs. Supports format and quality.
+    @property
+    def budget(self):
+        return self._budget if self._budget is not None else memory.get_default_budget()
+
+    @property
+    def preset(self):
+        return self._preset
+
+    def set(self, format=None, quality=None, preset=None, options=None,
+            max_bytes=None, min_similarity=None, candidates=None):
+        """Converts image to specified kwargs. Supports format, quality,
+        encoder preset and encoder options.
 
             image.set(format='jpg')
             image.set(quality=85)  # In percent
+
+        "preset" is "fast", "balanced" or "smallest" (see formats.PRESETS),
+        trading encoding time for file size. "options" are passed on to
+        Pillow's encoder, per format, overriding the preset's:
+
+            image.set(preset='smallest', options={'webp': {'lossless': True}})
+
+        Instead of a fixed quality, the image can be saved with the quality
+        that fits "max_bytes" and/or keeps "min_similarity" (SSIM, from 0
+        to 1), trying each of the "candidates" formats (see da_vinci.quality):
+
+            image.set(max_bytes=80 * 1024, candidates=['jpeg', 'webp'])
         """
         if format is not None:
             self._set_format(format)
         if quality is not None:
             self._set_quality(quality)
+        if preset is not None:
+            if preset not in formats.PRESETS:
+                raise ValueError('Preset must be one of %s, not "%s"'
+                                 % (', '.join(sorted(formats.PRESETS)), preset))
+            self._preset = preset
+        if options is not None:
+            for key, format_options in options.items():
+                key = formats.MAPPING.get(key.lower(), key.upper())
+                self._options.setdefault(key, {}).update(format_options)
+        if max_bytes is not None or min_similarity is not None or candidates is not None:
+            target = dict(self._target or {})
+            if max_bytes is not None:
+                target['max_bytes'] = max_bytes
+            if min_similarity is not None:
+                target['min_similarity'] = min_similarity
+            if candidates is not None:
+                target['candidates'] = [formats.MAPPING[candidate.lower()]
+                                        for candidate in candidates]
+            if not target.get('max_bytes') and not target.get('min_similarity'):
+                raise ValueError('max_bytes or min_similarity is required')
+            self._target = target
+
+    def get_save_options(self, format=None):
+        """Returns options passed to Pillow's encoder for a format, the
+        image's by default. These include the image's ICC profile."""
+        format = format or self.format
+        options = formats.get_save_options(format, self._preset, self._options)
+        if format in color.ICC_FORMATS:
+            icc_profile = self._pil_image.info.get('icc_profile')
+            if self._operations and animation.is_animated(self._pil_image):
+                # Frames are converted while saving
+                for operation in self._operations:
+                    if operation[0] == 'profile':
+                        icc_profile = color.get_output_profile(icc_profile, operation[1])
+            if icc_profile:
+                options.setdefault('icc_profile', icc_profile)
+        return options
 
     def get_filename(self):
         """Generates a suitable filename based on image name and format."""
         name = self.filename or self.name
+        if not name:
+            raise ValueError('Image has no filename, pass one to save()')
         filename, extension = os.path.splitext(name)
         return '%s.%s' % (filename, formats.EXTENSIONS[self.format])
 
     def show(self):
         """Displays the image, mainly for debugging purposes.
         This simply calls PIL's image.show()"""
+        self._apply_operations()
         return self._pil_image.show()
 
     def get_pil_image(self):
         """Returns the underlying PIL image for more extensive manipulation."""
+        self._apply_operations()
+        # The PIL image may be modified, so its derivatives can't be cached
+        self._history = None
         return self._pil_image
 
+    def to_shared(self):
+        """Copies the image's pixels to shared memory, returning a picklable
+        handle that other processes open without copying them. The handle
+        must be released, see da_vinci.shared."""
+        from . import shared
+        return shared.export(self)
+
+    def close(self):
+        """Closes the underlying file if the image hasn't been decoded."""
+        self._pil_image.close()
+
     def set_pil_image(self, pil_image):
         self._pil_image = pil_image
+        self._operations = []
+        self._size = pil_image.size
+        self._history = None
+
+    def _add_operation(self, operation):
+        """Records an operation, which is applied right away unless the
+        image is deferred."""
+        self._operations.append(operation)
+        self._size = pipeline.get_operation_size(operation, self._size)
+        if self._history is not None:
+            self._history.append(operation)
+        # Animated images are transformed frame by frame when saved
+        if not self.deferred and not self.is_animated:
+            self._apply_operations()
+
+    def estimate_memory(self, format=None):
+        """Returns an estimate of the peak memory, in bytes, of applying
+        pending operations and encoding the image ("format" defaults to the
+        image's). Only the header is read, see da_vinci.memory."""
+        format = formats.MAPPING[format.lower()] if format else self.format
+        return memory.estimate(self._pil_image, self._operations, format)
+
+    @contextlib.contextmanager
+    def _reserve(self, format=None, extra_bytes=0):
+        """Reserves the estimated memory of pending operations (and
+        encoding in "format") from the budget for the duration of the
+        block, once however many blocks are nested."""
+        budget = self.budget
+        if budget is None or self._reserved:
+            yield
+            return
+        nbytes = memory.estimate(self._pil_image, self._operations, format) + extra_bytes
+        with budget.reserve(nbytes):
+            self._reserved = True
+            try:
+                yield
+            finally:
+                self._reserved = False
+
+    def _apply_operations(self):
+        if not self._operations:
+            return
+        with self._reserve():
+            steps = pipeline.plan(self._operations, self._pil_image.size)
+            # E.g. a resize to the current size, the source is kept as is
+            if not steps:
+                self._operations = []
+                return
+            steps = pipeline.draft(self._pil_image, steps)
+            source = self._pil_image
+            self._pil_image = pipeline.run(source, steps)
+        self._operations = []
+        # Only part of the file may have been read, without loading the
+        # image. Close it, as loading would have.
+        if not pipeline.is_loaded(source) and isinstance(self._source, string_types):
+            source.close()
+
+    def _reopen(self):
+        """Returns a new PIL image of the source, without copying it."""
+        if isinstance(self._source, string_types):
+            return PILImage.open(self._source)
+        if isinstance(self._source, (BufferReader, io.BytesIO)):
+            return PILImage.open(BufferReader(self._source.getbuffer()))
+        return self._pil_image
+
+    def _get_proxy(self, max_size):
+        """Returns a small copy of the image with pending operations applied,
+        fitting max_size. Pending operations are left to run on the image."""
+        scale = min(max_size[0] / self.width, max_size[1] / self.height, 1)
+        size = (max(int(round(self.width * scale)), 1),
+                max(int(round(self.height * scale)), 1))
+        operations = self._operations + [('resize', size, 'fastest')]
+        source = self._pil_image
+        if not pipeline.is_loaded(source) and self._source is not None:
+            # Opened again, so JPEGs can be decoded at a reduced scale
+            source = self._reopen()
+            if source.size != self._pil_image.size:
+                # Drafted with a size hint
+                source.close()
+                source = self._pil_image
+        if source is self._pil_image:
+            # Decoded once, pending operations will run on the decoded image
+            with self._reserve():
+                pipeline.load(source)
+                return pipeline.run(source, pipeline.plan(operations, source.size))
+        proxy = pipeline.run(source, pipeline.draft(source, pipeline.plan(
+            operations, source.size)))
+        if proxy is not source:
+            source.close()
+        return proxy
 
     def flip(self, direction):
         """Flips an image, horizontally or vertically."""
         if direction == 'horizontal':
-            self._pil_image = self._pil_image.transpose(PILImage.FLIP_LEFT_RIGHT)
+            self._add_operation(('transpose', PILImage.FLIP_LEFT_RIGHT))
         elif direction == 'vertical':
-            self._pil_image = self._pil_image.transpose(PILImage.FLIP_TOP_BOTTOM)
+            self._add_operation(('transpose', PILImage.FLIP_TOP_BOTTOM))
         else:
             raise ValueError('Direction must be "horizontal" or "vertical"')
 
     def rotate(self, degrees):
         """Rotates image by specified number of degrees."""
-        self._pil_image = self._pil_image.rotate(degrees)
-
-    def save(self, filename=None, file=None, fill_color=(255, 255, 255)):
-        """Saves the image to disk. If image doesn't have a filename, it's
-        assigned one.
+        self._add_operation(('rotate', degrees))
+
+    def _get_source_digest(self):
+        if self._source_digest is None and self._source is not None:
+            if isinstance(self._source, string_types):
+                with open(self._source, 'rb') as file:
+                    self._source_digest = get_digest(file)
+            else:
+                self._source_digest = get_digest(self._source)
+        return self._source_digest
+
+    def get_cache_key(self, fill_color=(255, 255, 255)):
+        """Returns a key identifying the image as it would be saved, made from
+        the source image bytes and the operations applied to it. Returns None
+        if the image can't be identified, e.g. after set_pil_image()."""
+        if self._history is None:
+            return None
+        source_digest = self._get_source_digest()
+        if source_digest is None:
+            return None
+        description = {
+            'operations': self._history,
+            'format': self.format,
+            'quality': self.quality,
+            'fill_color': fill_color,
+        }
+        if self._preset is not None:
+            description['preset'] = self._preset
+        if self._options:
+            description['options'] = self._options
+        if self._target is not None:
+            description['target'] = self._target
+            if self._target.get('candidates'):
+                # The format is chosen when encoding
+                del description['format']
+        return get_key(source_digest, description)
+
+    def save(self, filename=None, file=None, fill_color=(255, 255, 255),
+             cache=None):
+        """Saves the image to disk, or to a file object if "file" is given.
+        If image doesn't have a filename, it's assigned one.
+
+        If a cache (see da_vinci.cache) is given, the encoded image is looked
+        up there first, skipping decoding and encoding entirely on a hit.
         """
         if filename:
             self.filename = filename
 
-        self.filename = self.get_filename()
+        key = self.get_cache_key(fill_color) if cache is not None else None
+        if key is None and self._target is None:
+            if file is None:
+                self.filename = self.get_filename()
+            self._encode(file or self.filename, fill_color)
+            return
+
+        data = cache.get(key) if key is not None else None
+        if data is None:
+            buffer = io.BytesIO()
+            self._encode(buffer, fill_color)
+            data = buffer.getvalue()
+            if key is not None:
+                cache.set(key, data)
+        elif self._target is not None:
+            # The cached image's format may have been chosen when encoding
+            self._format = PILImage.open(io.BytesIO(data)).format
+        if file is None:
+            self.filename = self.get_filename()
+        if file is not None:
+            file.write(data)
+        else:
+            with open(self.filename, 'wb') as output:
+                output.write(data)
+
+    def to_bytes(self, format=None, quality=None, fill_color=(255, 255, 255),
+                 cache=None):
+        """Returns the encoded image. "format" and "quality" default to the
+        image's own, which are left unchanged."""
+        original_format, original_quality = self._format, self._quality
+        self.set(format=format, quality=quality)
+        buffer = io.BytesIO()
+        try:
+            self.save(file=buffer, fill_color=fill_color, cache=cache)
+        finally:
+            self._format, self._quality = original_format, original_quality
+        return buffer.getvalue()
+
+    def _encode(self, fp, fill_color):
+        with self._reserve(self.format):
+            self._encode_image(fp, fill_color)
+
+    def _encode_image(self, fp, fill_color):
+        if self.is_animated and self.format in animation.FORMATS:
+            self._encode_animation(fp)
+            return
+
+        self._apply_operations()
+        pipeline.load(self._pil_image)
+        if self._target is not None:
+            encoding = find_encoding(
+                self._pil_image, self._target.get('candidates') or [self.format],
+                max_bytes=self._target.get('max_bytes'),
+                min_similarity=self._target.get('min_similarity'),
+                fill_color=fill_color,
+                get_options=self.get_save_options)
+            self._format = encoding.format
+            fp.write(encoding.data)
+            return
+
         kwargs = {
             'format': self._format,
-            'fp': file or self.filename,
+            'fp': fp,
         }
         if self.quality is not None:
             kwargs['quality'] = self.quality
+        kwargs.update(self.get_save_options())
 
         # fill with color instead of removing alpha, to make a fixed bg color
-        if self._pil_image.mode in ("RGBA", "LA", "PA") and self.format == "JPEG":
-            rgb_image = PILImage.new(self._pil_image.mode[:-1], self._pil_image.size, fill_color)
-            rgb_image.paste(self._pil_image, self._pil_image.split()[-1])
-            self._pil_image = rgb_image
-
-        self._pil_image.save(**kwargs)
+        if pipeline.needs_flattening(self._pil_image, self.format):
+            self._pil_image = pipeline.flatten(self._pil_image, fill_color)
+
+        with measure('encode', self._pil_image) as measurement:
+            start = 0 if isinstance(fp, string_types) else get_position(fp)
+            self._pil_image.save(**kwargs)
+            end = get_position(fp)
+            measurement.set_output(
+                self._pil_image, bytes=end - start if end is not None else None)
+
+    def _encode_animation(self, fp):
+        kwargs = self.get_save_options()
+        if self.quality is not None:
+            kwargs['quality'] = self.quality
+        steps = pipeline.plan(self._operations, self._pil_image.size)
+        with measure('encode', self._pil_image) as measurement:
+            start = 0 if isinstance(fp, string_types) else get_position(fp)
+            animation.save(self._pil_image, steps, fp, self.format, **kwargs)
+            end = get_position(fp)
+            measurement.set_output(
+                bytes=end - start if end is not None else None)
 
     # Should this accept percentages for width and height?
-    def resize(self, width=None, height=None, method='stretch'):
+    def resize(self, width=None, height=None, method='stretch', resample=None,
+               center=None):
         """Resizes image to specified width/height. Behavior depends on method:
         - "stretch" resizes the whole image to the specified dimension,
           regardless of aspect ratio
@@ -152,62 +580,215 @@ class Image(object):
         - "fill" resizes image to be as large as possible so that the specified
           dimension is completely covered. Aspect ratio is preserved, parts of
           the image may not be within the specified dimension.
+
+        "resample" trades quality for speed: "fastest", "balanced" or "best"
+        (the default), see pipeline.RESAMPLING. A PIL filter can be given too.
+
+        With "fill", a "center" crops the image to the specified dimension
+        around it, see crop().
         """
-        try:
-            resample = PILImage.ANTIALIAS
-        except AttributeError:
-            resample = PILImage.LANCZOS
-
-        self._pil_image = self._pil_image.resize(
-            calculate_dimensions(width, height, self.width, self.height,
-                                 method=method),
-            resample=resample
-        )
+        size = calculate_dimensions(width, height, self.width, self.height,
+                                    method=method)
+        if size[0] < 1 or size[1] < 1:
+            raise ValueError('height and width must be > 0')
+        self._add_operation(get_resize_operation(size, resample))
+        if center is not None and method == 'fill' and width and height and \
+                size != (width, height):
+            self.crop(width, height, center=center)
+
+    def renditions(self, specs):
+        """Returns resized copies of the image, decoding it only once. Each
+        spec is a (width, height, method, format, quality, resample) tuple or
+        a dict,
+        which may also contain a "filename" or "file" to save to:
+
+            image.renditions([
+                {'width': 1200, 'method': 'fit', 'filename': 'large.jpg'},
+                (600, None, 'fit', 'webp', 80),
+                (300, None, 'fit', 'webp', 80),
+            ])
+
+        Renditions are made largest first, each one resized from the smallest
+        rendition (or the image itself) that's larger than it.
+        """
+        specs = [spec if isinstance(spec, dict) else dict(zip(RENDITION_FIELDS, spec))
+                 for spec in specs]
+        sizes = []
+        for spec in specs:
+            size = calculate_dimensions(spec.get('width'), spec.get('height'),
+                                        self.width, self.height,
+                                        method=spec.get('method') or 'stretch')
+            if size[0] < 1 or size[1] < 1:
+                raise ValueError('height and width must be > 0')
+            pipeline.get_resampling(spec.get('resample'))
+            sizes.append(size)
+
+        root, extension = os.path.splitext(self.filename or self.name or '')
+        order = sorted(range(len(specs)),
+                       key=lambda index: sizes[index][0] * sizes[index][1],
+                       reverse=True)
+        # Besides decoding: every rendition, the largest resampling pass and
+        # the largest encoding, which renditions don't reserve again
+        encodings = [memory.get_encoding_bytes(
+            size, self.mode, formats.MAPPING[spec['format'].lower()]
+            if spec.get('format') else self.format)
+            for spec, size in zip(specs, sizes) if spec.get('filename') or spec.get('file')]
+        extra_bytes = (sum(memory.get_bytes(size, self.mode) for size in sizes) +
+                       max([memory.get_bytes((size[0], self.height), self.mode)
+                            for size in sizes] or [0]) +
+                       max(encodings or [0]))
+        with self._reserve(extra_bytes=extra_bytes):
+            return self._make_renditions(specs, sizes, order, root, extension)
+
+    def _make_renditions(self, specs, sizes, order, root, extension):
+        self._apply_operations()
+        sources = [self._pil_image]
+        results = [None] * len(specs)
+        for index in order:
+            size = sizes[index]
+            source = min(
+                [source for source in sources
+                 if source.size[0] >= size[0] and source.size[1] >= size[1]] or sources[:1],
+                key=lambda source: source.size[0] * source.size[1]
+            )
+            spec = specs[index]
+            pil_image = pipeline.resize(source, size, resample=spec.get('resample'))
+            sources.append(pil_image)
+
+            filename = '%s_%sx%s%s' % (root, size[0], size[1], extension)
+            rendition = self._from_pil_image(
+                pil_image, filename=filename if self.filename else None,
+                name=os.path.basename(filename) if root else None, format=self.format,
+                quality=self.quality)
+            rendition._source = self._source
+            rendition._source_digest = self._source_digest
+            if self._history is not None:
+                rendition._history = self._history + [
+                    get_resize_operation(size, spec.get('resample'))]
+            rendition._preset = self._preset
+            rendition._options = dict(self._options)
+            rendition._target = self._target
+            rendition.set(format=spec.get('format'), quality=spec.get('quality'))
+            rendition._budget = self._budget
+            if spec.get('filename') or spec.get('file'):
+                # Covered by this image's reservation
+                rendition._reserved = self._reserved
+                try:
+                    rendition.save(filename=spec.get('filename'), file=spec.get('file'))
+                finally:
+                    rendition._reserved = False
+            results[index] = rendition
+        return results
 
     def crop(self, width, height, center=('50%', '50%'),
              shape='rectangle'):
+        """Crops image to width x height around "center", which is a pair of
+        coordinates (in pixels or percents) or "auto" to choose it from the
+        image's content (see da_vinci.smartcrop, requires numpy)."""
+        if center == 'auto':
+            center = smartcrop.find_center(self._get_proxy(smartcrop.PROXY_SIZE),
+                                           (self.width, self.height), (width, height))
         center = (
             parse_dimension(center[0], self.width),
             parse_dimension(center[1], self.height)
         )
-        self._pil_image = self._pil_image.crop(
-            get_box_dimensions(
-                width, height,
-                self.width, self.height,
-                center=center,
-            )
-        )
+        self._add_operation(('crop', get_box_dimensions(
+            width, height,
+            self.width, self.height,
+            center=center,
+        )))
+
+    def get_hash(self, method='phash'):
+        """Returns a perceptual hash of the image with pending operations
+        applied: "ahash", "dhash" or "phash" (requires numpy). Computed
+        from a small proxy, see da_vinci.hashing."""
+        if method not in hashing.METHODS:
+            raise ValueError('Method must be one of %s, not "%s"'
+                             % (', '.join(hashing.METHODS), method))
+        return hashing.get_hash(self._get_proxy(hashing.PROXY_SIZE), method)
+
+    def get_blurhash(self, components=placeholders.BLURHASH_COMPONENTS):
+        """Returns the image's BlurHash, with (x, y) components. Requires
+        numpy, see da_vinci.placeholders."""
+        return placeholders.get_blurhash(self._get_proxy(placeholders.PROXY_SIZE),
+                                         components)
+
+    def get_lqip(self, size=placeholders.LQIP_SIZE, format=placeholders.LQIP_FORMAT,
+                 quality=placeholders.LQIP_QUALITY):
+        """Returns a tiny copy of the image fitting size x size as a base64
+        data URI."""
+        return placeholders.get_lqip(self._get_proxy((size, size)), size, format, quality)
+
+    def get_color(self, method='average'):
+        """Returns the image's "average" or "dominant" (red, green, blue)
+        color."""
+        proxy = self._get_proxy(placeholders.PROXY_SIZE)
+        if method == 'average':
+            return placeholders.get_average_color(proxy)
+        if method == 'dominant':
+            return placeholders.get_dominant_color(proxy)
+        raise ValueError('Method must be "average" or "dominant", not "%s"' % method)
+
+    def get_placeholders(self, lqip_size=placeholders.LQIP_SIZE, **kwargs):
+        """Returns the image's LQIP, average and dominant colors and BlurHash
+        in a dict, all computed from a single proxy. Keyword arguments are
+        passed on to placeholders.get_placeholders()."""
+        proxy = self._get_proxy((max(placeholders.PROXY_SIZE[0], lqip_size),
+                                 max(placeholders.PROXY_SIZE[1], lqip_size)))
+        return placeholders.get_placeholders(proxy, lqip_size=lqip_size, **kwargs)
+
+    def to_profile(self, profile='srgb', intent='perceptual'):
+        """Converts the image's colors to an ICC profile: "srgb", or a
+        profile as bytes, a filename or an ImageCmsProfile. "intent" is
+        "perceptual", "relative", "saturation" or "absolute". Images without
+        a profile are assumed to be sRGB. See da_vinci.color."""
+        if intent not in color.INTENTS:
+            raise ValueError('Intent must be one of %s, not "%s"'
+                             % (', '.join(sorted(color.INTENTS)), intent))
+        self._add_operation(('profile', color.get_profile_key(profile), intent))
 
     def adjust(self, sharpness=0, brightness=0, saturation=0, contrast=0):
         """
         Adjusts image's sharpness, brightness, saturation (color in PIL)
         and contrast. Accepted scale is from -100 to 100. (0 means unchanged).
         """
+        self._add_operation(('adjust', {
+            'sharpness': sharpness,
+            'brightness': brightness,
+            'saturation': saturation,
+            'contrast': contrast,
+        }))
+
+
+def from_file(path_or_file, **kwargs):
+    """Returns an image from a given filename or file object. Keyword
+    arguments are passed on to Image."""
+    return Image(path_or_file, **kwargs)
+
+
+def from_bytes(buffer, **kwargs):
+    """Returns an image from bytes or a buffer (bytearray, memoryview, mmap...)."""
+    return Image.from_bytes(buffer, **kwargs)
+
 
-        # Image will lose transparency info when saturation/contrast
-        # is changed, see https://github.com/jdriscoll/django-imagekit/issues/64
-        if saturation:
-            enhancer = ImageEnhance.Color(self._pil_image)
-            self._pil_image = enhancer.enhance(convert_to_pil_factor(saturation))
-        
-        if sharpness:
-            enhancer = ImageEnhance.Sharpness(self._pil_image)
-            self._pil_image = enhancer.enhance(convert_to_pil_factor(sharpness))
-        
-        if brightness:
-            enhancer = ImageEnhance.Brightness(self._pil_image)
-            self._pil_image = enhancer.enhance(convert_to_pil_factor(brightness))
-        
-        if contrast:
-            enhancer = ImageEnhance.Contrast(self._pil_image)
-            self._pil_image = enhancer.enhance(convert_to_pil_factor(contrast))
-
-
-def from_file(path_or_file):
-    """Returns an image from a given filename or file object."""
-    return Image(path_or_file)
-
-
-def from_url(url):
+def from_url(url, **kwargs):
     """Returns an image from a URL e.g: http://example.com/food.jpg."""
-    return Image(url)
+    return Image(url, **kwargs)
+
+
+def from_urls(urls, workers=8, return_exceptions=False, **kwargs):
+    """Returns images from URLs, fetched concurrently on a thread pool. If
+    "return_exceptions" is True, errors are returned in place of images
+    that failed instead of being raised."""
+    kwargs.setdefault('fetcher', get_default_fetcher())
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = [executor.submit(Image, url, **kwargs) for url in urls]
+        images = []
+        for result in results:
+            error = result.exception()
+            if error is not None and not return_exceptions:
+                for pending in results:
+                    pending.cancel()
+                raise error
+            images.append(error if error is not None else result.result())
+        return images
@@ -0,0 +1,244 @@
+"""
+Opt-in instrumentation of the work images do, including what happens
+implicitly when opening and saving them:
+
+    from da_vinci import instrumentation
+
+    with instrumentation.instrument() as collector:
+        image = Image('photo.jpg')
+        image.resize(width=300, method='fit')
+        image.save(filename='thumbnail.jpg')
+    print(collector.summary())
+
+Every operation is reported to the registered hooks as a Record, with its
+wall and CPU time, input and output dimensions, encoded bytes and the
+memory taken by the output pixels. Operations are "fetch", "open" (header
+read, including any fetch), "decode", "transpose", "rotate", "resize",
+"crop", "adjust", "profile" (color conversion), "flatten" (alpha removal
+when saving as JPEG) and "encode".
+
+Hooks are plain callables taking a Record, registered process-wide with
+add_hook() or for the duration of a block with instrument(). Collector,
+LoggingSink and StatsdSink are provided. Without hooks, nothing is
+measured.
+"""
+from __future__ import division
+
+import collections
+import contextlib
+import logging
+import socket
+import threading
+import time
+
+from PIL import ImageMode
+
+
+Record = collections.namedtuple('Record', [
+    'name', 'wall_time', 'cpu_time', 'input_size', 'output_size', 'mode',
+    'bytes', 'pixel_bytes',
+])
+
+_hooks = ()
+_lock = threading.Lock()
+
+logger = logging.getLogger('da_vinci')
+
+
+def add_hook(hook):
+    """Registers a callable that's called with a Record after every operation."""
+    global _hooks
+    with _lock:
+        _hooks = _hooks + (hook,)
+
+
+def remove_hook(hook):
+    global _hooks
+    with _lock:
+        hooks = list(_hooks)
+        hooks.remove(hook)
+        _hooks = tuple(hooks)
+
+
+def is_enabled():
+    return bool(_hooks)
+
+
+@contextlib.contextmanager
+def instrument(*hooks):
+    """Registers hooks while the block runs, a Collector if none are given.
+    Yields the first hook. Hooks are process-wide, so operations running
+    concurrently in other threads are recorded too."""
+    hooks = hooks or (Collector(),)
+    for hook in hooks:
+        add_hook(hook)
+    try:
+        yield hooks[0]
+    finally:
+        for hook in hooks:
+            remove_hook(hook)
+
+
+def get_pixel_bytes(size, mode):
+    """Returns the memory PIL allocates for pixels of an image. Images with
+    several 8 bit bands take 4 bytes per pixel, e.g. RGB."""
+    if mode in ('I', 'F'):
+        depth = 4
+    elif mode.startswith('I;16'):
+        depth = 2
+    elif len(ImageMode.getmode(mode).bands) > 1:
+        depth = 4
+    else:
+        depth = 1
+    return size[0] * size[1] * depth
+
+
+class _Measurement(object):
+
+    def __init__(self, name, pil_image, hooks):
+        self.name = name
+        self.hooks = hooks
+        self.input_size = pil_image.size if pil_image is not None else None
+        self.output = None
+        self.bytes = None
+
+    def __enter__(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_time = time.perf_counter() - self.wall_start
+        cpu_time = time.thread_time() - self.cpu_start
+        if exc_type is not None:
+            return
+        output_size = mode = pixel_bytes = None
+        if self.output is not None:
+            output_size = self.output.size
+            mode = self.output.mode
+            # Pixels of an image that's only been opened aren't allocated yet
+            if not getattr(self.output, 'tile', None):
+                pixel_bytes = get_pixel_bytes(output_size, mode)
+        record = Record(self.name, wall_time, cpu_time, self.input_size,
+                        output_size, mode, self.bytes, pixel_bytes)
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception:
+                logger.exception('Instrumentation hook %r failed', hook)
+
+    def set_output(self, pil_image=None, bytes=None):
+        self.output = pil_image
+        self.bytes = bytes
+
+
+class _NullMeasurement(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def set_output(self, pil_image=None, bytes=None):
+        pass
+
+
+_null_measurement = _NullMeasurement()
+
+
+def measure(name, pil_image=None):
+    """Returns a context manager timing the operation run inside it:
+
+        with measure('resize', pil_image) as measurement:
+            pil_image = pil_image.resize(size)
+            measurement.set_output(pil_image)
+    """
+    hooks = _hooks
+    if not hooks:
+        return _null_measurement
+    return _Measurement(name, pil_image, hooks)
+
+
+class Collector(object):
+    """Keeps records, and sums them up per operation."""
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def clear(self):
+        with self._lock:
+            self.records = []
+
+    def summary(self):
+        """Returns a dict of totals per operation name: count, wall_time,
+        cpu_time, bytes, max_pixel_bytes and pixels (of outputs)."""
+        summary = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            totals = summary.setdefault(record.name, {
+                'count': 0, 'wall_time': 0, 'cpu_time': 0, 'bytes': 0,
+                'pixels': 0, 'max_pixel_bytes': 0,
+            })
+            totals['count'] += 1
+            totals['wall_time'] += record.wall_time
+            totals['cpu_time'] += record.cpu_time
+            totals['bytes'] += record.bytes or 0
+            if record.output_size is not None:
+                totals['pixels'] += record.output_size[0] * record.output_size[1]
+            totals['max_pixel_bytes'] = max(totals['max_pixel_bytes'],
+                                            record.pixel_bytes or 0)
+        return summary
+
+
+class LoggingSink(object):
+
+    def __init__(self, logger=logger, level=logging.DEBUG):
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, record):
+        self.logger.log(
+            self.level, '%s %s -> %s %s: %.2f ms wall, %.2f ms cpu, %s bytes',
+            record.name, record.input_size, record.output_size, record.mode,
+            record.wall_time * 1000, record.cpu_time * 1000, record.bytes)
+
+
+class StatsdSink(object):
+    """Sends timings and counts to a StatsD server over UDP, e.g.
+    "da_vinci.resize.wall_time:12.5|ms"."""
+
+    def __init__(self, host='localhost', port=8125, prefix='da_vinci'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def get_metrics(self, record):
+        name = '%s.%s' % (self.prefix, record.name) if self.prefix else record.name
+        metrics = [
+            '%s.count:1|c' % name,
+            '%s.wall_time:%.3f|ms' % (name, record.wall_time * 1000),
+            '%s.cpu_time:%.3f|ms' % (name, record.cpu_time * 1000),
+        ]
+        if record.bytes is not None:
+            metrics.append('%s.bytes:%d|h' % (name, record.bytes))
+        if record.pixel_bytes is not None:
+            metrics.append('%s.pixel_bytes:%d|h' % (name, record.pixel_bytes))
+        return metrics
+
+    def __call__(self, record):
+        data = '\n'.join(self.get_metrics(record)).encode('utf-8')
+        try:
+            self._socket.sendto(data, self.address)
+        except (IOError, OSError):
+            # Metrics are best effort
+            pass
+
+    def close(self):
+        self._socket.close()
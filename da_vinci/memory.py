@@ -0,0 +1,275 @@
+"""
+Memory estimates and admission control. Decoding a 100MP image takes
+400MB before any operation runs, so a few large images processed at once
+can exhaust a worker's memory. A process-wide budget makes work wait until
+its estimated memory fits instead:
+
+    from da_vinci import memory
+
+    memory.set_default_budget(memory.MemoryBudget(
+        max_bytes=2 * 1024 ** 3, max_pixels=100 * 1000 * 1000, timeout=30))
+
+    image = Image('upload.jpg')      # ImageTooLarge past max_pixels
+    image.resize(width=1200, method='fit')
+    image.estimate_memory()          # Peak bytes, from the header only
+    image.save(filename='large.jpg') # Waits until the estimate fits
+
+Estimates are computed from the image header and the pending operations,
+before anything is decoded: the decoded size (JPEGs decoded at a reduced
+scale for downscales, only the needed rows of uncompressed images), then
+every step's input and output, adjustments' intermediate image and
+flattening before encoding to JPEG. They count pixels only, at Pillow's
+storage size (4 bytes per pixel for RGB).
+
+Images reserve their estimate from the budget while their operations are
+applied and while they're encoded, and release it when done. Reservations
+are granted in arrival order, so large images aren't starved by smaller
+ones. Work that can't fit in the budget at all raises ImageTooLarge, work
+that waits longer than "timeout" or finds "max_queued" reservations
+already waiting raises BudgetExceeded.
+
+Budgets can be pickled, e.g. passed to a process pool: every process gets
+one copy of the budget with the same limits, shared by the work it runs.
+"""
+from __future__ import division
+
+import collections
+import contextlib
+import math
+import os
+import threading
+import time
+import weakref
+
+from . import animation, pipeline, tiles
+
+
+# Bytes Pillow stores per pixel, 4 for other modes
+BYTES_PER_PIXEL = {
+    '1': 1,
+    'L': 1,
+    'P': 1,
+    'I;16': 2,
+    'I;16L': 2,
+    'I;16B': 2,
+    'I;16N': 2,
+}
+
+# Images a step holds at once besides its input
+STEP_COPIES = {
+    # The fused adjustments run in up to two passes
+    'adjust': 2,
+}
+
+# Copies of the image encoders make, JPEG and PNG encoders work a row at a
+# time. WebP's converts the image to ARGB, then YUV
+ENCODE_COPIES = {
+    'WEBP': 2,
+}
+
+JPEG_SCALES = (8, 4, 2, 1)
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def check_pixels(size, max_pixels):
+    """Raises ImageTooLarge if an image of `size` has more than max_pixels
+    pixels, unless max_pixels is None."""
+    if max_pixels is not None and size[0] * size[1] > max_pixels:
+        raise ImageTooLarge('Image of %dx%d pixels is larger than the limit of %d pixels'
+                            % (size[0], size[1], max_pixels))
+
+
+def get_bytes(size, mode):
+    return size[0] * size[1] * BYTES_PER_PIXEL.get(mode, 4)
+
+
+def get_encoding_bytes(size, mode, format):
+    """Returns the bytes encoding an image in `format` takes besides the
+    image itself."""
+    if mode in ('RGBA', 'LA', 'PA') and format == 'JPEG':
+        # The flattened copy and the alpha band
+        return get_bytes(size, mode) + get_bytes(size, 'L')
+    return ENCODE_COPIES.get(format, 0) * get_bytes(size, mode)
+
+
+def get_decoded_size(pil_image, steps):
+    """Returns the size the first step will decode a not yet loaded image
+    at, which may be smaller than the image (see pipeline.draft() and
+    pipeline.decode())."""
+    size = pil_image.size
+    if not steps or pipeline.is_loaded(pil_image):
+        return size
+    step = steps[0]
+    requested_size = pipeline.get_draft_size(pil_image, steps)
+    if requested_size is not None and pil_image.format == 'JPEG':
+        # Same scale as Pillow's JpegImageFile.draft()
+        scale = min(size[0] // requested_size[0], size[1] // requested_size[1])
+        scale = next(value for value in JPEG_SCALES if scale >= value)
+        return (int(math.ceil(size[0] / scale)), int(math.ceil(size[1] / scale)))
+    if step[0] in ('crop', 'resize') and tiles.can_read_rows(pil_image):
+        box = step[1] if step[0] == 'crop' else step[2] or (0, 0) + size
+        return (int(math.ceil(box[2] - box[0])), int(math.ceil(box[3] - box[1])))
+    return size
+
+
+def get_step_size(step, size):
+    name = step[0]
+    if name == 'resize':
+        return step[1]
+    if name == 'crop':
+        return (step[1][2] - step[1][0], step[1][3] - step[1][1])
+    if name == 'transpose':
+        return pipeline.transpose_size(size, step[1])
+    return size
+
+
+def estimate(pil_image, operations, format=None):
+    """Returns the peak bytes of pixels held at once while `operations` are
+    applied to an image, and while it's encoded in `format` if given."""
+    mode = pil_image.mode
+    steps = pipeline.plan(operations, pil_image.size)
+    if animation.is_animated(pil_image):
+        # Frames are transformed one at a time: the composited source
+        # frame, its transformed copy, and every encoded GIF frame
+        frame = get_bytes(pil_image.size, 'RGBA')
+        size = pil_image.size
+        for step in steps:
+            size = get_step_size(step, size)
+        frames = pil_image.n_frames if format == 'GIF' else 2
+        return 2 * frame + frames * get_bytes(size, 'RGBA')
+
+    size = get_decoded_size(pil_image, steps)
+    peak = current = get_bytes(size, mode)
+    for step in steps:
+        input_size, size = size, get_step_size(step, size)
+        output = get_bytes(size, mode)
+        if step[0] == 'resize':
+            # Resampling runs horizontally first, into an image as wide as
+            # the output and as high as the input
+            peak = max(peak, current + get_bytes((size[0], input_size[1]), mode) + output)
+        peak = max(peak, current + STEP_COPIES.get(step[0], 1) * output)
+        current = output
+    return max(peak, current + get_encoding_bytes(size, mode, format))
+
+
+# Budgets of this process by key, so an unpickled budget is created once per
+# process
+_budgets = weakref.WeakValueDictionary()
+_budgets_lock = threading.Lock()
+
+
+def _get_budget(key, max_bytes, max_pixels, timeout, max_queued):
+    with _budgets_lock:
+        budget = _budgets.get(key)
+        if budget is None:
+            budget = MemoryBudget(max_bytes, max_pixels, timeout, max_queued)
+            budget._key = key
+            _budgets[key] = budget
+    return budget
+
+
+class MemoryBudget(object):
+    """Bytes shared by the work of a process. Images reserve their
+    estimated memory before decoding.
+
+    - max_bytes: bytes that can be reserved at once
+    - max_pixels: largest image accepted, in pixels. Checked when images
+      are opened, from their header
+    - timeout: seconds a reservation waits for memory before raising
+      BudgetExceeded, waits indefinitely by default. 0 never waits
+    - max_queued: reservations allowed to wait at once, unlimited by default
+    """
+
+    def __init__(self, max_bytes, max_pixels=None, timeout=None, max_queued=None):
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.timeout = timeout
+        self.max_queued = max_queued
+        self.reserved = 0
+        self._waiting = collections.deque()
+        self._condition = threading.Condition()
+        self._key = None
+
+    def __reduce__(self):
+        # Reservations and waiters are local to a process, only the limits
+        # are sent
+        with _budgets_lock:
+            if self._key is None:
+                self._key = os.urandom(16).hex()
+                _budgets[self._key] = self
+        return (_get_budget, (self._key, self.max_bytes, self.max_pixels,
+                              self.timeout, self.max_queued))
+
+    @property
+    def available(self):
+        return self.max_bytes - self.reserved
+
+    @property
+    def queued(self):
+        return len(self._waiting)
+
+    def acquire(self, nbytes, timeout=None):
+        """Reserves `nbytes`, waiting for earlier reservations to be
+        released if they don't fit. `timeout` defaults to the budget's."""
+        if nbytes > self.max_bytes:
+            raise ImageTooLarge('%d bytes needed, the budget is %d bytes'
+                                % (nbytes, self.max_bytes))
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            if not self._waiting and self.reserved + nbytes <= self.max_bytes:
+                self.reserved += nbytes
+                return
+            if self.max_queued is not None and len(self._waiting) >= self.max_queued:
+                raise BudgetExceeded('%d reservations are already waiting' % len(self._waiting))
+            ticket = object()
+            self._waiting.append(ticket)
+            try:
+                while self._waiting[0] is not ticket or \
+                        self.reserved + nbytes > self.max_bytes:
+                    remaining = deadline - time.monotonic() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        raise BudgetExceeded('%d bytes not available after %ss'
+                                             % (nbytes, timeout))
+                    self._condition.wait(remaining)
+                self.reserved += nbytes
+            finally:
+                self._waiting.remove(ticket)
+                # The next reservation may fit now
+                self._condition.notify_all()
+
+    def release(self, nbytes):
+        with self._condition:
+            self.reserved -= nbytes
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes, timeout=None):
+        """Reserves `nbytes` for the duration of the block."""
+        self.acquire(nbytes, timeout)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+
+_default_budget = None
+
+
+def get_default_budget():
+    """Returns the process-wide budget images reserve memory from, None if
+    there's none."""
+    return _default_budget
+
+
+def set_default_budget(budget):
+    """Sets the process-wide budget, None removes it."""
+    global _default_budget
+    _default_budget = budget
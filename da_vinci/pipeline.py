@@ -0,0 +1,454 @@
+from __future__ import division
+
+import math
+
+from PIL import Image as PILImage
+
+from . import color, enhance, tiles
+from .instrumentation import measure
+
+
+try:
+    RESAMPLE = PILImage.ANTIALIAS
+except AttributeError:
+    RESAMPLE = PILImage.LANCZOS
+
+# Large downscales are first done by integer reduction (see PIL's
+# image.reduce()) down to this many times the target size. At 3 the result
+# is indistinguishable from a single pass.
+REDUCING_GAP = 3.0
+
+# JPEGs are DCT scaled by the decoder (see PIL's image.draft()) down to no
+# less than this many times the target size.
+DRAFT_REDUCING_GAP = 2.0
+
+# Resampling strategies, as (filter, reducing gap, draft reducing gap).
+# Large downscales first average blocks of pixels (box filter) down to
+# "reducing gap" times the target size, then resample the rest:
+# - "fastest" reduces down to about the target size, then resamples
+#   bilinearly. Around 2.5 times faster than "best" for large downscales,
+#   slightly blurrier and may show moire on fine patterns
+# - "balanced" reduces down to twice the target size, then resamples with
+#   a bicubic filter. Around 1.5 times faster than "best", hardly
+#   distinguishable from it
+# - "best" reduces down to 3 times the target size, then resamples with
+#   Lanczos, the sharpest filter
+# A PIL filter (e.g. PIL.Image.BICUBIC) resamples in a single pass, which
+# is much slower for large downscales.
+RESAMPLING = {
+    'fastest': (PILImage.BILINEAR, 1.0, 1.0),
+    'balanced': (PILImage.BICUBIC, 2.0, DRAFT_REDUCING_GAP),
+    'best': (RESAMPLE, REDUCING_GAP, DRAFT_REDUCING_GAP),
+}
+DEFAULT_RESAMPLING = 'best'
+
+FILTERS = (PILImage.NEAREST, PILImage.BOX, PILImage.BILINEAR,
+           PILImage.HAMMING, PILImage.BICUBIC, PILImage.LANCZOS)
+
+# Uncompressed images of at least this many pixels are resized a strip of
+# STRIP_ROWS source rows at a time, so they're never decoded whole
+STRIP_MIN_PIXELS = 4096 * 4096
+STRIP_ROWS = 512
+
+# Lanczos, the widest filter, reaches 3 pixels around each sample
+FILTER_SUPPORT = 3
+
+ORIENTATION_TAG = 0x0112
+
+# Maps EXIF orientation to the transposition that undoes it
+ORIENTATION_TRANSPOSES = {
+    2: PILImage.FLIP_LEFT_RIGHT,
+    3: PILImage.ROTATE_180,
+    4: PILImage.FLIP_TOP_BOTTOM,
+    5: PILImage.TRANSPOSE,
+    6: PILImage.ROTATE_270,
+    7: PILImage.TRANSVERSE,
+    8: PILImage.ROTATE_90,
+}
+
+# Each transposition is described by the 2x2 matrix (a, b, c, d) it applies
+# to pixel coordinates relative to the image center:
+#     x' = a * x + b * y
+#     y' = c * x + d * y
+# None is the identity.
+TRANSPOSE_MATRICES = {
+    None: (1, 0, 0, 1),
+    PILImage.FLIP_LEFT_RIGHT: (-1, 0, 0, 1),
+    PILImage.FLIP_TOP_BOTTOM: (1, 0, 0, -1),
+    PILImage.ROTATE_90: (0, 1, -1, 0),
+    PILImage.ROTATE_180: (-1, 0, 0, -1),
+    PILImage.ROTATE_270: (0, -1, 1, 0),
+    PILImage.TRANSPOSE: (0, 1, 1, 0),
+    PILImage.TRANSVERSE: (0, -1, -1, 0),
+}
+
+MATRIX_TRANSPOSES = dict(
+    (matrix, method) for method, matrix in TRANSPOSE_MATRICES.items()
+)
+
+
+def compose_transposes(first, second):
+    """Returns the single transposition equivalent to applying `first`
+    and then `second`."""
+    a1, b1, c1, d1 = TRANSPOSE_MATRICES[first]
+    a2, b2, c2, d2 = TRANSPOSE_MATRICES[second]
+    return MATRIX_TRANSPOSES[(
+        a2 * a1 + b2 * c1, a2 * b1 + b2 * d1,
+        c2 * a1 + d2 * c1, c2 * b1 + d2 * d1,
+    )]
+
+
+def swaps_axes(method):
+    return TRANSPOSE_MATRICES[method][0] == 0
+
+
+def transpose_size(size, method):
+    if swaps_axes(method):
+        return (size[1], size[0])
+    return size
+
+
+def untranspose_box(box, method, size):
+    """Maps a box given in the coordinates of a transposed image back to the
+    coordinates of the original image. `size` is the original image size."""
+    a, b, c, d = TRANSPOSE_MATRICES[method]
+    transposed_size = transpose_size(size, method)
+    corners = []
+    for x, y in ((box[0], box[1]), (box[2], box[3])):
+        x = x - transposed_size[0] / 2
+        y = y - transposed_size[1] / 2
+        # Transposition matrices are orthogonal, the inverse is the transpose
+        corners.append((a * x + c * y + size[0] / 2,
+                        b * x + d * y + size[1] / 2))
+    return (min(corners[0][0], corners[1][0]), min(corners[0][1], corners[1][1]),
+            max(corners[0][0], corners[1][0]), max(corners[0][1], corners[1][1]))
+
+
+def get_rotation_transpose(degrees, size):
+    """Returns the transposition equivalent to PIL's image.rotate(degrees)
+    (without expand), None for a no-op or False if there's none."""
+    degrees = degrees % 360
+    if degrees == 0:
+        return None
+    if degrees == 180:
+        return PILImage.ROTATE_180
+    if degrees in (90, 270) and size[0] == size[1]:
+        return PILImage.ROTATE_90 if degrees == 90 else PILImage.ROTATE_270
+    return False
+
+
+def get_orientation_transpose(pil_image):
+    """Returns the transposition needed to display an image upright, according
+    to its EXIF orientation. This only reads the header."""
+    # PIL decodes PNGs to look for EXIF data that comes after the pixels
+    if pil_image.format == 'PNG' and 'exif' not in pil_image.info:
+        return None
+    return ORIENTATION_TRANSPOSES.get(
+        pil_image.getexif().get(ORIENTATION_TAG, 1))
+
+
+def remove_orientation(pil_image):
+    """Removes EXIF orientation once the image has been transposed upright,
+    like PIL's ImageOps.exif_transpose() does."""
+    exif = pil_image.getexif()
+    if ORIENTATION_TAG in exif:
+        del exif[ORIENTATION_TAG]
+        if 'exif' in pil_image.info:
+            pil_image.info['exif'] = exif.tobytes()
+
+
+def is_loaded(pil_image):
+    return not getattr(pil_image, 'tile', None)
+
+
+def get_resampling(resample):
+    """Returns (filter, reducing gap, draft reducing gap) for a resampling
+    strategy name or a PIL filter."""
+    if resample is None:
+        resample = DEFAULT_RESAMPLING
+    if resample in RESAMPLING:
+        return RESAMPLING[resample]
+    if resample in FILTERS:
+        return (resample, None, DRAFT_REDUCING_GAP)
+    raise ValueError('Resample must be one of %s or a PIL filter, not %r'
+                     % (', '.join(sorted(RESAMPLING)), resample))
+
+
+def get_step_resample(step):
+    """Resize operations and steps only carry a resampling strategy if it
+    isn't the default."""
+    return step[3] if step[0] == 'resize' and len(step) > 3 else None
+
+
+def get_operation_size(operation, size):
+    """Returns image size after `operation` is applied to an image of `size`."""
+    name = operation[0]
+    if name == 'transpose':
+        return transpose_size(size, operation[1])
+    if name == 'resize':
+        return operation[1]
+    if name == 'crop':
+        box = operation[1]
+        return (box[2] - box[0], box[3] - box[1])
+    return size
+
+
+def _is_integral(value):
+    return abs(value - round(value)) < 1e-9
+
+
+class _Region(object):
+    """Accumulates crops and resizes into a single source box and output
+    size, which is executed as one resample (or one crop)."""
+
+    def __init__(self, size):
+        self.source_size = size
+        self.box = (0, 0, size[0], size[1])
+        self.size = size
+        self.resample = None
+
+    def contains(self, box):
+        return (0 <= box[0] < box[2] <= self.size[0] and
+                0 <= box[1] < box[3] <= self.size[1])
+
+    def crop(self, box):
+        scale_x = (self.box[2] - self.box[0]) / self.size[0]
+        scale_y = (self.box[3] - self.box[1]) / self.size[1]
+        self.box = (
+            self.box[0] + box[0] * scale_x, self.box[1] + box[1] * scale_y,
+            self.box[0] + box[2] * scale_x, self.box[1] + box[3] * scale_y,
+        )
+        self.size = (int(round(box[2] - box[0])), int(round(box[3] - box[1])))
+
+    def resize(self, size, resample=None):
+        # Only one resample runs, with the strategy of the last resize
+        self.size = size
+        self.resample = resample
+
+    def get_steps(self):
+        box_size = (self.box[2] - self.box[0], self.box[3] - self.box[1])
+        if self.size == box_size and all(_is_integral(v) for v in self.box):
+            box = tuple(int(round(v)) for v in self.box)
+            if box == (0, 0) + tuple(self.source_size):
+                return []
+            return [('crop', box)]
+        box = (max(self.box[0], 0), max(self.box[1], 0),
+               min(self.box[2], self.source_size[0]),
+               min(self.box[3], self.source_size[1]))
+        if self.resample is not None:
+            return [('resize', self.size, box, self.resample)]
+        return [('resize', self.size, box)]
+
+
+def plan(operations, size):
+    """Turns recorded operations into an equivalent list of steps to run on
+    an image of `size`:
+    - successive flips and rotations by multiples of 90 degrees are folded
+      into a single transposition, which is moved past crops, resizes and
+      adjustments so it runs on the smallest possible image
+    - crops and resizes are merged into one resample of a source region,
+      i.e. a crop always happens before a resize and consecutive resizes
+      only resample once
+    """
+    steps = []
+    region = _Region(size)
+    method = None
+
+    for operation in operations:
+        name = operation[0]
+        current_size = transpose_size(region.size, method)
+
+        if name == 'rotate':
+            rotation = get_rotation_transpose(operation[1], current_size)
+            if rotation is not False:
+                operation = ('transpose', rotation)
+                name = 'transpose'
+
+        if name == 'transpose':
+            if operation[1] is not None:
+                method = compose_transposes(method, operation[1])
+        elif name == 'resize':
+            region.resize(transpose_size(operation[1], method),
+                          operation[2] if len(operation) > 2 else None)
+        elif name == 'crop':
+            box = untranspose_box(operation[1], method, region.size)
+            if region.contains(box):
+                region.crop(box)
+            else:
+                # Crop extends beyond the image, let PIL pad it
+                steps.extend(region.get_steps())
+                steps.append(('crop', tuple(int(round(v)) for v in box)))
+                region = _Region((int(round(box[2] - box[0])),
+                                  int(round(box[3] - box[1]))))
+        elif name in ('adjust', 'profile'):
+            # Adjustments and color conversions are unaffected by
+            # transpositions, so those can still be deferred
+            steps.extend(region.get_steps())
+            steps.append(operation)
+            region = _Region(region.size)
+        else:
+            steps.extend(region.get_steps())
+            if method is not None:
+                steps.append(('transpose', method))
+            steps.append(operation)
+            region = _Region(current_size)
+            method = None
+
+    steps.extend(region.get_steps())
+    if method is not None:
+        steps.append(('transpose', method))
+    return steps
+
+
+def get_draft_size(pil_image, steps):
+    """Returns the size to ask the decoder of a not yet loaded image for, if
+    the first step is a large enough downscale, None otherwise."""
+    if not steps or steps[0][0] != 'resize' or is_loaded(pil_image):
+        return None
+    size, box = steps[0][1], steps[0][2]
+    reducing_gap = get_resampling(get_step_resample(steps[0]))[2]
+    original_size = pil_image.size
+    requested_size = (
+        int(math.ceil(original_size[0] * size[0] * reducing_gap / (box[2] - box[0]))),
+        int(math.ceil(original_size[1] * size[1] * reducing_gap / (box[3] - box[1]))),
+    )
+    if requested_size[0] * 2 > original_size[0] or requested_size[1] * 2 > original_size[1]:
+        return None
+    return requested_size
+
+
+def draft(pil_image, steps):
+    """Asks the decoder of a not yet loaded image to scale it down if the
+    first step is a large enough downscale (currently only JPEG supports
+    this). Returns the steps, adjusted to the drafted image."""
+    requested_size = get_draft_size(pil_image, steps)
+    if requested_size is None:
+        return steps
+    size, box = steps[0][1], steps[0][2]
+    original_size = pil_image.size
+    result = pil_image.draft(None, requested_size)
+    if result is None or pil_image.size == original_size:
+        return steps
+    scale_x = result[1][2] / original_size[0]
+    scale_y = result[1][3] / original_size[1]
+    box = (box[0] * scale_x, box[1] * scale_y, box[2] * scale_x, box[3] * scale_y)
+    return [('resize', size, box) + steps[0][3:]] + steps[1:]
+
+
+def resize(pil_image, size, box=None, resample=None):
+    """Resizes with a resampling strategy (see RESAMPLING) or PIL filter."""
+    resample, reducing_gap = get_resampling(resample)[:2]
+    return pil_image.resize(size, resample=resample, box=box,
+                            reducing_gap=reducing_gap)
+
+
+def needs_flattening(pil_image, format):
+    return pil_image.mode in ('RGBA', 'LA', 'PA') and format == 'JPEG'
+
+
+def flatten(pil_image, fill_color):
+    """Returns the image without alpha, filled with a fixed background color
+    where it's transparent."""
+    with measure('flatten', pil_image) as measurement:
+        flattened = PILImage.new(pil_image.mode[:-1], pil_image.size, fill_color)
+        # Only the alpha band is extracted, split() would copy every band
+        flattened.paste(pil_image, pil_image.getchannel('A'))
+        # Keeps the ICC profile
+        flattened.info = pil_image.info.copy()
+        measurement.set_output(flattened)
+    return flattened
+
+
+def load(pil_image):
+    """Decodes the pixels of an image if that hasn't happened yet."""
+    if not is_loaded(pil_image):
+        with measure('decode', pil_image) as measurement:
+            pil_image.load()
+            measurement.set_output(pil_image)
+    return pil_image
+
+
+def get_margin(scale):
+    """Returns how many source pixels around a resampled box affect it."""
+    return int(math.ceil(FILTER_SUPPORT * max(scale, 1))) + 2
+
+
+def resize_in_strips(pil_image, size, box, resample=None):
+    """Resizes a region of an uncompressed image that hasn't been loaded, a
+    strip at a time. Each strip is read with enough rows around it for the
+    resampling filter, so strips join seamlessly."""
+    scale_x = (box[2] - box[0]) / size[0]
+    scale_y = (box[3] - box[1]) / size[1]
+    margin_x = get_margin(scale_x)
+    margin_y = get_margin(scale_y)
+    rows = max(int(STRIP_ROWS / scale_y), 1)
+    output = None
+    for top in range(0, size[1], rows):
+        bottom = min(top + rows, size[1])
+        source_top = box[1] + top * scale_y
+        source_bottom = box[1] + bottom * scale_y
+        region, (x, y) = tiles.decode_region(pil_image, (
+            box[0] - margin_x, source_top - margin_y,
+            box[2] + margin_x, source_bottom + margin_y))
+        strip = resize(region, (size[0], bottom - top), box=(
+            box[0] - x, source_top - y, box[2] - x, source_bottom - y),
+            resample=resample)
+        if output is None:
+            output = PILImage.new(strip.mode, size)
+            output.info = strip.info.copy()
+            if strip.palette is not None:
+                output.palette = strip.palette.copy()
+        output.paste(strip, (0, top))
+    return output
+
+
+def decode(pil_image, steps):
+    """Decodes an image that hasn't been loaded yet, only the region the
+    first step needs if the format allows it (see da_vinci.tiles). Returns
+    the decoded image and the steps, adjusted to it."""
+    if not steps or is_loaded(pil_image):
+        return pil_image, steps
+    step = steps[0]
+    if step[0] == 'crop':
+        box = step[1]
+        region, (x, y) = tiles.decode_region(pil_image, box)
+        box = (box[0] - x, box[1] - y, box[2] - x, box[3] - y)
+        return region, [('crop', box)] + steps[1:]
+    if step[0] == 'resize':
+        size = step[1]
+        box = step[2] or (0, 0) + pil_image.size
+        if (tiles.can_read_rows(pil_image) and
+                (box[2] - box[0]) * (box[3] - box[1]) >= STRIP_MIN_PIXELS):
+            return resize_in_strips(pil_image, size, box,
+                                    get_step_resample(step)), steps[1:]
+        margin_x = get_margin((box[2] - box[0]) / size[0])
+        margin_y = get_margin((box[3] - box[1]) / size[1])
+        region, (x, y) = tiles.decode_region(pil_image, (
+            box[0] - margin_x, box[1] - margin_y, box[2] + margin_x, box[3] + margin_y))
+        box = (box[0] - x, box[1] - y, box[2] - x, box[3] - y)
+        return region, [('resize', size, box) + step[3:]] + steps[1:]
+    return load(pil_image), steps
+
+
+def run(pil_image, steps):
+    """Runs planned steps on a PIL image, returns the resulting image."""
+    # Decoded on its own, so it's measured apart from the first step
+    pil_image, steps = decode(pil_image, steps)
+    for step in steps:
+        name = step[0]
+        with measure(name, pil_image) as measurement:
+            if name == 'transpose':
+                pil_image = pil_image.transpose(step[1])
+            elif name == 'rotate':
+                pil_image = pil_image.rotate(step[1])
+            elif name == 'resize':
+                pil_image = resize(pil_image, step[1], box=step[2],
+                                   resample=get_step_resample(step))
+            elif name == 'crop':
+                pil_image = pil_image.crop(step[1])
+            elif name == 'adjust':
+                pil_image = enhance.adjust(pil_image, **step[1])
+            elif name == 'profile':
+                pil_image = color.convert(pil_image, step[1], step[2])
+            measurement.set_output(pil_image)
+    return pil_image
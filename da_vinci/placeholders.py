@@ -0,0 +1,169 @@
+"""
+Placeholders shown while an image loads: a BlurHash string, a tiny base64
+encoded image (LQIP) and the image's average or dominant color.
+
+    placeholders = image.get_placeholders()
+    # {'blurhash': 'LEHV6nWB2yk8...', 'lqip': 'data:image/webp;base64,...',
+    #  'average_color': (104, 98, 87), 'dominant_color': (38, 41, 33)}
+
+They're all computed from one small proxy of the image, decoded at a
+reduced scale where the format allows it (see Image._get_proxy), so their
+cost barely depends on the source's resolution. Getting placeholders from
+the smallest of an image's renditions reuses its decoded pixels instead:
+
+    thumbnail = image.renditions([(1200, None, 'fit'), (300, None, 'fit')])[-1]
+    placeholders = thumbnail.get_placeholders()
+
+The BlurHash components are computed at once with NumPy, which is required
+for BlurHashes.
+"""
+from __future__ import division
+
+import base64
+
+from PIL import Image as PILImage
+
+from . import formats, pipeline
+from .compat import numpy
+from .quality import encode
+
+
+PROXY_SIZE = (32, 32)
+BLURHASH_COMPONENTS = (4, 3)
+LQIP_SIZE = 16
+LQIP_FORMAT = 'WEBP'
+LQIP_QUALITY = 40
+# Colors the image is reduced to, to find the dominant one
+DOMINANT_COLORS = 8
+
+BASE83 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+
+
+def _to_rgb(pil_image):
+    """Returns the image in RGB and its alpha band, None if it has none."""
+    alpha = None
+    if pil_image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in pil_image.info:
+        pil_image = pil_image.convert('RGBA')
+        alpha = pil_image.getchannel('A')
+    if pil_image.mode != 'RGB':
+        pil_image = pil_image.convert('RGB')
+    return pil_image, alpha
+
+
+def _encode_base83(value, length):
+    return ''.join(BASE83[(value // 83 ** (length - 1 - position)) % 83]
+                   for position in range(length))
+
+
+def _to_srgb(value):
+    value = min(max(value, 0.0), 1.0)
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _get_linear_table():
+    values = numpy.arange(256) / 255
+    return numpy.where(values <= 0.04045, values / 12.92,
+                       ((values + 0.055) / 1.055) ** 2.4)
+
+
+def get_blurhash(pil_image, components=BLURHASH_COMPONENTS):
+    """Returns the BlurHash of a (small) image, with `components` (x, y)
+    components from 1 to 9 each."""
+    if numpy is None:
+        raise ImportError('BlurHashes require numpy')
+    x_components, y_components = components
+    if not (1 <= x_components <= 9 and 1 <= y_components <= 9):
+        raise ValueError('BlurHash components must be from 1 to 9, not %r' % (components,))
+    rgb, alpha = _to_rgb(pil_image)
+    width, height = rgb.size
+    pixels = _get_linear_table()[numpy.asarray(rgb)]
+
+    # Every component is the image's pixels weighted by a cosine along x and
+    # another one along y, all of them are computed at once
+    cosines_x = numpy.cos(numpy.pi * numpy.outer(numpy.arange(x_components),
+                                                 numpy.arange(width)) / width)
+    cosines_y = numpy.cos(numpy.pi * numpy.outer(numpy.arange(y_components),
+                                                 numpy.arange(height)) / height)
+    factors = numpy.einsum('jy,yxc,ix->jic', cosines_y, pixels, cosines_x)
+    factors *= 2 / (width * height)
+    factors[0, 0] /= 2
+    factors = factors.reshape(-1, 3)
+    dc, ac = factors[0], factors[1:]
+
+    blurhash = _encode_base83((x_components - 1) + (y_components - 1) * 9, 1)
+    if len(ac):
+        quantized_maximum = int(max(0, min(82, numpy.floor(numpy.abs(ac).max() * 166 - 0.5))))
+        maximum = (quantized_maximum + 1) / 166
+    else:
+        quantized_maximum = 0
+        maximum = 1
+    blurhash += _encode_base83(quantized_maximum, 1)
+    blurhash += _encode_base83(
+        (_to_srgb(dc[0]) << 16) + (_to_srgb(dc[1]) << 8) + _to_srgb(dc[2]), 4)
+    if len(ac):
+        scaled = ac / maximum
+        quantized = numpy.clip(numpy.floor(
+            numpy.sign(scaled) * numpy.sqrt(numpy.abs(scaled)) * 9 + 9.5), 0, 18).astype(int)
+        for red, green, blue in quantized:
+            blurhash += _encode_base83(red * 19 * 19 + green * 19 + blue, 2)
+    return blurhash
+
+
+def get_lqip(pil_image, size=LQIP_SIZE, format=LQIP_FORMAT, quality=LQIP_QUALITY):
+    """Returns a copy of the image fitting size x size, encoded as a data
+    URI."""
+    format = formats.MAPPING.get(format.lower(), format.upper())
+    scale = min(size / pil_image.width, size / pil_image.height, 1)
+    target = (max(int(round(pil_image.width * scale)), 1),
+              max(int(round(pil_image.height * scale)), 1))
+    if pil_image.mode not in ('RGB', 'RGBA', 'L'):
+        pil_image = pil_image.convert('RGBA' if 'A' in pil_image.getbands() or
+                                      'transparency' in pil_image.info else 'RGB')
+    if pil_image.size != target:
+        pil_image = pipeline.resize(pil_image, target, resample='balanced')
+    if pipeline.needs_flattening(pil_image, format):
+        pil_image = pipeline.flatten(pil_image, (255, 255, 255))
+    data = encode(pil_image, format, quality=quality)
+    return 'data:%s;base64,%s' % (PILImage.MIME[format],
+                                  base64.b64encode(data).decode('ascii'))
+
+
+def get_average_color(pil_image):
+    """Returns the average (red, green, blue) of the image's opaque
+    pixels."""
+    rgb, alpha = _to_rgb(pil_image)
+    histograms = rgb.histogram(mask=alpha)
+    averages = []
+    for band in range(3):
+        histogram = histograms[band * 256:(band + 1) * 256]
+        count = sum(histogram)
+        total = sum(value * number for value, number in enumerate(histogram))
+        averages.append(int(round(total / count)) if count else 0)
+    return tuple(averages)
+
+
+def get_dominant_color(pil_image, colors=DOMINANT_COLORS):
+    """Returns the (red, green, blue) of the most frequent color among the
+    image's opaque pixels, once reduced to `colors` colors."""
+    rgb, alpha = _to_rgb(pil_image)
+    quantized = rgb.quantize(colors=colors, method=PILImage.Quantize.FASTOCTREE)
+    counts = quantized.histogram(mask=alpha)
+    index = max(range(len(counts)), key=counts.__getitem__)
+    return tuple(quantized.getpalette()[index * 3:index * 3 + 3])
+
+
+def get_placeholders(pil_image, blurhash_components=BLURHASH_COMPONENTS,
+                     lqip_size=LQIP_SIZE, lqip_format=LQIP_FORMAT,
+                     lqip_quality=LQIP_QUALITY):
+    """Returns the placeholders of a (small) image in a dict, with a
+    BlurHash if numpy is installed."""
+    placeholders = {
+        'lqip': get_lqip(pil_image, lqip_size, lqip_format, lqip_quality),
+        'average_color': get_average_color(pil_image),
+        'dominant_color': get_dominant_color(pil_image),
+    }
+    if numpy is not None:
+        placeholders['blurhash'] = get_blurhash(pil_image, blurhash_components)
+    return placeholders
@@ -0,0 +1,199 @@
+"""
+Chooses encoder quality, and optionally format, to meet a file size budget
+or a similarity floor instead of a fixed quality:
+
+    image.set(max_bytes=80 * 1024, candidates=('jpeg', 'webp'))
+    image.set(min_similarity=0.95)
+
+Quality is bisected, every trial is encoded in memory from the same
+decoded (and flattened) pixels. The search stops once the encoded size is
+within TOLERANCE of max_bytes, or after max_trials encodes per format.
+With min_similarity, the lowest quality that's similar enough is chosen,
+as long as it fits max_bytes. Among candidate formats, the smallest
+output meeting the constraints wins. If none does, the smallest output
+(with max_bytes) or the most similar one is used.
+
+Similarity is SSIM, from 0 to 1, computed on grayscale proxies of at most
+PROXY_SIZE. It requires numpy. Downscaling hides fine compression
+artifacts, so useful floors are typically 0.98 and above.
+"""
+from __future__ import division
+
+import collections
+import io
+
+from PIL import Image as PILImage
+
+from . import pipeline
+from .compat import numpy
+from .instrumentation import measure
+
+
+# Formats whose encoders take a quality
+QUALITY_FORMATS = ('JPEG', 'WEBP')
+QUALITY_RANGE = (10, 95)
+MAX_TRIALS = 8
+
+# Searching for max_bytes stops once output is this close below the budget,
+# searching for min_similarity once it's this close above the floor
+TOLERANCE = 0.05
+SIMILARITY_TOLERANCE = 0.005
+
+PROXY_SIZE = (512, 512)
+SSIM_WINDOW = 7
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+Encoding = collections.namedtuple('Encoding', ['format', 'quality', 'data', 'similarity'])
+
+
+def encode(pil_image, format, quality=None, options=None):
+    """Returns the image encoded in memory."""
+    kwargs = dict(options or {})
+    if quality is not None:
+        kwargs['quality'] = quality
+    buffer = io.BytesIO()
+    with measure('encode', pil_image) as measurement:
+        pil_image.save(buffer, format=format, **kwargs)
+        measurement.set_output(pil_image, bytes=buffer.tell())
+    return buffer.getvalue()
+
+
+def get_proxy(pil_image, size=None):
+    """Returns a small grayscale copy of the image to compare, fitting
+    PROXY_SIZE unless a size is given."""
+    if size is None:
+        scale = min(PROXY_SIZE[0] / pil_image.width, PROXY_SIZE[1] / pil_image.height, 1)
+        size = (max(int(pil_image.width * scale), 1), max(int(pil_image.height * scale), 1))
+    if pil_image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        pil_image = pil_image.convert('RGB')
+    if pil_image.size != size:
+        pil_image = pil_image.resize(size, resample=PILImage.BILINEAR,
+                                     reducing_gap=pipeline.REDUCING_GAP)
+    return pil_image.convert('L')
+
+
+def get_decoded_proxy(data, size):
+    pil_image = PILImage.open(io.BytesIO(data))
+    # JPEGs are decoded at a reduced scale
+    pil_image.draft('RGB', size)
+    return get_proxy(pil_image, size)
+
+
+def _box_mean(array, window):
+    """Mean of every window x window region, from an integral image."""
+    integral = numpy.zeros((array.shape[0] + 1, array.shape[1] + 1))
+    integral[1:, 1:] = array.cumsum(0).cumsum(1)
+    total = (integral[window:, window:] - integral[:-window, window:] -
+             integral[window:, :-window] + integral[:-window, :-window])
+    return total / (window * window)
+
+
+def ssim(first, second):
+    """Returns the structural similarity of two grayscale images of the
+    same size, with a uniform window."""
+    if numpy is None:
+        raise ImportError('Image similarity requires numpy')
+    x = numpy.asarray(first, dtype=numpy.float64)
+    y = numpy.asarray(second, dtype=numpy.float64)
+    window = min(SSIM_WINDOW, x.shape[0], x.shape[1])
+    mean_x = _box_mean(x, window)
+    mean_y = _box_mean(y, window)
+    variance_x = _box_mean(x * x, window) - mean_x * mean_x
+    variance_y = _box_mean(y * y, window) - mean_y * mean_y
+    covariance = _box_mean(x * y, window) - mean_x * mean_y
+    similarity = (
+        (2 * mean_x * mean_y + SSIM_C1) * (2 * covariance + SSIM_C2) /
+        ((mean_x * mean_x + mean_y * mean_y + SSIM_C1) * (variance_x + variance_y + SSIM_C2))
+    )
+    return float(similarity.mean())
+
+
+def _search_format(pil_image, format, options, reference, max_bytes,
+                   min_similarity, max_trials):
+    """Returns the best Encoding of the image in `format` and whether it
+    meets the constraints. `reference` is the proxy to compare with."""
+    def trial(quality):
+        data = encode(pil_image, format, quality, options)
+        similarity = None
+        if reference is not None:
+            similarity = ssim(reference, get_decoded_proxy(data, reference.size))
+        return Encoding(format, quality, data, similarity)
+
+    def is_met(encoding):
+        return ((max_bytes is None or len(encoding.data) <= max_bytes) and
+                (min_similarity is None or encoding.similarity >= min_similarity))
+
+    if format not in QUALITY_FORMATS:
+        encoding = trial(None)
+        return encoding, is_met(encoding)
+
+    low, high = QUALITY_RANGE
+    best = None
+    trials = []
+    while low <= high and len(trials) < max_trials:
+        quality = (low + high) // 2
+        encoding = trial(quality)
+        trials.append(encoding)
+        if min_similarity is not None:
+            # Lowest quality that's similar enough
+            if encoding.similarity >= min_similarity:
+                if is_met(encoding):
+                    best = encoding
+                if encoding.similarity - min_similarity < SIMILARITY_TOLERANCE:
+                    break
+                high = quality - 1
+            else:
+                low = quality + 1
+        elif len(encoding.data) <= max_bytes:
+            # Highest quality that fits
+            best = encoding
+            if len(encoding.data) >= max_bytes * (1 - TOLERANCE):
+                break
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    if best is not None:
+        return best, True
+    return _get_fallback(trials, max_bytes), False
+
+
+def _get_fallback(encodings, max_bytes):
+    if max_bytes is not None:
+        return min(encodings, key=lambda encoding: len(encoding.data))
+    return max(encodings, key=lambda encoding: encoding.similarity)
+
+
+def find_encoding(pil_image, formats, max_bytes=None, min_similarity=None,
+                  fill_color=(255, 255, 255), get_options=None, max_trials=MAX_TRIALS):
+    """Returns the Encoding of the image meeting max_bytes and/or
+    min_similarity, trying each of `formats` (Pillow format names).
+    `get_options` returns encoder options for a format."""
+    if max_bytes is None and min_similarity is None:
+        raise ValueError('max_bytes or min_similarity is required')
+    if min_similarity is not None and numpy is None:
+        raise ImportError('min_similarity requires numpy')
+
+    results = []
+    flattened = None
+    references = {}
+    for format in formats:
+        prepared = pil_image
+        if pipeline.needs_flattening(prepared, format):
+            if flattened is None:
+                flattened = pipeline.flatten(prepared, fill_color)
+            prepared = flattened
+        reference = None
+        if min_similarity is not None:
+            if id(prepared) not in references:
+                references[id(prepared)] = get_proxy(prepared)
+            reference = references[id(prepared)]
+        options = get_options(format) if get_options is not None else None
+        results.append(_search_format(prepared, format, options, reference,
+                                      max_bytes, min_similarity, max_trials))
+
+    met = [encoding for encoding, is_met in results if is_met]
+    if met:
+        return min(met, key=lambda encoding: len(encoding.data))
+    return _get_fallback([encoding for encoding, is_met in results], max_bytes)
@@ -0,0 +1,322 @@
+"""
+WSGI application transforming images on the fly, from URLs like:
+
+    /fit/300x200/q85/webp/photos/cat.jpg
+    /fill/200x200/photos/cat.jpg
+    /crop/800x600/adjust/saturation=-20,contrast=10/photos/cat.jpg
+
+Option segments come first, in any order, then the image's path relative
+to the source directory:
+- "fit", "fill" or "stretch" followed by WIDTHxHEIGHT resizes, either
+  dimension may be empty, e.g. "300x"
+- "crop" followed by WIDTHxHEIGHT crops around the center
+- "adjust" followed by NAME=AMOUNT,... adjusts sharpness, brightness,
+  saturation or contrast
+- "q" followed by a number sets the quality, e.g. "q85"
+- a format ("jpeg", "png", "webp", "gif" or "tiff") sets the output
+  format. Without one, WebP is served to clients whose Accept header
+  includes image/webp and the source format to others, PNG if it's
+  another format
+
+Rendering runs on a worker pool, concurrent requests for the same image
+are coalesced into a single render. With a memory budget (see
+da_vinci.memory), images past its pixel limit get a 413 and renders that
+can't get memory in time a 503. Rendered images are cached (see
+da_vinci.cache) and served with an ETag derived from the source's size and
+mtime and the options, so conditional requests get a 304 without reading
+the source. To try it locally:
+
+    python -m da_vinci.server photos/ --port 8000 --cache-dir /tmp/derivatives
+"""
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import socketserver
+import sys
+import threading
+from concurrent import futures
+from wsgiref import simple_server
+
+from PIL import Image as PILImage
+
+from . import formats, images, memory
+from .cache import FileCache, MemoryCache, TieredCache
+
+
+SIZE_PATTERN = re.compile(r'^(\d*)x(\d*)$')
+QUALITY_PATTERN = re.compile(r'^q(\d{1,3})$')
+RESIZE_METHODS = ('fit', 'fill', 'stretch')
+ADJUSTMENTS = ('sharpness', 'brightness', 'saturation', 'contrast')
+
+# Served to clients accepting it when the URL doesn't set a format
+NEGOTIATED_FORMAT = 'WEBP'
+# Formats images are served in, browsers can't display the others
+OUTPUT_FORMATS = ('JPEG', 'PNG', 'WEBP', 'GIF', 'TIFF')
+# Served when the URL doesn't set a format and the source's isn't above
+FALLBACK_FORMAT = 'PNG'
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def parse_size(value):
+    match = SIZE_PATTERN.match(value or '')
+    if match is None or value == 'x':
+        raise BadRequest('Expected WIDTHxHEIGHT, not "%s"' % value)
+    return tuple(int(dimension) if dimension else None for dimension in match.groups())
+
+
+def parse_adjustments(value):
+    adjustments = {}
+    for item in (value or '').split(','):
+        name, separator, amount = item.partition('=')
+        if name not in ADJUSTMENTS:
+            raise BadRequest('Unknown adjustment "%s"' % name)
+        try:
+            amount = int(amount)
+        except ValueError:
+            raise BadRequest('Invalid %s "%s"' % (name, amount))
+        if not -100 <= amount <= 100:
+            raise BadRequest('%s must be between -100 and 100' % name)
+        adjustments[name] = amount
+    return adjustments
+
+
+def parse_path(path):
+    """Returns the operations, format, quality and image path of a URL path.
+    Operations are (Image method name, keyword arguments) tuples."""
+    segments = [segment for segment in path.split('/') if segment]
+    operations = []
+    format = quality = None
+    while segments:
+        segment = segments[0]
+        if segment in RESIZE_METHODS:
+            width, height = parse_size(segments[1] if len(segments) > 1 else None)
+            operations.append(('resize', {'width': width, 'height': height,
+                                          'method': segment}))
+            segments = segments[2:]
+        elif segment == 'crop':
+            width, height = parse_size(segments[1] if len(segments) > 1 else None)
+            if width is None or height is None:
+                raise BadRequest('Crop width and height are required')
+            operations.append(('crop', {'width': width, 'height': height}))
+            segments = segments[2:]
+        elif segment == 'adjust':
+            adjustments = parse_adjustments(segments[1] if len(segments) > 1 else None)
+            operations.append(('adjust', adjustments))
+            segments = segments[2:]
+        elif QUALITY_PATTERN.match(segment):
+            quality = int(segment[1:])
+            if not 1 <= quality <= 100:
+                raise BadRequest('Quality must be between 1 and 100')
+            segments = segments[1:]
+        elif segment.lower() in formats.MAPPING and len(segments) > 1:
+            format = formats.MAPPING[segment.lower()]
+            if format not in OUTPUT_FORMATS:
+                raise BadRequest('Images can\'t be served as %s' % format)
+            segments = segments[1:]
+        else:
+            break
+    if not segments:
+        raise BadRequest('Image path is missing')
+    return operations, format, quality, '/'.join(segments)
+
+
+def accepts_webp(accept):
+    return 'image/webp' in (accept or '')
+
+
+def render(filename, operations, format=None, quality=None, max_pixels=None,
+           budget=None):
+    """Returns the image at `filename` transformed and encoded, and its
+    format. Module level so it can run on a process pool."""
+    image = images.Image(filename, deferred=True, budget=budget)
+    for method, kwargs in operations:
+        getattr(image, method)(**kwargs)
+    if max_pixels is not None and image.width * image.height > max_pixels:
+        raise BadRequest('Output can be at most %d pixels' % max_pixels)
+    return image.to_bytes(format=format, quality=quality), format or image.format
+
+
+def get_output_format(filename):
+    """Returns the format an image is served in when the URL doesn't set
+    one, reading only the source's header."""
+    with PILImage.open(filename) as pil_image:
+        format = pil_image.format
+    return format if format in OUTPUT_FORMATS else FALLBACK_FORMAT
+
+
+class Application(object):
+    """WSGI application serving transformed images from `root`.
+
+    - cache: a derivative cache, defaults to a 64MB MemoryCache. Use a
+      cache.TieredCache to also keep derivatives on disk
+    - executor: a concurrent.futures.Executor rendering images, defaults
+      to a thread pool with a thread per CPU. Pillow releases the GIL while
+      decoding, resampling and encoding
+    - max_age: Cache-Control max-age, in seconds
+    - max_pixels: largest output image, in pixels
+    - negotiate: serve WebP to clients accepting it, unless the URL sets
+      a format
+    - budget: a memory.MemoryBudget renders reserve memory from, defaults
+      to the process-wide one. It's passed to every render, as processes
+      of a process pool don't share this process' default. They each get
+      a copy with the same limits
+    """
+
+    def __init__(self, root, cache=None, executor=None, max_age=86400,
+                 max_pixels=25 * 1000 * 1000, negotiate=True, budget=None):
+        self.root = os.path.realpath(root)
+        self.cache = cache if cache is not None else MemoryCache()
+        self.executor = executor or futures.ThreadPoolExecutor(
+            max_workers=os.cpu_count() or 1)
+        self.max_age = max_age
+        self.max_pixels = max_pixels
+        self.negotiate = negotiate
+        self.budget = budget
+        self._renders = {}
+        self._lock = threading.Lock()
+
+    def get_filename(self, path):
+        """Returns the source file of a path, None if there's no such file
+        inside the root directory."""
+        filename = os.path.realpath(os.path.join(self.root, *path.split('/')))
+        if not filename.startswith(self.root + os.sep) or not os.path.isfile(filename):
+            return None
+        return filename
+
+    def get_etag(self, path, stat, operations, format, quality):
+        description = json.dumps(
+            [path, stat.st_size, stat.st_mtime_ns, operations, format, quality],
+            sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+    def get_image(self, key, filename, operations, format, quality):
+        """Returns the rendered image from the cache, or renders it, and its
+        format. A render in progress for the same key is waited for rather
+        than repeated."""
+        data = self.cache.get(key)
+        if data is not None:
+            return data, format
+        with self._lock:
+            future = self._renders.get(key)
+            is_owner = future is None
+            if is_owner:
+                budget = self.budget if self.budget is not None else memory.get_default_budget()
+                future = self.executor.submit(render, filename, operations, format,
+                                              quality, self.max_pixels, budget)
+                self._renders[key] = future
+        if is_owner:
+            try:
+                data, format = future.result()
+                self.cache.set(key, data)
+            finally:
+                with self._lock:
+                    del self._renders[key]
+            return data, format
+        return future.result()
+
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        if method not in ('GET', 'HEAD'):
+            return self.respond(start_response, '405 Method Not Allowed',
+                                headers=[('Allow', 'GET, HEAD')])
+        try:
+            operations, format, quality, path = parse_path(environ.get('PATH_INFO', ''))
+        except BadRequest as error:
+            return self.respond(start_response, '400 Bad Request', str(error))
+        filename = self.get_filename(path)
+        if filename is None:
+            return self.respond(start_response, '404 Not Found', 'Not found')
+
+        headers = []
+        if format is None and self.negotiate:
+            headers.append(('Vary', 'Accept'))
+            if accepts_webp(environ.get('HTTP_ACCEPT')):
+                format = NEGOTIATED_FORMAT
+        etag = '"%s"' % self.get_etag(path, os.stat(filename), operations, format, quality)
+        headers.append(('ETag', etag))
+        headers.append(('Cache-Control', 'public, max-age=%d' % self.max_age))
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH', '')
+        if etag in [value.strip() for value in if_none_match.split(',')] or if_none_match == '*':
+            return self.respond(start_response, '304 Not Modified', headers=headers)
+
+        try:
+            if format is None:
+                format = get_output_format(filename)
+            data, format = self.get_image(etag.strip('"'), filename, operations, format,
+                                          quality)
+        except BadRequest as error:
+            return self.respond(start_response, '400 Bad Request', str(error))
+        except memory.ImageTooLarge as error:
+            # Past the memory budget's pixel limit, or larger than the budget
+            return self.respond(start_response, '413 Payload Too Large', str(error))
+        except memory.BudgetExceeded as error:
+            return self.respond(start_response, '503 Service Unavailable', str(error),
+                                headers=[('Retry-After', '1')])
+        except (IOError, OSError) as error:
+            # Includes files Pillow can't identify
+            return self.respond(start_response, '415 Unsupported Media Type', str(error))
+        except ValueError as error:
+            # Invalid dimensions, e.g. a crop larger than the image
+            return self.respond(start_response, '400 Bad Request', str(error))
+        headers.append(('Content-Type', PILImage.MIME[format]))
+        return self.respond(start_response, '200 OK', data, headers,
+                            include_body=method != 'HEAD')
+
+    def respond(self, start_response, status, body=b'', headers=None, include_body=True):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+            headers = (headers or []) + [('Content-Type', 'text/plain; charset=utf-8')]
+        headers = list(headers or [])
+        if not status.startswith('304'):
+            headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+        return [body] if include_body and not status.startswith('304') else []
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, simple_server.WSGIServer):
+    daemon_threads = True
+
+
+def make_server(application, host='127.0.0.1', port=8000):
+    """Returns a threaded development server, serve_forever() runs it."""
+    return simple_server.make_server(host, port, application,
+                                     server_class=ThreadingWSGIServer)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Serves transformed images from a directory')
+    parser.add_argument('root', help='Directory of source images')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--cache-dir', help='Also cache derivatives in this directory')
+    parser.add_argument('--cache-size', type=int, default=64,
+                        help='Memory cache size in MB (default: 64)')
+    parser.add_argument('--workers', type=int, help='Default: number of CPUs')
+    args = parser.parse_args(args)
+
+    derivatives = MemoryCache(max_bytes=args.cache_size * 1024 * 1024)
+    if args.cache_dir:
+        derivatives = TieredCache(derivatives, FileCache(args.cache_dir))
+    executor = futures.ThreadPoolExecutor(max_workers=args.workers or os.cpu_count() or 1)
+    application = Application(args.root, cache=derivatives, executor=executor)
+    server = make_server(application, args.host, args.port)
+    print('Serving %s on http://%s:%d/' % (application.root, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        executor.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+"""
+Passes images between processes through shared memory instead of pickling
+their pixels:
+
+    from da_vinci import shared
+
+    def work(handle):
+        with handle.open() as image:   # No copy, pixels stay in shared memory
+            image.resize(width=300, method='fit')
+            return image.to_bytes(format='webp')
+
+    handle = image.to_shared()         # Pixels are copied once
+    try:
+        data = pool.submit(work, handle).result()
+    finally:
+        handle.release()
+
+A SharedImage is a small picklable handle: the shared memory's name, the
+image's mode, size, palette, info, format and quality. Opened images are
+read only views of the shared memory, operations on them produce new
+images as usual.
+
+Lifetime is explicit. Each process that opens a handle maps the memory
+until the open() block exits, or close() is called once the images opened
+from it are closed. The process that exported the image owns the memory
+and frees it with release(), once no process needs it anymore. Memory
+that isn't released stays allocated until the system reboots.
+
+RGB images are stored with 4 bytes per pixel, like Pillow stores them,
+so RGB, RGBA, RGBX, L, P, CMYK and 16 bit images are mapped without
+copying. Images in other modes are copied out of the shared memory.
+"""
+import contextlib
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+from PIL import Image as PILImage
+
+from . import images, pipeline, tiles
+
+
+# Modes whose pixels are laid out in memory as Pillow stores them, with the
+# raw mode to map them with
+RAW_MODES = {
+    'RGB': 'RGBX',
+    'RGBX': 'RGBX',
+    'RGBA': 'RGBA',
+    'L': 'L',
+    'P': 'P',
+    'CMYK': 'CMYK',
+    'I;16': 'I;16',
+    'I;16L': 'I;16L',
+    'I;16B': 'I;16B',
+}
+
+
+# Before Python 3.13, every process mapping shared memory registers it with
+# the resource tracker, which frees it when any of them exits. It's only
+# tracked while being unlinked then.
+CAN_UNTRACK = sys.version_info >= (3, 13)
+
+
+def _create(size):
+    memory = shared_memory.SharedMemory(create=True, size=size)
+    if not CAN_UNTRACK:
+        resource_tracker.unregister(memory._name, 'shared_memory')
+    return memory
+
+
+def _attach(name):
+    if CAN_UNTRACK:
+        return shared_memory.SharedMemory(name=name, track=False)
+    memory = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(memory._name, 'shared_memory')
+    return memory
+
+
+def _unlink(memory):
+    if not CAN_UNTRACK:
+        # unlink() unregisters it
+        resource_tracker.register(memory._name, 'shared_memory')
+    memory.unlink()
+
+
+def get_view(mode, size, buffer):
+    """Returns a read only image whose pixels are `buffer`, without copying
+    it."""
+    if mode == 'RGB':
+        # PIL.Image.frombuffer() maps RGBX, but not RGB, which is stored the
+        # same way. Same as frombuffer(), with an RGB image, through Pillow
+        # internals it has had for long (see PillowTest)
+        pil_image = PILImage.new(mode, (0, 0))
+        pil_image = pil_image._new(PILImage.core.map_buffer(
+            buffer, size, 'raw', 0, (mode, 0, 1)))
+        pil_image.readonly = 1
+        return pil_image
+    return PILImage.frombuffer(mode, size, buffer, 'raw', RAW_MODES[mode], 0, 1)
+
+
+class SharedImage(object):
+    """Picklable handle to an image's pixels in shared memory."""
+
+    def __init__(self, name, mode, size, nbytes, palette=None, info=None,
+                 format=None, quality=None, filename=None, image_name=None):
+        self.name = name
+        self.mode = mode
+        self.size = size
+        self.nbytes = nbytes
+        self.palette = palette
+        self.info = info or {}
+        self.format = format
+        self.quality = quality
+        self.filename = filename
+        self.image_name = image_name
+        self._memory = None
+        self._is_owner = False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_memory'] = None
+        state['_is_owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def _get_memory(self):
+        if self._memory is None:
+            self._memory = _attach(self.name)
+        return self._memory
+
+    def get_pil_image(self):
+        """Returns a read only PIL image of the shared pixels, a copy if its
+        mode can't be mapped."""
+        buffer = self._get_memory().buf[:self.nbytes]
+        if self.mode in RAW_MODES:
+            pil_image = get_view(self.mode, self.size, buffer)
+        else:
+            pil_image = PILImage.frombytes(self.mode, self.size, buffer)
+        if self.palette is not None:
+            pil_image.putpalette(self.palette[1], rawmode=self.palette[0])
+        pil_image.info = dict(self.info)
+        return pil_image
+
+    @contextlib.contextmanager
+    def open(self):
+        """Yields an Image of the shared pixels, which is closed and unmapped
+        when the block exits. Keep no references to its PIL image."""
+        image = images.Image._from_pil_image(
+            self.get_pil_image(), filename=self.filename, format=self.format,
+            quality=self.quality)
+        image.name = self.image_name
+        try:
+            yield image
+        finally:
+            image.close()
+            del image
+            self.close()
+
+    def close(self):
+        """Unmaps the shared memory from this process. Raises BufferError if
+        an image still uses it."""
+        if self._memory is not None:
+            self._memory.close()
+            self._memory = None
+
+    def release(self):
+        """Frees the shared memory, which can't be opened anymore. Only the
+        process that exported the image does this."""
+        memory = self._get_memory()
+        if not self._is_owner:
+            raise ValueError('Only the process that exported an image releases it')
+        self.close()
+        _unlink(memory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def __repr__(self):
+        return '<SharedImage %s %s %dx%d>' % (self.name, self.mode, self.size[0], self.size[1])
+
+
+def export(image):
+    """Copies an Image's pixels, with pending operations applied, to new
+    shared memory. Returns its SharedImage, which owns the memory."""
+    image._apply_operations()
+    pil_image = pipeline.load(image._pil_image)
+    mode = pil_image.mode
+    if mode in RAW_MODES:
+        nbytes = tiles.get_row_bytes(mode, RAW_MODES[mode], pil_image.width) * pil_image.height
+    else:
+        data = pil_image.tobytes()
+        nbytes = len(data)
+
+    memory = _create(max(nbytes, 1))
+    try:
+        if mode in RAW_MODES:
+            buffer = memory.buf[:nbytes]
+            view = get_view(mode, pil_image.size, buffer)
+            # The view is read only so Pillow doesn't copy it, the pixels are
+            # written into shared memory directly
+            view.readonly = 0
+            view.paste(pil_image, (0, 0))
+            del view, buffer
+        else:
+            memory.buf[:nbytes] = data
+    except BaseException:
+        memory.close()
+        _unlink(memory)
+        raise
+
+    palette = None
+    if pil_image.palette is not None and mode == 'P':
+        palette = (pil_image.palette.mode, pil_image.getpalette(pil_image.palette.mode))
+    handle = SharedImage(memory.name, mode, pil_image.size, nbytes, palette=palette,
+                         info=dict(pil_image.info), format=image.format,
+                         quality=image.quality, filename=image.filename,
+                         image_name=image.name)
+    handle._memory = memory
+    handle._is_owner = True
+    return handle
@@ -0,0 +1,109 @@
+"""
+Chooses where to crop from the image's content, for Image.crop(center='auto')
+and Image.resize(method='fill', center='auto'):
+
+    image.resize(width=300, height=300, method='fill', center='auto')
+
+Every pixel of a small proxy of the image (at most PROXY_SIZE) is weighted
+by its edge energy, how likely it is to be skin and how much its color
+stands out from the image's average color (a simple saliency measure).
+The crop window with the highest total weight is chosen, with a slight
+preference for central windows. Window totals come from an integral
+image, so every position is scored at once and choosing a crop takes a
+few milliseconds whatever the size of the source. Requires numpy.
+"""
+from __future__ import division
+
+from PIL import ImageFilter
+
+from .compat import numpy
+
+
+PROXY_SIZE = (256, 256)
+
+EDGE_WEIGHT = 1.0
+SKIN_WEIGHT = 0.6
+SALIENCY_WEIGHT = 0.4
+# Windows are scored down by up to this much as they move off center
+CENTER_BIAS = 0.1
+
+
+def get_skin(ycbcr):
+    """Returns how likely every pixel is to be skin, from 0 to 1, based on
+    its chroma."""
+    cb = ycbcr[..., 1]
+    cr = ycbcr[..., 2]
+    # Distance to the center of the usual skin chroma range, in its units
+    distance = numpy.hypot((cb - 102) / 25, (cr - 153) / 20)
+    # Very dark and very bright pixels aren't told apart by chroma
+    luma = ycbcr[..., 0]
+    return numpy.clip(1 - distance, 0, 1) * ((luma > 40) & (luma < 240))
+
+
+def _normalize(array):
+    maximum = array.max()
+    return array / maximum if maximum > 0 else array
+
+
+def get_weights(pil_image, edge_weight=EDGE_WEIGHT, skin_weight=SKIN_WEIGHT,
+                saliency_weight=SALIENCY_WEIGHT):
+    """Returns the weight of every pixel of a (small) image as a 2D array."""
+    if numpy is None:
+        raise ImportError('Choosing crops from content requires numpy')
+    rgb = pil_image.convert('RGB')
+    gray = numpy.asarray(rgb.convert('L'), dtype=numpy.float32)
+    edges = numpy.zeros_like(gray)
+    edges[:, 1:] += numpy.abs(numpy.diff(gray, axis=1))
+    edges[1:, :] += numpy.abs(numpy.diff(gray, axis=0))
+    weights = edge_weight * _normalize(edges)
+
+    if skin_weight:
+        ycbcr = numpy.asarray(rgb.convert('YCbCr'), dtype=numpy.float32)
+        weights += skin_weight * get_skin(ycbcr)
+    if saliency_weight:
+        blurred = numpy.asarray(rgb.filter(ImageFilter.GaussianBlur(2)),
+                                dtype=numpy.float32)
+        mean = blurred.reshape(-1, 3).mean(axis=0)
+        weights += saliency_weight * _normalize(
+            numpy.sqrt(((blurred - mean) ** 2).sum(axis=2)))
+    return weights
+
+
+def find_window(weights, size):
+    """Returns the (left, top) position of the size[0] x size[1] window with
+    the highest total weight."""
+    height, width = weights.shape
+    window_width = min(max(int(round(size[0])), 1), width)
+    window_height = min(max(int(round(size[1])), 1), height)
+    integral = numpy.zeros((height + 1, width + 1))
+    integral[1:, 1:] = weights.cumsum(0).cumsum(1)
+    totals = (integral[window_height:, window_width:] -
+              integral[:-window_height, window_width:] -
+              integral[window_height:, :-window_width] +
+              integral[:-window_height, :-window_width])
+
+    # Distance of every window from the central one, from 0 to 1
+    rows, columns = totals.shape
+    y = numpy.abs(numpy.linspace(-1, 1, rows)) if rows > 1 else numpy.zeros(1)
+    x = numpy.abs(numpy.linspace(-1, 1, columns)) if columns > 1 else numpy.zeros(1)
+    totals = totals * (1 - CENTER_BIAS * numpy.maximum.outer(y, x))
+
+    top, left = numpy.unravel_index(numpy.argmax(totals), totals.shape)
+    return int(left), int(top)
+
+
+def find_center(proxy, size, crop_size):
+    """Returns the center of the best crop of crop_size in an image of
+    `size`, judging by `proxy`, a small copy of it."""
+    scale_x = proxy.width / size[0]
+    scale_y = proxy.height / size[1]
+    left, top = find_window(get_weights(proxy),
+                            (crop_size[0] * scale_x, crop_size[1] * scale_y))
+    crop_width = min(crop_size[0], size[0])
+    crop_height = min(crop_size[1], size[1])
+    center_x = (left / scale_x) + crop_width / 2
+    center_y = (top / scale_y) + crop_height / 2
+    # Keeps the window inside the image despite rounding on the proxy
+    center_x = min(max(center_x, crop_width / 2), size[0] - crop_width / 2)
+    center_y = min(max(center_y, crop_height / 2), size[1] - crop_height / 2)
+    return int(round(center_x)), int(round(center_y))
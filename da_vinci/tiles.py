@@ -0,0 +1,140 @@
+"""
+Decodes the part of an image covering a region, rather than the whole
+image, where the format allows it:
+- uncompressed images (TIFF, BMP, PPM...), striped or tiled, are read
+  directly from the file, only the rows (or tiles) covering the region
+- PNGs that aren't interlaced are decoded up to the region's last row,
+  into an image of the full size
+
+Other images are decoded whole, compressed TIFFs included even if they're
+tiled: Pillow decodes them with libtiff, which reads the whole file. This
+only relies on image headers, so it works on images that haven't been
+loaded yet.
+"""
+from __future__ import division
+
+import math
+
+from PIL import Image as PILImage
+
+from .instrumentation import measure
+
+
+# Decoders that can stop after any row
+SEQUENTIAL_CODECS = ('zip',)
+
+
+def _normalize_args(args):
+    if not isinstance(args, tuple):
+        args = (args,)
+    rawmode = args[0]
+    stride = args[1] if len(args) > 1 else 0
+    orientation = args[2] if len(args) > 2 else 1
+    return rawmode, stride, orientation
+
+
+def get_row_bytes(mode, rawmode, width):
+    """Returns the number of bytes of a row of `width` pixels in `rawmode`,
+    None if Pillow can't tell."""
+    try:
+        return len(PILImage.new(mode, (width, 1)).tobytes('raw', rawmode))
+    except (ValueError, KeyError, OSError):
+        return None
+
+
+def get_raw_tiles(pil_image):
+    """Returns an unloaded image's tiles as (extents, offset, rawmode,
+    stride, orientation) if they're all uncompressed, None otherwise."""
+    tiles = getattr(pil_image, 'tile', None)
+    if not tiles or getattr(pil_image, 'fp', None) is None:
+        return None
+    raw_tiles = []
+    for tile in tiles:
+        codec, extents, offset, args = tile[:4]
+        if codec != 'raw':
+            return None
+        rawmode, stride, orientation = _normalize_args(args)
+        if orientation not in (1, -1):
+            return None
+        if not stride:
+            stride = get_row_bytes(pil_image.mode, rawmode, extents[2] - extents[0])
+            if stride is None:
+                return None
+        raw_tiles.append((extents, offset, rawmode, stride, orientation))
+    return raw_tiles
+
+
+def can_read_rows(pil_image):
+    return get_raw_tiles(pil_image) is not None
+
+
+def _new_region(pil_image, size):
+    region = PILImage.new(pil_image.mode, size)
+    if pil_image.palette is not None:
+        region.palette = pil_image.palette.copy()
+    region.info = pil_image.info.copy()
+    return region
+
+
+def _clamp_box(box, size):
+    return (max(int(math.floor(box[0])), 0), max(int(math.floor(box[1])), 0),
+            min(int(math.ceil(box[2])), size[0]), min(int(math.ceil(box[3])), size[1]))
+
+
+def read_rows(pil_image, box):
+    """Reads the rows of an uncompressed image covering `box`, only from
+    the tiles that intersect it. Returns the region and its offset in the
+    image."""
+    box = _clamp_box(box, pil_image.size)
+    tiles = [tile for tile in get_raw_tiles(pil_image)
+             if tile[0][0] < box[2] and tile[0][2] > box[0] and
+             tile[0][1] < box[3] and tile[0][3] > box[1]]
+    left = min(tile[0][0] for tile in tiles)
+    right = max(tile[0][2] for tile in tiles)
+    region = _new_region(pil_image, (right - left, box[3] - box[1]))
+
+    for extents, offset, rawmode, stride, orientation in tiles:
+        top = max(extents[1], box[1])
+        bottom = min(extents[3], box[3])
+        if orientation == 1:
+            start = offset + (top - extents[1]) * stride
+        else:
+            # Rows are stored bottom up
+            start = offset + (extents[3] - bottom) * stride
+        pil_image.fp.seek(start)
+        data = pil_image.fp.read((bottom - top) * stride)
+        tile_image = PILImage.frombytes(
+            pil_image.mode, (extents[2] - extents[0], bottom - top), data,
+            'raw', rawmode, stride, orientation)
+        region.paste(tile_image, (extents[0] - left, top - box[1]))
+    return region, (left, box[1])
+
+
+def _truncate(tile, extents):
+    if hasattr(tile, '_replace'):
+        return tile._replace(extents=extents)
+    return (tile[0], extents) + tuple(tile[2:])
+
+
+def decode_region(pil_image, box):
+    """Decodes as little of a not yet loaded image as needed to cover
+    `box`. Returns the decoded image and its offset in the original image,
+    which is (0, 0) if decoding started from the top left corner."""
+    clamped = _clamp_box(box, pil_image.size)
+    with measure('decode', pil_image) as measurement:
+        if clamped[0] < clamped[2] and clamped[1] < clamped[3] and can_read_rows(pil_image):
+            region, offset = read_rows(pil_image, clamped)
+            measurement.set_output(region)
+            return region, offset
+
+        tiles = pil_image.tile
+        if (len(tiles) == 1 and tiles[0][0] in SEQUENTIAL_CODECS and
+                not pil_image.info.get('interlace') and
+                tuple(tiles[0][1]) == (0, 0) + pil_image.size and
+                0 < clamped[3] < pil_image.size[1]):
+            # Stop decoding after the last row of the region, rows below it
+            # are left blank
+            pil_image.tile = [_truncate(tiles[0], (0, 0, pil_image.size[0], clamped[3]))]
+        pil_image.load()
+        measurement.set_output(pil_image)
+    return pil_image, (0, 0)
@@ -1,5 +1,8 @@
 from __future__ import division
 
+import io
+import os
+
 
 def calculate_dimensions(width, height, original_width, original_height,
                          keep_aspect_ratio=True, method='stretch'):
@@ -75,4 +78,59 @@ def convert_to_pil_factor(value):
     elif value < 0:
         return 1- (abs(value) / 100)
     else:
-        return (value / 100) + 1
\ No newline at end of file
+        return (value / 100) + 1
+
+
+class BufferReader(io.RawIOBase):
+    """Read-only file object over bytes or any object supporting the buffer
+    protocol. Unlike io.BytesIO, the buffer isn't copied."""
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError('Negative seek position %d' % offset)
+        self._position = offset
+        return offset
+
+    def read(self, size=-1):
+        start = min(self._position, len(self._view))
+        end = len(self._view) if size is None or size < 0 else min(start + size, len(self._view))
+        self._position = end
+        return self._view[start:end].tobytes()
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def getbuffer(self):
+        return self._view
+
+
+def make_temporary_file(directory):
+    """Like tempfile.mkstemp(), but the file gets the permissions open()
+    would give it (0666 less the umask) rather than 0600, as it's meant to
+    replace another one. Returns its descriptor and path."""
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+    while True:
+        path = os.path.join(directory, '.%s' % os.urandom(8).hex())
+        try:
+            return os.open(path, flags, 0o666), path
+        except FileExistsError:
+            continue
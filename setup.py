@@ -7,6 +7,12 @@ setup(
     author='Selwin Ong',
     author_email='selwin.ong@gmail.com',
     packages=['da_vinci'],
+    extras_require={
+        'numpy': ['numpy'],
+    },
+    entry_points={
+        'console_scripts': ['da-vinci = da_vinci.cli:main'],
+    },
     url='https://github.com/ui/da-vinci',
     license='MIT',
     description='A simple image manipulation library aiming to make common image tasks easy.',
@@ -1,14 +1,50 @@
+import asyncio
+import base64
+import functools
+import gc
+import importlib
 import io
+import mmap
 import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import warnings
+from concurrent import futures
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 
-from da_vinci import images
+from PIL import Image as PILImage
+from PIL import ImageChops, ImageCms
+
+from da_vinci import (aio, batch, cache, cli, color, enhance, fetch, hashing, images,
+                      instrumentation, memory, pipeline, placeholders, quality,
+                      server, shared, tiles, utils)
+from da_vinci.compat import numpy
 from da_vinci.utils import (calculate_dimensions, convert_to_pil_factor,
                             parse_dimension)
 
 
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
 class UtilsTest(unittest.TestCase):
 
+    def test_make_temporary_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        # The current umask applies
+        self.addCleanup(os.umask, os.umask(0o027))
+        descriptor, path = utils.make_temporary_file(directory)
+        os.close(descriptor)
+        self.assertEqual(os.path.dirname(path), directory)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+
     def test_calculate_dimensions_auto_width_height(self):
         """
         In this test we need to:
@@ -206,6 +242,172 @@ class ImageTest(unittest.TestCase):
         image.save(file=file_like_object)
         self.assertEqual(image.mode, "RGB")
 
+    def test_bytes(self):
+        with open('tests/10x20.jpg', 'rb') as file:
+            data = file.read()
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.addCleanup(buffer.close)
+
+        for source in (data, bytearray(data), memoryview(data), buffer):
+            image = images.from_bytes(source)
+            self.assertEqual((image.width, image.height), (10, 20))
+            self.assertEqual(image.format, 'JPEG')
+            self.assertIsNone(image.filename)
+
+        # File objects don't need a name
+        image = images.from_file(io.BytesIO(data))
+        output = io.BytesIO()
+        image.save(file=output)
+        self.assertIsNone(image.filename)
+        self.assertRaises(ValueError, image.save)
+
+        data = image.to_bytes(format='png')
+        self.assertEqual(PILImage.open(io.BytesIO(data)).format, 'PNG')
+        self.assertEqual(image.format, 'JPEG')
+
+    def test_presets(self):
+        image = images.from_file('tests/10x20.jpg')
+        key = image.get_cache_key()
+        image.set(preset='smallest', options={'jpg': {'subsampling': 0}})
+        self.assertEqual(image.get_save_options(),
+                         {'optimize': True, 'progressive': True, 'subsampling': 0})
+        self.assertNotEqual(image.get_cache_key(), key)
+        pil_image = PILImage.open(io.BytesIO(image.to_bytes()))
+        self.assertTrue(pil_image.info.get('progressive'))
+
+        image.set(format='png')
+        self.assertEqual(image.get_save_options(),
+                         {'compress_level': 9, 'optimize': True})
+        self.assertRaises(ValueError, image.set, preset='tiny')
+
+    def test_target_size(self):
+        image = images.from_file('tests/10x20.jpg')
+        image.set_pil_image(PILImage.effect_noise((200, 200), 60).convert('RGB'))
+        image.set(format='png', max_bytes=8000, candidates=['jpeg', 'webp'])
+        data = image.to_bytes()
+        self.assertLessEqual(len(data), 8000)
+        self.assertIn(PILImage.open(io.BytesIO(data)).format, ('JPEG', 'WEBP'))
+
+        self.assertRaises(ValueError, quality.find_encoding,
+                          image.get_pil_image(), ['JPEG'])
+
+        # Saving with a filename uses the chosen format's extension
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        image = images.from_file('tests/20x10.jpg')
+        image.set(max_bytes=100000, candidates=['png'])
+        image.save(filename=os.path.join(directory, 'image.jpg'))
+        self.assertEqual(image.filename, os.path.join(directory, 'image.png'))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_target_similarity(self):
+        pil_image = PILImage.effect_noise((200, 200), 60).convert('RGB')
+        self.assertEqual(quality.ssim(pil_image.convert('L'), pil_image.convert('L')), 1)
+        encoding = quality.find_encoding(pil_image, ['JPEG'], min_similarity=0.9)
+        self.assertGreaterEqual(encoding.similarity, 0.9)
+        self.assertLess(encoding.quality, quality.QUALITY_RANGE[1])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_smart_crop(self):
+        # A textured square on a flat background
+        pil_image = PILImage.new('RGB', (400, 200), (200, 200, 200))
+        pil_image.paste(PILImage.effect_noise((80, 80), 80).convert('RGB'), (300, 60))
+        buffer = io.BytesIO()
+        pil_image.save(buffer, format='PNG')
+        image = images.from_bytes(buffer.getvalue())
+        image.crop(150, 150, center='auto')
+        left, top, right, bottom = image._history[-1][1]
+        self.assertTrue(left <= 300 and right >= 380 and 0 <= top and bottom <= 200)
+
+        # Pending operations are taken into account
+        image = images.from_bytes(buffer.getvalue(), deferred=True)
+        image.flip('horizontal')
+        image.resize(width=100, height=100, method='fill', center='auto')
+        # The square is at x 20 to 60 once flipped and resized
+        left, top, right, bottom = image._operations[-1][1]
+        self.assertTrue(left <= 20 and right >= 60)
+        self.assertEqual(image.get_pil_image().size, (100, 100))
+
+    def test_color_profile(self):
+        with open('tests/wide_gamut.icc', 'rb') as file:
+            icc_profile = file.read()
+        buffer = io.BytesIO()
+        PILImage.new('RGB', (10, 10), (128, 64, 64)).save(
+            buffer, format='PNG', icc_profile=icc_profile)
+        data = buffer.getvalue()
+
+        # The embedded profile is kept
+        image = images.from_bytes(data)
+        image.resize(width=5, height=5)
+        saved = PILImage.open(io.BytesIO(image.to_bytes(format='jpeg')))
+        self.assertEqual(saved.info.get('icc_profile'), icc_profile)
+
+        # Converted to sRGB, colors are more saturated and the profile dropped
+        color._transforms.clear()
+        for deferred in (False, True):
+            image = images.from_bytes(data, deferred=deferred, color_profile='srgb')
+            pil_image = image.get_pil_image()
+            red, green, blue = pil_image.getpixel((0, 0))
+            self.assertTrue(red > 128 and green < 64)
+            self.assertNotIn('icc_profile', pil_image.info)
+        # The transform was built once
+        self.assertEqual(len(color._transforms), 1)
+
+        # sRGB images are left alone, other profiles are embedded
+        image = images.from_file('tests/20x10.jpg')
+        pil_image = image.get_pil_image()
+        image.to_profile('srgb')
+        self.assertIs(image.get_pil_image(), pil_image)
+        image.to_profile('tests/wide_gamut.icc', intent='relative')
+        self.assertEqual(image.get_pil_image().info['icc_profile'], icc_profile)
+        self.assertRaises(ValueError, image.to_profile, 'tests/missing.icc')
+
+    def test_color_without_littlecms(self):
+        """Without littlecms, only color management fails"""
+        def create_profile(*args):
+            raise ImportError('The _imagingcms C module is not installed')
+
+        create = ImageCms.createProfile
+        self.addCleanup(importlib.reload, color)
+        self.addCleanup(setattr, ImageCms, 'createProfile', create)
+        ImageCms.createProfile = create_profile
+        importlib.reload(color)
+        image = images.from_file('tests/20x10.jpg')
+        image.resize(width=10)
+        image.to_bytes()
+        self.assertRaises(ImportError, color.get_profile, color.SRGB)
+
+    def test_animation(self):
+        frames = [PILImage.new('RGB', (40, 20), (index * 60, 0, 0)) for index in range(4)]
+        file_like_object = io.BytesIO()
+        frames[0].save(file_like_object, format='GIF', save_all=True,
+                       append_images=frames[1:], duration=[100, 200, 300, 400], loop=0)
+
+        for format in ('gif', 'webp'):
+            image = images.from_bytes(file_like_object.getvalue())
+            self.assertTrue(image.is_animated)
+            image.resize(width=20)
+            image.flip('horizontal')
+            pil_image = PILImage.open(io.BytesIO(image.to_bytes(format=format)))
+            self.assertEqual(pil_image.size, (20, 10))
+            self.assertEqual(pil_image.n_frames, 4)
+            self.assertEqual(pil_image.info['loop'], 0)
+            durations = []
+            for frame in range(4):
+                pil_image.seek(frame)
+                pil_image.load()
+                durations.append(pil_image.info['duration'])
+            self.assertEqual(durations, [100, 200, 300, 400])
+            pil_image.seek(3)
+            self.assertGreater(pil_image.convert('RGB').getpixel((5, 5))[0], 150)
+
+        # Other formats get the first frame
+        image = images.from_bytes(file_like_object.getvalue())
+        image.resize(width=20)
+        pil_image = image.get_pil_image()
+        self.assertEqual(pil_image.size, (20, 10))
+        self.assertFalse(image.is_animated)
+
     def test_rotate(self):
         image = images.from_file('tests/10x20.jpg')
         self.assertEqual(image.width, 10)
@@ -217,6 +419,61 @@ class ImageTest(unittest.TestCase):
         self.assertEqual(image.width, 10)
         self.assertEqual(image.height, 20)
 
+    def test_lazy_open(self):
+        """Reading metadata doesn't decode the image"""
+        filename = 'tests/rotated.jpg'
+        exif = PILImage.Exif()
+        exif[pipeline.ORIENTATION_TAG] = 8  # Rotated 90 degrees counterclockwise
+        PILImage.new('RGB', (20, 10)).save(filename, exif=exif.tobytes())
+        self.addCleanup(os.remove, filename)
+
+        image = images.from_file(filename)
+        self.assertEqual((image.width, image.height), (10, 20))
+        self.assertEqual(image.aspect_ratio, 0.5)
+        self.assertEqual(image.format, 'JPEG')
+        self.assertIn('exif', image.info)
+        self.assertFalse(pipeline.is_loaded(image._pil_image))
+
+        image.flip('horizontal')
+        self.assertTrue(pipeline.is_loaded(image._pil_image))
+        self.assertEqual(image.get_pil_image().size, (10, 20))
+
+        # Files the image was opened from are closed with it
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            image = images.from_file(filename)
+            del image
+            gc.collect()
+        self.assertEqual([warning for warning in caught
+                          if issubclass(warning.category, ResourceWarning)], [])
+
+        # File objects may be closed before the image is decoded
+        with open(filename, 'rb') as file:
+            image = images.from_file(file, deferred=True)
+        image.resize(width=5)
+        output = io.BytesIO()
+        image.save(file=output)
+        self.assertEqual(PILImage.open(output).size, (5, 10))
+        self.assertEqual(image.filename, filename)
+
+    def test_renditions(self):
+        image = images.from_file('tests/20x10.jpg')
+        file_like_object = io.BytesIO()
+        renditions = image.renditions([
+            (4, 4, 'fit', 'png'),
+            {'width': 10, 'method': 'fit', 'quality': 80, 'file': file_like_object},
+            (2, 2, 'stretch'),
+        ])
+        self.assertEqual([(rendition.width, rendition.height) for rendition in renditions],
+                         [(4, 2), (10, 5), (2, 2)])
+        self.assertEqual([rendition.format for rendition in renditions],
+                         ['PNG', 'JPEG', 'JPEG'])
+        self.assertEqual(renditions[0].get_filename(), 'tests/20x10_4x2.png')
+        self.assertEqual(renditions[1].quality, 80)
+        self.assertTrue(file_like_object.getvalue())
+        # Original image is unchanged
+        self.assertEqual((image.width, image.height), (20, 10))
+
     def test_format_getter_setter(self):
         image = images.from_file('tests/10x20.jpg')
         image.format = 'JPG'
@@ -260,3 +517,913 @@ class ImageTest(unittest.TestCase):
         image.format = 'webp'
         image.save(new_filename)
         os.remove(image.filename)
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_compose_transposes(self):
+        self.assertEqual(
+            pipeline.compose_transposes(PILImage.FLIP_LEFT_RIGHT,
+                                        PILImage.FLIP_LEFT_RIGHT),
+            None
+        )
+        self.assertEqual(
+            pipeline.compose_transposes(PILImage.FLIP_LEFT_RIGHT,
+                                        PILImage.FLIP_TOP_BOTTOM),
+            PILImage.ROTATE_180
+        )
+        self.assertEqual(
+            pipeline.compose_transposes(PILImage.ROTATE_90, PILImage.ROTATE_90),
+            PILImage.ROTATE_180
+        )
+
+    def test_plan(self):
+        # Flips and rotations are folded into one transposition
+        operations = [
+            ('transpose', PILImage.FLIP_LEFT_RIGHT),
+            ('rotate', 180),
+            ('transpose', PILImage.FLIP_TOP_BOTTOM),
+        ]
+        self.assertEqual(pipeline.plan(operations, (20, 10)), [])
+
+        # Crop after resize is done as a single resample of the source region
+        operations = [('resize', (10, 5)), ('crop', (0, 0, 5, 5))]
+        self.assertEqual(pipeline.plan(operations, (20, 10)),
+                         [('resize', (5, 5), (0, 0, 10, 10))])
+
+        # Consecutive resizes are merged, transposition runs last
+        operations = [
+            ('resize', (10, 5)),
+            ('transpose', PILImage.ROTATE_90),
+            ('resize', (4, 8)),
+        ]
+        self.assertEqual(pipeline.plan(operations, (20, 10)), [
+            ('resize', (8, 4), (0, 0, 20, 10)),
+            ('transpose', PILImage.ROTATE_90),
+        ])
+
+        # Rotations that aren't transpositions are applied as is
+        operations = [('resize', (10, 5)), ('rotate', 45)]
+        self.assertEqual(pipeline.plan(operations, (20, 10)), [
+            ('resize', (10, 5), (0, 0, 20, 10)),
+            ('rotate', 45),
+        ])
+
+    def test_resample(self):
+        # The last resize's strategy is used for the merged resample
+        operations = [('resize', (10, 5), 'fastest'), ('crop', (0, 0, 5, 5))]
+        self.assertEqual(pipeline.plan(operations, (20, 10)),
+                         [('resize', (5, 5), (0, 0, 10, 10), 'fastest')])
+
+        source = PILImage.radial_gradient('L').resize((512, 512))
+        for resample in ('fastest', 'balanced', 'best', PILImage.BICUBIC):
+            resized = pipeline.resize(source, (64, 64), resample=resample)
+            self.assertEqual(resized.size, (64, 64))
+        self.assertRaises(ValueError, pipeline.get_resampling, 'sharpest')
+
+        image = images.from_file('tests/20x10.jpg', deferred=True)
+        image.resize(width=10, resample='balanced')
+        self.assertEqual(image._operations, [('resize', (10, 5), 'balanced')])
+        self.assertEqual(image.get_pil_image().size, (10, 5))
+        # The default strategy doesn't change cache keys
+        image = images.from_file('tests/20x10.jpg')
+        image.resize(width=10, resample='best')
+        self.assertEqual(image._history[-1], ('resize', (10, 5)))
+        self.assertRaises(ValueError, image.resize, width=10, resample='sharpest')
+
+        small, = images.from_file('tests/20x10.jpg').renditions(
+            [(10, None, 'fit', None, None, 'fastest')])
+        self.assertEqual((small.width, small.height), (10, 5))
+        self.assertEqual(small._history[-1], ('resize', (10, 5), 'fastest'))
+
+    def test_deferred(self):
+        image = images.from_file('tests/20x10.jpg', deferred=True)
+        image.flip('horizontal')
+        image.resize(width=10)
+        image.crop(4, 4)
+        self.assertEqual(image._operations[0], ('transpose', PILImage.FLIP_LEFT_RIGHT))
+        self.assertEqual((image.width, image.height), (4, 4))
+        self.assertEqual(image.get_pil_image().size, (4, 4))
+        self.assertEqual(image._operations, [])
+
+        # Without resizes, deferred result is identical to the eager one
+        eager = images.from_file('tests/20x10.jpg')
+        deferred = images.from_file('tests/20x10.jpg', deferred=True)
+        for image in (eager, deferred):
+            image.crop(12, 8, center=('40%', '50%'))
+            image.rotate(180)
+            image.flip('vertical')
+            image.adjust(brightness=20)
+        self.assertEqual(eager.get_pil_image().tobytes(),
+                         deferred.get_pil_image().tobytes())
+
+        # Operations planned to nothing leave the source open
+        image = images.from_file('tests/20x10.jpg', deferred=True)
+        image.resize(width=20, height=10)
+        self.assertEqual(image.get_pil_image().tobytes(),
+                         images.from_file('tests/20x10.jpg').get_pil_image().tobytes())
+
+    def test_draft(self):
+        """Pending downscales let the JPEG decoder scale the image down"""
+        filename = 'tests/large.jpg'
+        exif = PILImage.Exif()
+        exif[pipeline.ORIENTATION_TAG] = 6  # Rotated 90 degrees clockwise
+        pil_image = PILImage.linear_gradient('L').resize((800, 400))
+        pil_image.save(filename, exif=exif.tobytes())
+        self.addCleanup(os.remove, filename)
+
+        expected = images.from_file(filename)
+        expected.resize(width=50)
+
+        image = images.from_file(filename, deferred=True)
+        self.assertEqual((image.width, image.height), (400, 800))
+        image.resize(width=50)
+        pil_image = image.get_pil_image()
+        self.assertEqual(pil_image.size, (50, 100))
+        self.assertNotIn(pipeline.ORIENTATION_TAG, pil_image.getexif())
+        difference = ImageChops.difference(pil_image, expected.get_pil_image())
+        self.assertLessEqual(difference.getextrema()[1], 2)
+
+        image = images.from_file(filename, size_hint=(50, 50))
+        self.assertEqual((image.width, image.height), (50, 100))
+
+
+class TilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.pil_image = PILImage.effect_noise((300, 200), 60).convert('RGB')
+
+    def save(self, format):
+        filename = os.path.join(self.directory, 'image.%s' % format)
+        self.pil_image.save(filename)
+        return filename
+
+    def test_decode_region(self):
+        for format in ('bmp', 'tif', 'png', 'jpg'):
+            filename = self.save(format)
+            with PILImage.open(filename) as pil_image:
+                expected = pil_image.crop((40, 30, 140, 90))
+            pil_image = PILImage.open(filename)
+            self.addCleanup(pil_image.close)
+            region, offset = tiles.decode_region(pil_image, (40, 30, 140, 90))
+            box = (40 - offset[0], 30 - offset[1], 140 - offset[0], 90 - offset[1])
+            self.assertIsNone(ImageChops.difference(region.crop(box), expected).getbbox())
+            if format in ('bmp', 'tif'):
+                self.assertEqual(region.size, (300, 60))
+            elif format == 'png':
+                # Decoding stopped after the region's last row
+                self.assertIsNone(region.crop((0, 90, 300, 200)).getbbox())
+
+    def test_crop(self):
+        image = images.from_file(self.save('bmp'))
+        image.crop(100, 50, center=(150, 20))
+        self.assertEqual(image.get_pil_image().size, (100, 50))
+        expected = self.pil_image.crop((100, -5, 200, 45))
+        self.assertIsNone(ImageChops.difference(image.get_pil_image(), expected).getbbox())
+
+    def test_resize_in_strips(self):
+        filename = self.save('tif')
+        expected = images.from_file(filename)
+        expected.resize(width=100, height=70)
+        original_min_pixels, original_rows = pipeline.STRIP_MIN_PIXELS, pipeline.STRIP_ROWS
+        pipeline.STRIP_MIN_PIXELS, pipeline.STRIP_ROWS = 0, 20
+        try:
+            image = images.from_file(filename)
+            image.resize(width=100, height=70)
+            pil_image = image.get_pil_image()
+        finally:
+            pipeline.STRIP_MIN_PIXELS, pipeline.STRIP_ROWS = original_min_pixels, original_rows
+        self.assertEqual(pil_image.size, (100, 70))
+        difference = ImageChops.difference(pil_image, expected.get_pil_image())
+        self.assertLessEqual(max(high for low, high in difference.getextrema()), 2)
+
+
+class EnhanceTest(unittest.TestCase):
+
+    def test_adjust(self):
+        """Fused adjustments match ImageEnhance within 4 levels"""
+        # Noise and gradients, sharpening and saturation change every pixel
+        gradient = PILImage.linear_gradient('L').resize((64, 64))
+        noise = PILImage.effect_noise((64, 64), 60)
+        pil_image = PILImage.merge('RGB', (noise, gradient, gradient.rotate(90)))
+        pil_image.putalpha(gradient.rotate(180))
+        adjustments = [
+            {'saturation': -50, 'brightness': -20, 'contrast': 40},
+            {'saturation': 80, 'brightness': 30, 'contrast': -60},
+            {'saturation': -60, 'sharpness': 80, 'brightness': 80, 'contrast': 80},
+            {'saturation': 50, 'sharpness': -60, 'brightness': -60},
+            {'sharpness': 70, 'brightness': 10},
+            {'sharpness': -40, 'contrast': 100},
+        ]
+        for mode in ('RGB', 'RGBA', 'L', 'LA'):
+            converted = pil_image.convert(mode)
+            for kwargs in adjustments:
+                expected = enhance.enhance(converted, **kwargs)
+                result = enhance.adjust(converted, **kwargs)
+                self.assertEqual(result.mode, mode)
+                extrema = ImageChops.difference(result, expected).getextrema()
+                if mode == 'L':
+                    extrema = [extrema]
+                self.assertLessEqual(max(high for low, high in extrema), 4, (mode, kwargs))
+
+
+class BatchTest(unittest.TestCase):
+
+    def test_process(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        sources = ['tests/10x10.jpg', 'tests/missing.jpg', 'tests/20x10.jpg']
+        recipe = [
+            ('resize', {'width': 4, 'method': 'fit'}),
+            ('set', {'format': 'png'}),
+            ('save', {'filename': os.path.join(directory, '{index}-{stem}.{extension}')}),
+        ]
+        results = list(batch.process(sources, recipe, workers=2, ordered=True))
+        self.assertEqual([result.source for result in results], sources)
+        self.assertEqual(results[0].value, os.path.join(directory, '0-10x10.png'))
+        self.assertEqual(images.from_file(results[2].value).height, 2)
+        # Same permissions as files saved directly
+        self.assertEqual(os.stat(results[0].value).st_mode & 0o777, 0o666 & ~get_umask())
+        self.assertIsNone(results[1].value)
+        self.assertIsInstance(results[1].error, IOError)
+
+        # Without a "save" step, encoded images are returned
+        results = batch.process(sources[:1] * 5, [('flip', {'direction': 'vertical'})],
+                                executor='thread', max_in_flight=2)
+        for result in results:
+            self.assertTrue(result.value.startswith(b'\xff\xd8'))
+
+        self.assertRaises(ValueError, batch.validate_recipe, [('delete', {})])
+
+
+class CliTest(unittest.TestCase):
+
+    def test_main(self):
+        source = tempfile.mkdtemp()
+        output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        self.addCleanup(shutil.rmtree, output)
+        os.makedirs(os.path.join(source, 'nested'))
+        shutil.copy('tests/20x10.jpg', source)
+        shutil.copy('tests/no_bg.png', os.path.join(source, 'nested'))
+        args = [source, output, '--resize', '10x', '--format', 'webp', '--quality', '70',
+                '--executor', 'thread', '--quiet']
+        self.assertEqual(cli.main(args), 0)
+        self.assertEqual(images.from_file(os.path.join(output, '20x10.webp')).width, 10)
+        manifest = cli.Manifest(os.path.join(output, cli.MANIFEST_NAME))
+        self.assertEqual(sorted(manifest.entries), ['20x10.jpg', 'nested/no_bg.png'])
+        self.assertEqual(os.stat(manifest.path).st_mode & 0o777, 0o666 & ~get_umask())
+
+        # Unchanged sources aren't processed again, even if touched
+        os.remove(os.path.join(output, 'nested', 'no_bg.webp'))
+        os.utime(os.path.join(source, '20x10.jpg'), (0, 0))
+        self.assertEqual(cli.main(args), 0)
+        self.assertTrue(os.path.exists(os.path.join(output, 'nested', 'no_bg.webp')))
+        manifest = cli.Manifest(os.path.join(output, cli.MANIFEST_NAME))
+        self.assertEqual(manifest.entries['20x10.jpg']['mtime'], 0)
+
+        # A new recipe processes everything
+        self.assertEqual(cli.main(args[:3] + ['5x'] + args[4:]), 0)
+        self.assertEqual(images.from_file(os.path.join(output, '20x10.webp')).width, 5)
+        self.assertRaises(SystemExit, cli.main, [source, output, '--resize', 'big'])
+
+
+class CountingExecutor(futures.ThreadPoolExecutor):
+
+    def __init__(self):
+        super(CountingExecutor, self).__init__(max_workers=2)
+        self.submitted = 0
+
+    def submit(self, function, *args, **kwargs):
+        self.submitted += 1
+
+        def slow_function():
+            time.sleep(0.1)
+            return function(*args, **kwargs)
+        return super(CountingExecutor, self).submit(slow_function)
+
+
+class ServerTest(unittest.TestCase):
+
+    def request(self, application, path, **headers):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path}
+        environ.update(('HTTP_' + name.upper(), value) for name, value in headers.items())
+        response = {}
+
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = dict(headers)
+        response['body'] = b''.join(application(environ, start_response))
+        return response
+
+    def test_parse_path(self):
+        self.assertEqual(server.parse_path('/fit/300x/q85/webp/a/b.jpg'), (
+            [('resize', {'width': 300, 'height': None, 'method': 'fit'})],
+            'WEBP', 85, 'a/b.jpg'))
+        self.assertEqual(server.parse_path('/crop/10x20/adjust/contrast=10/webp'), (
+            [('crop', {'width': 10, 'height': 20}), ('adjust', {'contrast': 10})],
+            None, None, 'webp'))
+        self.assertRaises(server.BadRequest, server.parse_path, '/fit/big/a.jpg')
+        self.assertRaises(server.BadRequest, server.parse_path, '/q85')
+        # Formats browsers can't display aren't served
+        self.assertRaises(server.BadRequest, server.parse_path, '/pdf/a.jpg')
+
+    def test_application(self):
+        executor = CountingExecutor()
+        self.addCleanup(executor.shutdown)
+        application = server.Application('tests', executor=executor)
+
+        response = self.request(application, '/fit/10x10/q80/20x10.jpg')
+        self.assertEqual(response['status'], '200 OK')
+        self.assertEqual(response['headers']['Content-Type'], 'image/jpeg')
+        self.assertEqual(images.from_bytes(response['body']).height, 5)
+        etag = response['headers']['ETag']
+        response = self.request(application, '/fit/10x10/q80/20x10.jpg', if_none_match=etag)
+        self.assertEqual(response['status'], '304 Not Modified')
+        self.assertEqual(response['body'], b'')
+
+        # WebP is negotiated, concurrent identical requests are rendered once
+        responses = []
+        threads = [threading.Thread(target=lambda: responses.append(self.request(
+            application, '/fill/4x4/10x20.jpg', accept='image/webp,*/*')))
+            for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(executor.submitted, 2)
+        self.assertEqual(set(response['headers']['Content-Type'] for response in responses),
+                         set(['image/webp']))
+        self.assertEqual(responses[0]['headers']['Vary'], 'Accept')
+        self.request(application, '/fill/4x4/10x20.jpg', accept='image/webp')
+        self.assertEqual(executor.submitted, 2)
+
+        self.assertEqual(self.request(application, '/fit/4x4/../setup.py')['status'],
+                         '404 Not Found')
+        self.assertEqual(self.request(application, '/fit/4x4/missing.jpg')['status'],
+                         '404 Not Found')
+        self.assertEqual(self.request(application, '/adjust/contrast=200/10x10.jpg')['status'],
+                         '400 Bad Request')
+        self.assertEqual(self.request(application, '/fit/4x4/tests.py')['status'],
+                         '415 Unsupported Media Type')
+        for i in range(2):
+            self.assertEqual(self.request(application, '/pdf/10x20.jpg')['status'],
+                             '400 Bad Request')
+
+        # Sources in other formats are served as PNG
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        PILImage.new('RGB', (10, 10)).save(os.path.join(directory, 'image.bmp'))
+        application = server.Application(directory, executor=executor)
+        response = self.request(application, '/fit/5x5/image.bmp')
+        self.assertEqual(response['headers']['Content-Type'], 'image/png')
+        self.assertEqual(PILImage.open(io.BytesIO(response['body'])).format, 'PNG')
+
+
+class PillowTest(unittest.TestCase):
+    """Pillow internals animation.FrameSequence and shared.get_view() rely
+    on, which need Pillow 10.1 or later"""
+
+    def test_version(self):
+        version = tuple(int(part) for part in PILImage.__version__.split('.')[:2])
+        self.assertGreaterEqual(version, (10, 1))
+
+    def test_internals(self):
+        # FrameSequence sets a frame's pixels, mode and size like _new()
+        frame = PILImage.new('LA', (3, 2))
+        pil_image = PILImage.Image()
+        pil_image.im = frame.im
+        pil_image._mode = frame.mode
+        pil_image._size = frame.size
+        self.assertEqual((pil_image.mode, pil_image.size), ('LA', (3, 2)))
+        self.assertEqual(pil_image.tobytes(), frame.tobytes())
+
+        # get_view() maps RGB buffers
+        data = bytearray(b'\x01\x02\x03\x00' * 6)
+        view = PILImage.new('RGB', (0, 0))._new(PILImage.core.map_buffer(
+            data, (3, 2), 'raw', 0, ('RGB', 0, 1)))
+        self.assertEqual(view.getpixel((2, 1)), (1, 2, 3))
+
+
+def get_shared_size(handle):
+    with handle.open() as image:
+        image.resize(width=5)
+        return image.width, image.height, image.format
+
+
+class SharedTest(unittest.TestCase):
+
+    def test_shared(self):
+        image = images.from_file('tests/20x10.jpg')
+        image.resize(width=200, height=100)
+        image.flip('horizontal')
+        handle = image.to_shared()
+        self.addCleanup(handle.release)
+        data = pickle.dumps(handle)
+        # Pixels aren't pickled
+        self.assertLess(len(data), 4096)
+
+        # Opened without copying the pixels
+        received = pickle.loads(data)
+        with received.open() as opened:
+            pil_image = opened.get_pil_image()
+            self.assertEqual(pil_image.mode, 'RGB')
+            self.assertTrue(pil_image.readonly)
+            self.assertEqual(pil_image.tobytes(), image.get_pil_image().tobytes())
+            self.assertEqual(opened.format, 'JPEG')
+            del pil_image
+        self.assertIsNone(received._memory)
+        self.assertRaises(ValueError, received.release)
+
+        with futures.ProcessPoolExecutor(max_workers=1) as executor:
+            self.assertEqual(executor.submit(get_shared_size, handle).result(),
+                             (5, 2, 'JPEG'))
+
+        # Palette images keep their palette, other modes are copied
+        for mode in ('P', 'LA'):
+            pil_image = PILImage.open('tests/20x10.jpg').convert(mode)
+            with images.Image._from_pil_image(pil_image).to_shared() as handle:
+                received = pickle.loads(pickle.dumps(handle))
+                shared_image = received.get_pil_image()
+                self.assertEqual(shared_image.tobytes(), pil_image.tobytes())
+                self.assertEqual(shared_image.getpalette(), pil_image.getpalette())
+                del shared_image
+                received.close()
+            self.assertRaises(FileNotFoundError, shared._attach, handle.name)
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class HashingTest(unittest.TestCase):
+
+    def test_hash(self):
+        pil_image = PILImage.effect_noise((120, 80), 80).convert('RGB').resize((600, 400))
+        buffer = io.BytesIO()
+        pil_image.save(buffer, format='JPEG', quality=95)
+        original = images.from_bytes(buffer.getvalue())
+        buffer = io.BytesIO()
+        pil_image.resize((300, 200)).save(buffer, format='JPEG', quality=40)
+        copy = images.from_bytes(buffer.getvalue())
+        flipped = images.from_bytes(buffer.getvalue())
+        flipped.flip('horizontal')
+        for method in hashing.METHODS:
+            value = original.get_hash(method)
+            self.assertLessEqual(hashing.get_distance(value, copy.get_hash(method)), 6)
+            self.assertGreater(hashing.get_distance(value, flipped.get_hash(method)), 10)
+        self.assertRaises(ValueError, original.get_hash, 'md5')
+
+    def test_distinct_images(self):
+        """pHashes of re-encoded copies are within MAX_DISTANCE, distinct
+        images' aren't"""
+        gradients = [PILImage.linear_gradient('L'), PILImage.linear_gradient('L').rotate(90),
+                     PILImage.radial_gradient('L')]
+        sources = [PILImage.effect_noise((60, 40), 80).resize((300, 200)) for i in range(6)]
+        for index, gradient in enumerate(gradients):
+            sources[index] = PILImage.blend(sources[index], gradient.resize((300, 200)), 0.5)
+        values = []
+        for pil_image in sources:
+            buffer = io.BytesIO()
+            pil_image.convert('RGB').save(buffer, format='JPEG', quality=90)
+            values.append(images.from_bytes(buffer.getvalue()).get_hash())
+            buffer = io.BytesIO()
+            pil_image.convert('RGB').resize((150, 100)).save(buffer, format='JPEG', quality=40)
+            copy = images.from_bytes(buffer.getvalue()).get_hash()
+            self.assertLessEqual(hashing.get_distance(values[-1], copy), hashing.MAX_DISTANCE)
+        for index, value in enumerate(values):
+            for other in values[index + 1:]:
+                self.assertGreater(hashing.get_distance(value, other), hashing.MAX_DISTANCE)
+
+    def test_index(self):
+        index = hashing.HashIndex()
+        index.add('a.jpg', 0)
+        index.add('b.jpg', 0b111)
+        index.add('c.jpg', 2 ** 64 - 1)
+        self.assertEqual(index.query(0b1, max_distance=2), [('a.jpg', 1), ('b.jpg', 2)])
+        index.add('d.jpg', 0b1)
+        self.assertEqual(index.nearest(2 ** 64 - 2, count=2), [('c.jpg', 1), ('b.jpg', 62)])
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'hashes.npy')
+        index.save(filename)
+        self.assertEqual(os.stat(filename).st_mode & 0o777, 0o666 & ~get_umask())
+        loaded = hashing.HashIndex.load(filename)
+        self.assertEqual(len(loaded), 4)
+        self.assertEqual(loaded.query(0b1), index.query(0b1))
+        loaded.add('e.jpg', 0b11)
+        self.assertEqual(loaded.nearest(0b11), [('e.jpg', 0)])
+        self.assertEqual(hashing.HashIndex().nearest(0), [])
+
+
+class PlaceholdersTest(unittest.TestCase):
+
+    def test_placeholders(self):
+        # Mostly blue, with a red quarter
+        pil_image = PILImage.new('RGB', (400, 300), (0, 0, 255))
+        pil_image.paste((255, 0, 0), (0, 0, 200, 150))
+        buffer = io.BytesIO()
+        pil_image.save(buffer, format='PNG')
+        image = images.from_bytes(buffer.getvalue())
+        for value, expected in zip(image.get_color('dominant'), (0, 0, 255)):
+            self.assertAlmostEqual(value, expected, delta=2)
+        self.assertEqual(image.get_color(), (64, 0, 191))
+        self.assertRaises(ValueError, image.get_color, 'median')
+
+        lqip = image.get_lqip(size=20, format='jpeg')
+        self.assertTrue(lqip.startswith('data:image/jpeg;base64,'))
+        with PILImage.open(io.BytesIO(base64.b64decode(lqip.split(',')[1]))) as decoded:
+            self.assertEqual(decoded.size, (20, 15))
+
+        # Transparent pixels are ignored
+        pil_image = PILImage.new('RGBA', (40, 40), (0, 0, 0, 0))
+        pil_image.paste((255, 0, 0, 255), (0, 0, 10, 10))
+        self.assertEqual(placeholders.get_average_color(pil_image), (255, 0, 0))
+        self.assertEqual(placeholders.get_dominant_color(pil_image), (255, 0, 0))
+        self.assertTrue(placeholders.get_lqip(pil_image).startswith('data:image/webp;'))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_blurhash(self):
+        # Size flag, maximum AC component, DC (the average color), then AC
+        # components
+        pil_image = PILImage.new('RGB', (32, 32), (255, 0, 0))
+        self.assertEqual(placeholders.get_blurhash(pil_image, (1, 1)), '00TI:j')
+        blurhash = placeholders.get_blurhash(pil_image)
+        self.assertEqual(len(blurhash), 6 + 2 * 11)
+        self.assertEqual(blurhash[0] + blurhash[2:6], 'LTI:j')
+        self.assertRaises(ValueError, placeholders.get_blurhash, pil_image, (10, 1))
+
+        image = images.from_file('tests/20x10.jpg')
+        result = image.get_placeholders(blurhash_components=(3, 2))
+        self.assertEqual(len(result['blurhash']), 4 + 2 * 3 * 2)
+        self.assertEqual(result['blurhash'], image.get_blurhash((3, 2)))
+        self.assertEqual(result['average_color'], image.get_color('average'))
+        self.assertEqual(sorted(result), ['average_color', 'blurhash', 'dominant_color', 'lqip'])
+
+
+class MemoryTest(unittest.TestCase):
+
+    def test_estimate(self):
+        pil_image = PILImage.new('RGB', (4000, 3000))
+        buffer = io.BytesIO()
+        pil_image.save(buffer, format='JPEG')
+        image = images.from_bytes(buffer.getvalue(), deferred=True)
+        self.assertEqual(image.estimate_memory(), 4000 * 3000 * 4)
+        # Decoded at 1/4 scale, then resampled through a 500x750 image
+        image.resize(width=500, height=375)
+        self.assertEqual(image.estimate_memory(), (1000 * 750 + 500 * 750 + 500 * 375) * 4)
+        self.assertFalse(pipeline.is_loaded(image._pil_image))
+        # WebP's encoder copies the image twice
+        self.assertEqual(image.estimate_memory('webp'), (1000 * 750 + 500 * 750 + 500 * 375) * 4)
+        image.crop(100, 100)
+        self.assertEqual(image.estimate_memory(), (1000 * 750 + 100 * 750 + 100 * 100) * 4)
+
+        # The flattened copy and alpha band
+        image = images.Image._from_pil_image(PILImage.new('RGBA', (100, 100)))
+        self.assertEqual(image.estimate_memory('png'), 100 * 100 * 4)
+        self.assertEqual(image.estimate_memory('jpeg'), 100 * 100 * 9)
+
+    def test_budget(self):
+        budget = memory.MemoryBudget(100, timeout=0)
+        budget.acquire(60)
+        self.assertRaises(memory.BudgetExceeded, budget.acquire, 50)
+        self.assertRaises(memory.ImageTooLarge, budget.acquire, 101)
+
+        # Reservations are granted in arrival order
+        granted = []
+
+        def reserve(nbytes):
+            with budget.reserve(nbytes, timeout=5):
+                granted.append(nbytes)
+
+        threads = []
+        for nbytes in (80, 10):
+            threads.append(threading.Thread(target=reserve, args=(nbytes,)))
+            threads[-1].start()
+            while budget.queued < len(threads):
+                time.sleep(0.001)
+        budget.release(60)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(granted, [80, 10])
+        self.assertEqual(budget.available, 100)
+
+        budget = memory.MemoryBudget(100, max_queued=0)
+        budget.acquire(100)
+        self.assertRaises(memory.BudgetExceeded, budget.acquire, 1)
+
+    def test_image_budget(self):
+        budget = memory.MemoryBudget(2 * 10 * 10 * 4, max_pixels=150, timeout=0)
+        self.assertRaises(memory.ImageTooLarge, images.from_file, 'tests/10x20.jpg',
+                          budget=budget)
+        image = images.from_file('tests/10x10.jpg', budget=budget)
+        image.flip('horizontal')
+        self.assertEqual(budget.available, 800)
+        self.assertRaises(memory.ImageTooLarge, image.resize, width=20, height=20)
+
+        # Saved renditions are covered by the image's single reservation
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        specs = [{'width': 8, 'filename': os.path.join(directory, 'large.webp')},
+                 {'width': 4, 'filename': os.path.join(directory, 'small.jpg')}]
+        reservations = []
+        large_budget = memory.MemoryBudget(10 ** 6)
+        acquire = large_budget.acquire
+        large_budget.acquire = lambda nbytes, timeout=None: (
+            reservations.append(nbytes), acquire(nbytes, timeout))
+        memory.set_default_budget(large_budget)
+        self.addCleanup(memory.set_default_budget, None)
+        images.from_file('tests/10x10.jpg', deferred=True).renditions(specs)
+        self.assertEqual(len(reservations), 1)
+        memory.set_default_budget(memory.MemoryBudget(reservations[0] * 3 // 2, timeout=0))
+        renditions = images.from_file('tests/10x10.jpg', deferred=True).renditions(specs)
+        self.assertEqual([rendition.width for rendition in renditions], [8, 4])
+        self.assertTrue(os.path.exists(specs[1]['filename']))
+
+        memory.set_default_budget(budget)
+        self.assertRaises(memory.ImageTooLarge, images.from_file, 'tests/20x10.jpg')
+        application = server.Application('tests')
+        self.addCleanup(application.executor.shutdown)
+        self.assertEqual(ServerTest().request(application, '/fit/4x4/20x10.jpg')['status'],
+                         '413 Payload Too Large')
+        budget.acquire(500)
+        self.assertEqual(ServerTest().request(application, '/fit/4x4/10x10.jpg')['status'],
+                         '503 Service Unavailable')
+        budget.release(500)
+
+    def test_process_budget(self):
+        """Worker processes get a copy of the budget, with the same limits"""
+        budget = memory.MemoryBudget(2 * 10 * 10 * 4, max_pixels=150, timeout=0)
+        received = pickle.loads(pickle.dumps(budget))
+        self.assertIs(received, budget)
+        with futures.ProcessPoolExecutor(max_workers=1) as executor:
+            application = server.Application('tests', executor=executor, budget=budget)
+            self.assertEqual(ServerTest().request(application, '/fit/4x4/20x10.jpg')['status'],
+                             '413 Payload Too Large')
+            # Reservations of this process aren't sent
+            budget.acquire(500)
+            self.addCleanup(budget.release, 500)
+            self.assertEqual(ServerTest().request(application, '/fit/4x4/10x10.jpg')['status'],
+                             '200 OK')
+
+
+class CacheTest(unittest.TestCase):
+
+    def test_memory_cache(self):
+        memory_cache = cache.MemoryCache(max_bytes=10)
+        memory_cache.set('a', b'12345')
+        memory_cache.set('b', b'12345')
+        self.assertEqual(memory_cache.get('a'), b'12345')
+        # "b" is the least recently used entry
+        memory_cache.set('c', b'12345')
+        self.assertIsNone(memory_cache.get('b'))
+        self.assertEqual(memory_cache.stats(),
+                         {'hits': 1, 'misses': 1, 'entries': 2, 'bytes': 10})
+
+    def test_file_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        file_cache = cache.FileCache(directory, max_bytes=10)
+        file_cache.set('a', b'12345')
+        file_cache.set('b', b'12345')
+        file_cache.get('a')
+        file_cache.set('c', b'12345')
+        self.assertEqual(sorted(os.listdir(directory)), ['a', 'c'])
+        self.assertEqual(os.stat(os.path.join(directory, 'a')).st_mode & 0o777,
+                         0o666 & ~get_umask())
+        # Existing entries are picked up
+        self.assertEqual(cache.FileCache(directory).size, 10)
+
+    def test_save(self):
+        memory_cache = cache.MemoryCache()
+        for i in range(2):
+            image = images.from_file('tests/20x10.jpg', deferred=True)
+            image.resize(width=10)
+            image.set(format='png')
+            file_like_object = io.BytesIO()
+            image.save(file=file_like_object, cache=memory_cache)
+            self.assertTrue(file_like_object.getvalue())
+        self.assertEqual((memory_cache.hits, memory_cache.misses), (1, 1))
+        # Cache hit doesn't decode the image
+        self.assertFalse(pipeline.is_loaded(image._pil_image))
+
+        image = images.from_file('tests/20x10.jpg')
+        image.resize(width=5)
+        self.assertNotEqual(image.get_cache_key(), None)
+        image.get_pil_image()
+        self.assertIsNone(image.get_cache_key())
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def test_instrument(self):
+        with instrumentation.instrument() as collector:
+            image = images.from_file('tests/no_bg.png', deferred=True)
+            image.resize(width=5)
+            image.to_bytes(format='jpeg')
+        names = [record.name for record in collector.records]
+        self.assertEqual(names, ['open', 'decode', 'resize', 'flatten', 'encode'])
+        encode = collector.records[-1]
+        self.assertEqual(encode.input_size, (image.width, image.height))
+        self.assertGreater(encode.bytes, 0)
+        summary = collector.summary()
+        self.assertEqual(summary['resize']['count'], 1)
+        self.assertEqual(summary['flatten']['max_pixel_bytes'],
+                         image.width * image.height * 4)
+
+        # Hooks are removed afterwards
+        image = images.from_file('tests/20x10.jpg')
+        image.resize(width=10)
+        self.assertEqual(len(collector.records), 5)
+
+    def test_statsd_sink(self):
+        sink = instrumentation.StatsdSink(prefix='images')
+        self.addCleanup(sink.close)
+        record = instrumentation.Record('encode', 0.01, 0.005, (10, 10), (10, 10),
+                                        'RGB', 120, 400)
+        self.assertEqual(sink.get_metrics(record), [
+            'images.encode.count:1|c',
+            'images.encode.wall_time:10.000|ms',
+            'images.encode.cpu_time:5.000|ms',
+            'images.encode.bytes:120|h',
+            'images.encode.pixel_bytes:400|h',
+        ])
+
+
+class TestRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+
+    def setup(self):
+        TestRequestHandler.connections += 1
+        SimpleHTTPRequestHandler.setup(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FetchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        handler = functools.partial(TestRequestHandler, directory='tests')
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.url = 'http://127.0.0.1:%d/' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_fetch(self):
+        fetcher = fetch.Fetcher(timeout=5)
+        connections = TestRequestHandler.connections
+        response = fetcher.fetch(self.url + '10x10.jpg')
+        with open('tests/10x10.jpg', 'rb') as file:
+            self.assertEqual(response.data, file.read())
+
+        # Connection is kept alive
+        response = fetcher.fetch(self.url + '10x20.jpg')
+        self.assertFalse(response.not_modified)
+        self.assertEqual(TestRequestHandler.connections, connections + 1)
+
+        response = fetcher.fetch(self.url + '10x20.jpg',
+                                 last_modified=response.last_modified)
+        self.assertTrue(response.not_modified)
+        self.assertIsNone(response.data)
+        self.assertRaises(fetch.FetchError, fetcher.fetch, self.url + 'missing.jpg')
+        fetcher.close()
+
+    def test_limits(self):
+        fetcher = fetch.Fetcher(max_bytes=100)
+        self.assertRaises(fetch.ResponseTooLarge, fetcher.fetch, self.url + '10x10.jpg')
+        fetcher = fetch.Fetcher(max_pixels=150)
+        fetcher.fetch(self.url + '10x10.jpg')
+        self.assertRaises(fetch.ResponseTooLarge, fetcher.fetch, self.url + '10x20.jpg')
+
+        # Past Pillow's own limit, the image couldn't be opened anyway
+        max_image_pixels = PILImage.MAX_IMAGE_PIXELS
+        self.addCleanup(setattr, PILImage, 'MAX_IMAGE_PIXELS', max_image_pixels)
+        PILImage.MAX_IMAGE_PIXELS = 50
+        fetcher.max_pixels = 1000
+        self.assertRaises(fetch.ResponseTooLarge, fetcher.fetch, self.url + '10x20.jpg')
+        fetcher.close()
+
+    def test_retry(self):
+        class Connection(object):
+            closed = False
+
+            def request(self, *args, **kwargs):
+                raise ConnectionResetError()
+
+            def close(self):
+                self.closed = True
+
+        # A reused connection failing is retried once on a new connection,
+        # both are closed if the retry fails too
+        connections = [Connection(), Connection()]
+        fetcher = fetch.Fetcher()
+        fetcher._new_connection = lambda scheme, netloc: connections[1]
+        fetcher._release_connection('http', '127.0.0.1', connections[0])
+        self.assertRaises(OSError, fetcher.fetch, 'http://127.0.0.1/10x10.jpg')
+        self.assertEqual([connection.closed for connection in connections], [True, True])
+
+    def test_from_url(self):
+        fetcher = fetch.Fetcher()
+        self.addCleanup(fetcher.close)
+        image = images.from_url(self.url + '10x20.jpg', fetcher=fetcher)
+        self.assertEqual((image.width, image.height), (10, 20))
+        self.assertEqual(image.name, '10x20.jpg')
+
+        urls = [self.url + '10x10.jpg', self.url + 'missing.jpg', self.url + '20x10.jpg']
+        self.assertRaises(fetch.FetchError, images.from_urls, urls, fetcher=fetcher)
+        results = images.from_urls(urls, return_exceptions=True, fetcher=fetcher)
+        self.assertEqual(results[0].width, 10)
+        self.assertIsInstance(results[1], fetch.FetchError)
+        self.assertEqual(results[2].width, 20)
+
+
+class AsyncImageTest(unittest.TestCase):
+
+    def test_save_async(self):
+        async def process():
+            image = await aio.AsyncImage.open('tests/20x10.jpg')
+            image.resize(width=10)
+            image.set(format='png')
+            file_like_object = io.BytesIO()
+            await image.save_async(file=file_like_object)
+            return image, file_like_object
+
+        image, file_like_object = asyncio.run(process())
+        self.assertEqual((image.width, image.height), (10, 5))
+        self.assertEqual(PILImage.open(file_like_object).format, 'PNG')
+
+    def test_runner(self):
+        runner = aio.Runner(max_concurrency=1, max_queued=1)
+        self.addCleanup(runner.shutdown)
+
+        async def process():
+            tasks = [asyncio.ensure_future(runner.run(time.sleep, 0.05))
+                     for i in range(3)]
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        results = asyncio.run(process())
+        self.assertEqual(results[:2], [None, None])
+        self.assertIsInstance(results[2], aio.RunnerBusy)
+
+        # The runner isn't bound to the first event loop
+        results = asyncio.run(process())
+        self.assertEqual(results[:2], [None, None])
+
+    def test_cancel(self):
+        """A cancelled coroutine holds its slot until its function returns"""
+        runner = aio.Runner(executor=futures.ThreadPoolExecutor(max_workers=2),
+                            max_concurrency=1)
+        self.addCleanup(runner.shutdown)
+        events = []
+
+        def work(name, delay):
+            events.append(('start', name))
+            time.sleep(delay)
+            events.append(('end', name))
+
+        async def process():
+            first = asyncio.ensure_future(runner.run(work, 'first', 0.1))
+            await asyncio.sleep(0.02)
+            first.cancel()
+            waiting = asyncio.ensure_future(runner.run(work, 'cancelled', 0))
+            await asyncio.sleep(0)
+            waiting.cancel()
+            await runner.run(work, 'second', 0)
+
+        asyncio.run(process())
+        self.assertEqual(events, [('start', 'first'), ('end', 'first'),
+                                  ('start', 'second'), ('end', 'second')])
+        self.assertEqual((runner.running, runner.queued), (0, 0))
+
+    def test_async_wrappers(self):
+        async def process():
+            image = await aio.AsyncImage.open('tests/20x10.jpg')
+            await image.to_profile_async('srgb')
+            if numpy is not None:
+                await image.crop_async(10, 10, center='auto')
+            else:
+                image.crop(10, 10)
+            self.assertRaises(ValueError, image.crop, 5, 5, center='auto')
+            self.assertRaises(ValueError, image.resize, 5, 2, 'fill', center='auto')
+            await image.resize_async(8, 4, 'fill', center='auto' if numpy is not None
+                                     else ('50%', '50%'))
+            return (await image.get_hash_async('dhash'), await image.get_color_async(),
+                    await image.get_placeholders_async())
+
+        value, average_color, result = asyncio.run(process())
+        image = images.from_file('tests/20x10.jpg')
+        image.to_profile('srgb')
+        image.crop(10, 10, center='auto' if numpy is not None else ('50%', '50%'))
+        image.resize(8, 4, 'fill', center='auto' if numpy is not None else ('50%', '50%'))
+        self.assertEqual(value, image.get_hash('dhash'))
+        self.assertEqual(average_color, image.get_color())
+        self.assertEqual(result, image.get_placeholders())